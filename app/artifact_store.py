@@ -0,0 +1,204 @@
+"""
+Content-addressed store of finished workflow runs: scripts, output and charts.
+
+A run is keyed by a hash of what it executed (the generated code, or a
+measure's name) and a snapshot of the data it read. An identical later run
+can then be served from the store instead of being executed again:
+
+    artifacts = ArtifactStore()
+    snapshot = data_snapshot(endpoints, store_path)
+    key = artifact_key(code, snapshot)
+    artifact = artifacts.get(key, max_age=reuse_max_age(snapshot))
+    if artifact is None:
+        run_code(code, work_dir, pool)
+        artifact = artifacts.put(key, work_dir, {"charts": [...], ...})
+    artifact.path, artifact.result      # directory with the files, result dict
+
+`put()` moves the whole work directory into the store, so job directories do
+not pile up. A run that is kept but can never be served again (a failed
+or timed-out script, a run without a data snapshot) goes under a `run_key()`
+of its own. Paths into that directory in the result are rewritten to the new
+location. A local store's snapshot is its file size and modification time, so
+any change to the data means a new key. A FHIR endpoint's data can change
+without notice, so runs against endpoints are only reused for
+`FHIR_MAX_AGE` seconds. Entries expire after CLINICAL_ARTIFACT_DAYS, and the
+least recently used go first once the store is over CLINICAL_ARTIFACT_MB.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+from llm_cache import CACHE_DIR
+
+DEFAULT_TTL = float(os.environ.get("CLINICAL_ARTIFACT_DAYS", 7)) * 24 * 3600
+DEFAULT_MAX_BYTES = int(float(os.environ.get("CLINICAL_ARTIFACT_MB", 2048)) * 1024 * 1024)
+FHIR_MAX_AGE = 3600     # seconds a run against FHIR endpoints may be reused
+
+
+def data_snapshot(endpoints: dict[str, str], store_path: str | None) -> dict:
+    """What identifies the version of the data a run reads (JSON-serializable)."""
+    if store_path:
+        path = Path(store_path).resolve()
+        # SQLite in WAL mode writes to the -wal file first. Opening a
+        # connection creates it empty, which must not count as a change.
+        files = [f for f in (path, Path(f"{path}-wal")) if f.exists() and f.stat().st_size]
+        return {"store": str(path), "files": [[f.stat().st_size, f.stat().st_mtime_ns] for f in files]}
+    return {"fhir": sorted(url.rstrip("/") for url in endpoints.values())}
+
+
+def reuse_max_age(snapshot: dict) -> float | None:
+    """How old a run against this data may be and still be reused (None = any age)."""
+    return None if "store" in snapshot else FHIR_MAX_AGE
+
+
+def artifact_key(code: str, snapshot: dict) -> str:
+    payload = json.dumps([code, snapshot], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def run_key() -> str:
+    """A key no other run shares, for keeping a run's files without offering it for reuse."""
+    return uuid.uuid4().hex
+
+
+@dataclass
+class Artifact:
+    key: str
+    path: Path
+    result: dict
+    created: float
+    size: int
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def _jsonable(value):
+    # numpy scalars (pandas summaries) -> Python numbers; anything else as text
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def _relocate(value, old: str, new: str):
+    """`value` with every path string under `old` moved to `new`."""
+    if isinstance(value, str):
+        return new + value[len(old):] if value == old or value.startswith(old + os.sep) else value
+    if isinstance(value, list):
+        return [_relocate(v, old, new) for v in value]
+    if isinstance(value, dict):
+        return {k: _relocate(v, old, new) for k, v in value.items()}
+    return value
+
+
+class ArtifactStore:
+    """Run directories under `root`, indexed in SQLite, with TTL and LRU size eviction."""
+
+    def __init__(
+        self,
+        root: str | Path = CACHE_DIR / "artifacts",
+        ttl: float = DEFAULT_TTL,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The workbench and the scripts it runs may share the store.
+        self.conn = sqlite3.connect(str(self.root / "index.db"), timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            " key TEXT PRIMARY KEY, result TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+
+    def _dir(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str, max_age: float | None = None) -> Artifact | None:
+        """The stored run for `key`, unless missing, expired or older than `max_age` seconds."""
+        now = time.time()
+        oldest = now - self.ttl if max_age is None else now - min(max_age, self.ttl)
+        with self._lock, self.conn:
+            row = self.conn.execute(
+                "SELECT result, size, created FROM artifacts WHERE key = ? AND created > ?", (key, oldest),
+            ).fetchone()
+            if row is None or not self._dir(key).is_dir():
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE artifacts SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return Artifact(key, self._dir(key), json.loads(row[0]), row[2], row[1])
+
+    def put(self, key: str, work_dir: str | Path, result: dict) -> Artifact:
+        """Move `work_dir` into the store under `key`.
+
+        Returns the stored run, whose result is `result` as JSON with paths
+        into `work_dir` rewritten to point into the store.
+        """
+        work_dir, target = Path(work_dir), self._dir(key)
+        # Move into place under a temporary name, then rename: readers never
+        # see a half-moved run, and a rerun replaces the previous one whole.
+        staging = self.root / f".{key}.{uuid.uuid4().hex[:8]}"
+        shutil.move(str(work_dir), str(staging))
+        result = _relocate(json.loads(json.dumps(result, default=_jsonable)), str(work_dir), str(target))
+        size, now = _dir_size(staging), time.time()
+        with self._lock, self.conn:
+            if target.exists():
+                shutil.rmtree(target, ignore_errors=True)
+            target.parent.mkdir(exist_ok=True)
+            os.replace(staging, target)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(result), size, now, now),
+            )
+            self._evict(now, keep=key)
+        return Artifact(key, target, result, now, size)
+
+    def _evict(self, now: float, keep: str):
+        expired = self.conn.execute("SELECT key FROM artifacts WHERE created <= ?", (now - self.ttl,)).fetchall()
+        doomed = [key for key, in expired]
+        total = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE created > ?", (now - self.ttl,),
+        ).fetchone()[0]
+        if total > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM artifacts WHERE created > ? AND key != ? ORDER BY accessed", (now - self.ttl, keep),
+            ).fetchall()
+            for key, size in rows:
+                doomed.append(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self.conn.executemany("DELETE FROM artifacts WHERE key = ?", [(key,) for key in doomed])
+        for key in doomed:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        shutil.rmtree(self._dir(key), ignore_errors=True)
+        try:
+            self._dir(key).parent.rmdir()     # the two-character prefix directory, once empty
+        except OSError:
+            pass
+
+    def clear(self):
+        with self._lock, self.conn:
+            keys = [key for key, in self.conn.execute("SELECT key FROM artifacts").fetchall()]
+            self.conn.execute("DELETE FROM artifacts")
+            for key in keys:
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
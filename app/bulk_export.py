@@ -0,0 +1,142 @@
+"""
+FHIR Bulk Data ($export) client.
+
+Implements the asynchronous kick-off / poll / download flow from the Bulk Data
+Access spec. Output files are NDJSON (one resource per line) and are streamed:
+downloads go to disk in fixed-size chunks and parsing reads one line at a
+time, so memory stays bounded regardless of export size.
+
+    from fhir_client import FHIRClient
+    from bulk_export import export
+
+    client = FHIRClient("https://bulk-data.example.org/fhir")
+    files = export(client, "fallback-data/bulk", types=["Patient", "Condition"])
+
+`scripts/cache-fhir-data.py --bulk` runs an export into the offline cache.
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+from fhir_client import FHIRClient
+
+NDJSON = "application/fhir+ndjson"
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_EXPORT_TIMEOUT = 3600
+DOWNLOAD_CHUNK = 1 << 20
+
+
+class BulkExportError(RuntimeError):
+    pass
+
+
+def kick_off(
+    client: FHIRClient,
+    level: str = "Patient",
+    types: list[str] | None = None,
+    since: str | None = None,
+) -> str:
+    """Start an export and return the status URL to poll.
+
+    `level` is "" (system), "Patient" (all patients) or "Group/<id>".
+    """
+    path = f"{level.strip('/')}/$export" if level else "$export"
+    params = {"_outputFormat": NDJSON}
+    if types:
+        params["_type"] = ",".join(types)
+    if since:
+        params["_since"] = since
+    r = client.session.get(
+        client.url(path),
+        params=params,
+        headers={"Accept": "application/fhir+json", "Prefer": "respond-async"},
+        timeout=client.timeout,
+    )
+    if r.status_code != 202 or "Content-Location" not in r.headers:
+        raise BulkExportError(f"$export kick-off failed: HTTP {r.status_code} {r.text[:200]}")
+    return r.headers["Content-Location"]
+
+
+def poll(
+    client: FHIRClient,
+    status_url: str,
+    interval: float = DEFAULT_POLL_INTERVAL,
+    timeout: float = DEFAULT_EXPORT_TIMEOUT,
+) -> dict:
+    """Poll the status URL until the export completes; returns the manifest."""
+    deadline = time.monotonic() + timeout
+    while True:
+        r = client.session.get(status_url, headers={"Accept": "application/json"}, timeout=client.timeout)
+        if r.status_code == 200:
+            return r.json()
+        if r.status_code != 202:
+            raise BulkExportError(f"$export failed: HTTP {r.status_code} {r.text[:200]}")
+        if time.monotonic() > deadline:
+            raise BulkExportError(f"$export did not finish within {timeout:.0f}s")
+        try:
+            wait = float(r.headers.get("Retry-After", interval))
+        except ValueError:
+            wait = interval
+        time.sleep(max(wait, 0.1))
+
+
+def iter_ndjson(client: FHIRClient, url: str) -> Iterator[dict]:
+    """Stream resources from a remote NDJSON file without holding it in memory."""
+    with client.session.get(url, headers={"Accept": NDJSON}, stream=True, timeout=client.timeout) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def download(client: FHIRClient, url: str, path: str | Path) -> Path:
+    """Stream one output file to disk in fixed-size chunks."""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".part")
+    with client.session.get(url, headers={"Accept": NDJSON}, stream=True, timeout=client.timeout) as r:
+        r.raise_for_status()
+        with open(tmp, "wb") as f:
+            for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                f.write(chunk)
+    os.replace(tmp, path)
+    return path
+
+
+def export(
+    client: FHIRClient,
+    out_dir: str | Path,
+    level: str = "Patient",
+    types: list[str] | None = None,
+    since: str | None = None,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+) -> list[Path]:
+    """Run a full export and download every output file to `out_dir`.
+
+    Files are named `<Type>.<n>.ndjson`; downloads run concurrently on the
+    client's thread pool. Returns the downloaded paths.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    status_url = kick_off(client, level, types, since)
+    manifest = poll(client, status_url, poll_interval)
+
+    jobs, per_type = [], {}
+    for item in manifest.get("output", []):
+        n = per_type[item["type"]] = per_type.get(item["type"], 0) + 1
+        jobs.append((item["url"], out_dir / f"{item['type']}.{n}.ndjson"))
+    paths = client.map(lambda job: download(client, *job), jobs)
+
+    for item in manifest.get("error", []):
+        for outcome in iter_ndjson(client, item["url"]):
+            for issue in outcome.get("issue", []):
+                print(f"  export error: {issue.get('diagnostics') or issue.get('code')}")
+
+    # Tell the server it can discard the export files.
+    try:
+        client.session.delete(status_url, timeout=client.timeout)
+    except Exception:
+        pass
+    return paths
@@ -0,0 +1,369 @@
+"""
+Local indexed clinical store.
+
+Loads FHIR Bundles (or NDJSON) into a SQLite database with flattened,
+indexed tables for the questions the workflows ask, so cohort queries run
+locally in milliseconds instead of minutes of REST calls:
+
+    from clinical_store import ClinicalStore
+
+    store = ClinicalStore("clinical.db")
+    store.ingest_dir("fallback-data")
+    a1c = store.latest_observations("4548-4", cohort="44054006")   # DataFrame
+    meds = store.medications(a1c["patient_id"], status="active")
+
+Run `python app/clinical_store.py fallback-data/ --db clinical.db` to build a
+store from cached Bundles.
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable
+
+import pandas as pd
+
+DEFAULT_STORE = Path(__file__).resolve().parent.parent / "fallback-data" / "clinical.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    patient_id TEXT,
+    last_updated TEXT,
+    json TEXT NOT NULL,
+    PRIMARY KEY (type, id)
+);
+CREATE TABLE IF NOT EXISTS patients (
+    id TEXT PRIMARY KEY,
+    gender TEXT,
+    birth_date TEXT,
+    family TEXT,
+    given TEXT
+);
+CREATE TABLE IF NOT EXISTS conditions (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    code TEXT,
+    display TEXT,
+    clinical_status TEXT,
+    onset TEXT
+);
+CREATE TABLE IF NOT EXISTS observations (
+    obs_id TEXT NOT NULL,
+    patient_id TEXT,
+    code TEXT,
+    display TEXT,
+    value REAL,
+    unit TEXT,
+    effective TEXT
+);
+CREATE TABLE IF NOT EXISTS medications (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    status TEXT,
+    name TEXT,
+    rxnorm TEXT,
+    authored TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_resources_patient ON resources (patient_id, type);
+CREATE INDEX IF NOT EXISTS idx_obs_patient_code_date ON observations (patient_id, code, effective);
+CREATE INDEX IF NOT EXISTS idx_obs_code_patient ON observations (code, patient_id, effective, value, unit);
+CREATE INDEX IF NOT EXISTS idx_obs_id ON observations (obs_id);
+CREATE INDEX IF NOT EXISTS idx_cond_code_status ON conditions (code, clinical_status);
+CREATE INDEX IF NOT EXISTS idx_cond_patient ON conditions (patient_id);
+CREATE INDEX IF NOT EXISTS idx_med_patient_status ON medications (patient_id, status);
+"""
+
+
+def _utc(ts: str | None) -> str | None:
+    """Normalize an ISO timestamp to UTC so string ordering matches time ordering."""
+    if not ts or len(ts) <= 10:
+        return ts
+    try:
+        dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    except ValueError:
+        return ts
+    if dt.tzinfo is None:
+        return dt.isoformat()
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _coding(concept: dict | None) -> dict:
+    return ((concept or {}).get("coding") or [{}])[0]
+
+
+def _patient_ref(resource: dict) -> str | None:
+    ref = (resource.get("subject") or resource.get("patient") or {}).get("reference", "")
+    return ref.split("/")[-1] or None
+
+
+def read_resources(path: str | Path) -> Iterable[dict]:
+    """Yield resources from a Bundle JSON file or an NDJSON file."""
+    path = Path(path)
+    with open(path) as f:
+        if path.suffix == ".ndjson":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        data = json.load(f)
+    if data.get("resourceType") == "Bundle":
+        for entry in data.get("entry", []):
+            if "resource" in entry:
+                yield entry["resource"]
+    elif "resourceType" in data:
+        yield data
+
+
+class ClinicalStore:
+    """SQLite-backed store of flattened FHIR resources."""
+
+    def __init__(self, path: str | Path = DEFAULT_STORE):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    # -- ingestion ---------------------------------------------------------
+
+    def ingest(self, resources: Iterable[dict], batch_size: int = 5000) -> int:
+        """Upsert resources; returns the number ingested."""
+        count, batch = 0, []
+        for resource in resources:
+            batch.append(resource)
+            if len(batch) >= batch_size:
+                count += self._ingest_batch(batch)
+                batch = []
+        if batch:
+            count += self._ingest_batch(batch)
+        return count
+
+    def ingest_bundle(self, bundle: dict) -> int:
+        return self.ingest(e["resource"] for e in bundle.get("entry", []) if "resource" in e)
+
+    def ingest_file(self, path: str | Path) -> int:
+        return self.ingest(read_resources(path))
+
+    def ingest_dir(self, directory: str | Path) -> int:
+        """Ingest every `*.json` Bundle in a directory and every `*.ndjson` file below it."""
+        directory = Path(directory)
+        files = sorted(directory.glob("*.json")) + sorted(directory.rglob("*.ndjson"))
+        return sum(self.ingest_file(p) for p in files)
+
+    def delete(self, resource_type: str, resource_id: str):
+        with self._lock, self.conn:
+            self._delete(resource_type, [resource_id])
+
+    def _delete(self, resource_type: str, ids: list[str]):
+        rows = [(i,) for i in ids]
+        self.conn.executemany("DELETE FROM resources WHERE type = ? AND id = ?", [(resource_type, i) for i in ids])
+        if resource_type == "Patient":
+            self.conn.executemany("DELETE FROM patients WHERE id = ?", rows)
+        elif resource_type == "Condition":
+            self.conn.executemany("DELETE FROM conditions WHERE id = ?", rows)
+        elif resource_type == "Observation":
+            self.conn.executemany("DELETE FROM observations WHERE obs_id = ?", rows)
+        elif resource_type == "MedicationRequest":
+            self.conn.executemany("DELETE FROM medications WHERE id = ?", rows)
+
+    def _ingest_batch(self, batch: list[dict]) -> int:
+        raw, patients, conditions, observations, medications = [], [], [], [], []
+        replaced: dict[str, list[str]] = {}
+        # Several versions of a resource in one batch (history, merged pages):
+        # only the last one counts, as if they were ingested one by one.
+        latest = {(r.get("resourceType"), r.get("id")): r for r in batch}
+        for r in latest.values():
+            rtype, rid = r.get("resourceType"), r.get("id")
+            if not rtype or not rid:
+                continue
+            pid = rid if rtype == "Patient" else _patient_ref(r)
+            raw.append((rtype, rid, pid, r.get("meta", {}).get("lastUpdated"), json.dumps(r, separators=(",", ":"))))
+
+            if rtype == "Patient":
+                name = (r.get("name") or [{}])[0]
+                patients.append((rid, r.get("gender"), r.get("birthDate"), name.get("family"), " ".join(name.get("given", []))))
+            elif rtype == "Condition":
+                coding = _coding(r.get("code"))
+                conditions.append((
+                    rid, pid, coding.get("code"), coding.get("display"),
+                    _coding(r.get("clinicalStatus")).get("code"), _utc(r.get("onsetDateTime")),
+                ))
+            elif rtype == "Observation":
+                replaced.setdefault("Observation", []).append(rid)
+                effective = _utc(r.get("effectiveDateTime") or (r.get("effectivePeriod") or {}).get("start") or r.get("issued"))
+                # One row for the observation itself plus one per component, so
+                # panel members (e.g. systolic 8480-6 inside 55284-4) are queryable.
+                for part in [r] + r.get("component", []):
+                    coding = _coding(part.get("code"))
+                    quantity = part.get("valueQuantity") or {}
+                    observations.append((
+                        rid, pid, coding.get("code"), coding.get("display"),
+                        quantity.get("value"), quantity.get("unit"), effective,
+                    ))
+            elif rtype == "MedicationRequest":
+                concept = r.get("medicationCodeableConcept") or {}
+                coding = _coding(concept)
+                medications.append((
+                    rid, pid, r.get("status"), concept.get("text") or coding.get("display"),
+                    coding.get("code"), _utc(r.get("authoredOn")),
+                ))
+
+        with self._lock, self.conn:
+            for rtype, ids in replaced.items():
+                self._delete(rtype, ids)
+            self.conn.executemany("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)", raw)
+            self.conn.executemany("INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?, ?)", patients)
+            self.conn.executemany("INSERT OR REPLACE INTO conditions VALUES (?, ?, ?, ?, ?, ?)", conditions)
+            self.conn.executemany("INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?, ?)", observations)
+            self.conn.executemany("INSERT OR REPLACE INTO medications VALUES (?, ?, ?, ?, ?, ?)", medications)
+        return len(raw)
+
+    # -- queries -----------------------------------------------------------
+
+    def query(self, sql: str, params: Iterable = (), cohort_ids: Iterable[str] | None = None) -> pd.DataFrame:
+        """Run SQL and return a DataFrame; `cohort_ids` fills the `temp.cohort` table first."""
+        with self._lock:
+            if cohort_ids is not None:
+                self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS cohort (id TEXT PRIMARY KEY)")
+                self.conn.execute("DELETE FROM temp.cohort")
+                self.conn.executemany("INSERT OR IGNORE INTO temp.cohort VALUES (?)", [(i,) for i in cohort_ids])
+            return pd.read_sql_query(sql, self.conn, params=list(params))
+
+    @staticmethod
+    def _cohort_clause(cohort, column: str = "patient_id") -> tuple[str, list, list | None]:
+        """SQL filter for a cohort given as a SNOMED code (str) or patient IDs (iterable).
+
+        Returns (clause, params, cohort_ids) for `query()`.
+        """
+        if cohort is None:
+            return "", [], None
+        if isinstance(cohort, str):
+            return (
+                f" AND {column} IN (SELECT patient_id FROM conditions WHERE code = ? AND clinical_status = 'active')",
+                [cohort],
+                None,
+            )
+        return f" AND {column} IN (SELECT id FROM temp.cohort)", [], list(cohort)
+
+    def cohort(self, snomed_code: str, status: str | None = "active") -> list[str]:
+        """Patient IDs with a Condition matching `snomed_code`."""
+        sql = "SELECT DISTINCT patient_id FROM conditions WHERE code = ?"
+        params = [snomed_code]
+        if status:
+            sql += " AND clinical_status = ?"
+            params.append(status)
+        with self._lock:
+            return [row[0] for row in self.conn.execute(sql + " ORDER BY patient_id", params)]
+
+    def latest_observations(self, loinc_code: str, cohort=None) -> pd.DataFrame:
+        """Latest value per patient for `loinc_code`.
+
+        `cohort` is a SNOMED code (patients with that active condition), a list
+        of patient IDs, or None for every patient. Columns: patient_id, value,
+        unit, effective.
+        """
+        clause, params, ids = self._cohort_clause(cohort)
+        # SQLite returns the bare columns from the row holding MAX(effective).
+        return self.query(
+            "SELECT patient_id, value, unit, MAX(effective) AS effective FROM observations "
+            "WHERE code = ? AND value IS NOT NULL" + clause + " GROUP BY patient_id",
+            [loinc_code, *params],
+            ids,
+        )
+
+    def observations(self, patient_id: str, loinc_code: str | None = None) -> pd.DataFrame:
+        """All observation rows for one patient, newest first."""
+        sql, params = "SELECT * FROM observations WHERE patient_id = ?", [patient_id]
+        if loinc_code:
+            sql += " AND code = ?"
+            params.append(loinc_code)
+        return self.query(sql + " ORDER BY effective DESC", params)
+
+    def conditions(self, patient_id: str | None = None, status: str | None = None) -> pd.DataFrame:
+        sql, params = "SELECT * FROM conditions WHERE 1 = 1", []
+        if patient_id:
+            sql += " AND patient_id = ?"
+            params.append(patient_id)
+        if status:
+            sql += " AND clinical_status = ?"
+            params.append(status)
+        return self.query(sql, params)
+
+    def medications(self, cohort=None, status: str | None = "active") -> pd.DataFrame:
+        """MedicationRequest rows for a cohort (SNOMED code, patient IDs or None)."""
+        clause, params, ids = self._cohort_clause(cohort)
+        sql = "SELECT * FROM medications WHERE 1 = 1" + clause
+        if status:
+            sql += " AND status = ?"
+            params.append(status)
+        return self.query(sql, params, ids)
+
+    def patients(self, cohort=None) -> pd.DataFrame:
+        clause, params, ids = self._cohort_clause(cohort, column="id")
+        return self.query("SELECT * FROM patients WHERE 1 = 1" + clause, params, ids)
+
+    def resource(self, resource_type: str, resource_id: str) -> dict | None:
+        """Raw FHIR JSON for one resource."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT json FROM resources WHERE type = ? AND id = ?", (resource_type, resource_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def resources(self, resource_type: str, patient_id: str | None = None) -> list[dict]:
+        """Raw FHIR JSON for every resource of a type, optionally for one patient."""
+        sql, params = "SELECT json FROM resources WHERE type = ?", [resource_type]
+        if patient_id:
+            sql += " AND patient_id = ?"
+            params.append(patient_id)
+        with self._lock:
+            return [json.loads(row[0]) for row in self.conn.execute(sql, params)]
+
+    def counts(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.conn.execute("SELECT type, COUNT(*) FROM resources GROUP BY type"))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_stores: dict[str, ClinicalStore] = {}
+_stores_lock = threading.Lock()
+
+
+def store_for(path: str | Path) -> ClinicalStore:
+    """Return the process-wide shared store for `path`."""
+    key = str(Path(path).resolve())
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = ClinicalStore(key)
+        return _stores[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load FHIR Bundles / NDJSON into a local clinical store.")
+    parser.add_argument("paths", nargs="+", help="Bundle .json / .ndjson files or directories")
+    parser.add_argument("--db", default=str(DEFAULT_STORE), help=f"SQLite file (default: {DEFAULT_STORE})")
+    args = parser.parse_args()
+
+    with ClinicalStore(args.db) as store:
+        for path in args.paths:
+            n = store.ingest_dir(path) if Path(path).is_dir() else store.ingest_file(path)
+            print(f"  {path}: {n} resources")
+        print(f"\nStore {args.db}: {store.counts()}")
+
+
+if __name__ == "__main__":
+    main()
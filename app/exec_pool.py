@@ -0,0 +1,372 @@
+"""
+Pre-warmed worker processes for running generated analysis scripts.
+
+Starting a fresh `python3` per workflow re-imports pandas, matplotlib and
+requests every time (1-3 s before any analysis runs). Instead, a forkserver
+imports them once and forks long-lived workers from it. Each script then runs
+in a child forked from its warmed worker, which is cheap (copy-on-write) and
+exits when the script ends, so nothing a script changes -- patched modules,
+`pd.set_option`, module globals, caches -- carries over to the next analysis.
+Each run gets its own working directory, a wall-clock timeout (the worker
+and its child are killed and the worker replaced on expiry) and an
+address-space limit. Where `os.fork` is unavailable, scripts run in the
+worker itself, which is recycled after `max_runs` scripts.
+
+A script's stdout goes to a file in its working directory, which the parent
+tails while the script runs: new lines are passed to `on_output` as they
+appear, and only the last `DISPLAY_LINES` are kept in memory. The file keeps
+the full output for download, however much the script prints.
+
+    pool = ExecutionPool(size=2)
+    result = pool.run(code, work_dir)      # ExecResult(returncode, stdout, stderr)
+    result = pool.run(code, work_dir, on_output=lambda lines: print(*lines, sep="\n"))
+"""
+
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import telemetry
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+APP_DIR = Path(__file__).resolve().parent
+PRELOAD = ["pandas", "numpy", "matplotlib", "matplotlib.pyplot", "requests", "fhir_client", "fhir_batch", "fhir_frames", "terminology", "reference_ranges", "telemetry"]
+
+SCRIPT_NAME = "_analysis.py"
+STDOUT_NAME = "_stdout.txt"
+STDERR_NAME = "_stderr.txt"
+
+DEFAULT_TIMEOUT = 120
+DEFAULT_MEMORY_MB = 4096
+DEFAULT_MAX_RUNS = 20
+
+DISPLAY_LINES = 2000        # stdout lines kept in memory (the last ones)
+MAX_LINE_BYTES = 4096       # longer lines are cut
+STDERR_BYTES = 64 * 1024    # tail of stderr returned
+TAIL_INTERVAL = 0.25        # seconds between reads of a running script's output
+READ_CHUNK = 1 << 20
+
+
+@dataclass
+class ExecResult:
+    returncode: int
+    stdout: str             # the last DISPLAY_LINES lines; the full output is in stdout_path
+    stderr: str             # the last STDERR_BYTES
+    peak_rss_kb: int = 0    # high-water RSS of the worker so far (0 if unknown)
+    telemetry: dict | None = None   # the script's trace (`telemetry.Trace.to_dict()`)
+    stdout_lines: int = 0   # lines the script printed in total
+    stdout_path: str = ""
+
+
+class OutputTail:
+    """Ring buffer of the last lines of a growing byte stream, with totals."""
+
+    def __init__(self, max_lines: int = DISPLAY_LINES):
+        self.lines: deque[str] = deque(maxlen=max_lines)
+        self.total_lines = 0
+        self.total_bytes = 0
+        self._partial = b""
+
+    def feed(self, data: bytes) -> list[str]:
+        """Add output; returns the lines it completed."""
+        self.total_bytes += len(data)
+        *complete, partial = (self._partial + data).split(b"\n")
+        # A line with no newline yet is held, cut to MAX_LINE_BYTES.
+        self._partial = partial[:MAX_LINE_BYTES]
+        return self._add(complete)
+
+    def finish(self) -> list[str]:
+        """Flush a final line that has no trailing newline."""
+        partial, self._partial = self._partial, b""
+        return self._add([partial]) if partial else []
+
+    def _add(self, raw: list[bytes]) -> list[str]:
+        lines = [line[:MAX_LINE_BYTES].decode(errors="replace").rstrip("\r") for line in raw]
+        self.lines.extend(lines)
+        self.total_lines += len(lines)
+        return lines
+
+    @property
+    def omitted(self) -> int:
+        """Lines no longer in the buffer."""
+        return self.total_lines - len(self.lines)
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + ("\n" if self.lines else "")
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+# ---------------------------------------------------------------------------
+
+def _limit_memory(memory_mb: int | None):
+    if resource is None or not memory_mb:
+        return
+    limit = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _peak_rss_kb() -> int:
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss   # bytes on macOS, KiB elsewhere
+
+
+def _run_script(script_path: str, work_dir: str) -> tuple[int, dict | None]:
+    """Execute one script as `__main__` with stdout/stderr redirected to files.
+
+    Returns the exit code and the script's trace: FHIR requests made through
+    `fhir_client` and any `telemetry` spans the script records.
+    """
+    home, environ = os.getcwd(), dict(os.environ)
+    stdout = open(os.path.join(work_dir, STDOUT_NAME), "w")
+    stderr = open(os.path.join(work_dir, STDERR_NAME), "w")
+    saved = os.dup(1), os.dup(2)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Redirect at the fd level so output from C extensions is captured too.
+    os.dup2(stdout.fileno(), 1)
+    os.dup2(stderr.fileno(), 2)
+    returncode, script_trace = 0, None
+    try:
+        os.chdir(work_dir)
+        with open(script_path) as f:
+            code = compile(f.read(), script_path, "exec")
+        sys.argv = [script_path]
+        with telemetry.trace("script") as script_trace:
+            exec(code, {"__name__": "__main__", "__file__": script_path, "__builtins__": __builtins__})
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+        stdout.close()
+        stderr.close()
+        os.chdir(home)
+        os.environ.clear()
+        os.environ.update(environ)
+        if "matplotlib.pyplot" in sys.modules:
+            plt = sys.modules["matplotlib.pyplot"]
+            plt.close("all")
+            plt.rcdefaults()
+    return returncode, script_trace.to_dict() if script_trace else None
+
+
+def _run_forked(script_path: str, work_dir: str) -> tuple[int, dict | None, int]:
+    """`_run_script` in a fresh child of this worker; (returncode, trace, peak RSS).
+
+    The child hands its result back through a pipe and exits, taking any
+    state the script changed with it. A child that dies without answering
+    (memory limit, segfault, os._exit) reports its exit status, negative
+    for a signal.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            with os.fdopen(write_fd, "wb") as out:
+                pickle.dump((*_run_script(script_path, work_dir), _peak_rss_kb()), out)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as answer:
+        data = answer.read()
+    _, status = os.waitpid(pid, 0)
+    if data:
+        return pickle.loads(data)
+    return os.waitstatus_to_exitcode(status) or -1, None, 0
+
+
+def _worker_main(conn, memory_mb: int | None):
+    if str(APP_DIR) not in sys.path:
+        sys.path.insert(0, str(APP_DIR))
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()    # so killing the worker's group also kills a running script
+    _limit_memory(memory_mb)
+    sys.stdin = open(os.devnull)
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        if hasattr(os, "fork"):
+            conn.send(_run_forked(*job))
+        else:
+            conn.send((*_run_script(*job), _peak_rss_kb()))
+
+
+# ---------------------------------------------------------------------------
+# Parent side
+# ---------------------------------------------------------------------------
+
+class _Worker:
+    def __init__(self, ctx, memory_mb: int | None):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child, memory_mb), daemon=True)
+        self.process.start()
+        child.close()
+        self.runs = 0
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)     # the worker and a running script
+            except (AttributeError, OSError):
+                self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ExecutionPool:
+    """Fixed-size pool of pre-warmed, recycled script workers."""
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_runs: int = DEFAULT_MAX_RUNS,
+        timeout: float = DEFAULT_TIMEOUT,
+        memory_mb: int | None = DEFAULT_MEMORY_MB,
+    ):
+        self.size = size
+        self.max_runs = max_runs
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+
+        method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        self._ctx = mp.get_context(method)
+        if method == "forkserver":
+            # The forkserver imports these once; every worker forked from it
+            # starts with them already loaded. "__main__" keeps workers from
+            # re-running the parent's entry script on every fork.
+            os.environ.setdefault("MPLBACKEND", "Agg")
+            self._ctx.set_forkserver_preload(["__main__", *PRELOAD])
+        self._idle: queue.Queue[_Worker] = queue.Queue()
+        self._closed = False
+        for _ in range(size):
+            self._idle.put(_Worker(self._ctx, memory_mb))
+
+    def run(
+        self, code: str, work_dir: str, timeout: float | None = None,
+        on_output: Callable[[list[str]], None] | None = None,
+    ) -> ExecResult:
+        """Run `code` in `work_dir` on an idle worker.
+
+        `on_output` is called with each batch of new stdout lines while the
+        script runs. Raises subprocess.TimeoutExpired if the script exceeds
+        the timeout.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        script_path = os.path.join(work_dir, SCRIPT_NAME)
+        stdout_path = os.path.join(work_dir, STDOUT_NAME)
+        with open(script_path, "w") as f:
+            f.write(code)
+        # Created here so it can be tailed from the start; the worker
+        # truncates and writes the same file.
+        open(stdout_path, "wb").close()
+
+        tail = OutputTail()
+        worker = self._idle.get()
+        healthy, peak_rss_kb, trace = False, 0, None
+        try:
+            with open(stdout_path, "rb") as stdout:
+                def drain():
+                    while chunk := stdout.read(READ_CHUNK):
+                        lines = tail.feed(chunk)
+                        if lines and on_output is not None:
+                            on_output(lines)
+
+                try:
+                    worker.conn.send((script_path, work_dir))
+                    deadline = time.monotonic() + timeout
+                    while not worker.conn.poll(max(0.0, min(TAIL_INTERVAL, deadline - time.monotonic()))):
+                        drain()
+                        if time.monotonic() >= deadline:
+                            raise subprocess.TimeoutExpired(script_path, timeout)
+                    returncode, trace, peak_rss_kb = worker.conn.recv()
+                    healthy = True
+                except (EOFError, OSError):
+                    # The worker died before or mid-run (memory limit, os._exit,
+                    # segfault, failed startup). Depending on timing the pipe
+                    # reports that as EOF or as a reset/broken connection.
+                    worker.process.join(timeout=1)
+                    returncode = worker.process.exitcode if worker.process.exitcode else -1
+                drain()
+                last = tail.finish()
+                if last and on_output is not None:
+                    on_output(last)
+        finally:
+            worker.runs += 1
+            self._release(worker, healthy)
+
+        return ExecResult(
+            returncode,
+            tail.text(),
+            _read_tail(os.path.join(work_dir, STDERR_NAME), STDERR_BYTES),
+            peak_rss_kb,
+            trace,
+            tail.total_lines,
+            stdout_path,
+        )
+
+    def _release(self, worker: _Worker, healthy: bool):
+        if healthy and worker.runs < self.max_runs and not self._closed:
+            self._idle.put(worker)
+            return
+        if healthy:
+            worker.stop()
+        else:
+            worker.kill()
+        if not self._closed:
+            self._idle.put(_Worker(self._ctx, self.memory_mb))
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                return
+
+
+def _read_tail(path: str, max_bytes: int) -> str:
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, f.seek(0, os.SEEK_END) - max_bytes))
+            return f.read().decode(errors="replace")
+    except FileNotFoundError:
+        return ""
@@ -0,0 +1,343 @@
+"""
+Batched cohort retrieval on top of `fhir_client`.
+
+Instead of one Observation/MedicationRequest search per patient (N+1 round
+trips), a cohort is split into chunks and each chunk is fetched with a single
+search using a comma-separated `patient=` list. Results are demultiplexed back
+to patient IDs. Chunks run concurrently on the client's thread pool.
+
+    from fhir_client import FHIRClient
+    from fhir_batch import cohort_patient_ids, latest_observations, medications_by_patient
+
+    client = FHIRClient(base_url)
+    ids = cohort_patient_ids(client, "44054006")
+    a1c = latest_observations(client, ids, "4548-4")      # {patient_id: Observation}
+    labs = latest_observations_by_code(client, ids, ["4548-4", "33914-3"])   # {loinc: {patient_id: Observation}}
+    meds = medications_by_patient(client, ids)             # {patient_id: [MedicationRequest]}
+"""
+
+from collections import defaultdict
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+import requests
+
+from fhir_client import FHIRClient
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+RXNORM = "http://www.nlm.nih.gov/research/umls/rxnorm"
+
+# ~50 UUID ids keeps the query string around 2 KB, well under server URL limits.
+DEFAULT_CHUNK_SIZE = 50
+
+
+def patient_id(resource: dict) -> str | None:
+    """Return the patient ID a resource belongs to (Patient.id or subject/patient reference)."""
+    if resource.get("resourceType") == "Patient":
+        return resource.get("id")
+    ref = (resource.get("subject") or resource.get("patient") or {}).get("reference", "")
+    return ref.split("/")[-1] or None
+
+
+def effective_date(resource: dict) -> str:
+    """Best-effort clinical date of an Observation/MedicationRequest, as an ISO string."""
+    return (
+        resource.get("effectiveDateTime")
+        or (resource.get("effectivePeriod") or {}).get("start")
+        or resource.get("issued")
+        or resource.get("authoredOn")
+        or ""
+    )
+
+
+def observation_value(resource: dict, loinc_code: str | None = None) -> float | None:
+    """Numeric value of an Observation.
+
+    Panels such as blood pressure (55284-4) carry their values in `component`;
+    pass the component's LOINC (e.g. 8480-6 for systolic) to read it.
+    """
+    if "valueQuantity" in resource:
+        return resource["valueQuantity"].get("value")
+    for component in resource.get("component", []):
+        codes = {c.get("code") for c in component.get("code", {}).get("coding", [])}
+        if loinc_code in codes and "valueQuantity" in component:
+            return component["valueQuantity"].get("value")
+    return None
+
+
+def observation_codes(resource: dict) -> set[str]:
+    """Codes of an Observation and of its components."""
+    concepts = [resource.get("code") or {}] + [c.get("code") or {} for c in resource.get("component", [])]
+    return {coding.get("code") for concept in concepts for coding in concept.get("coding", [])} - {None}
+
+
+def observation_rows(resources: Iterable[dict]) -> "pd.DataFrame":
+    """Observations as a frame: patient_id, code, display, value, unit, effective.
+
+    Panels such as blood pressure give one row per component (8480-6,
+    8462-4). Columns are strings as in the resources (`effective` is the
+    ISO date-time) and `value` is numeric; `fhir_frames.observations` gives
+    the same rows with typed, categorical columns and more of them.
+    """
+    import pandas as pd
+
+    rows = []
+    for resource in resources:
+        if resource.get("resourceType") != "Observation":
+            continue
+        pid, effective = patient_id(resource), effective_date(resource)
+        parts = resource.get("component") or [resource]
+        for part in parts:
+            coding = ((part.get("code") or {}).get("coding") or [{}])[0]
+            quantity = part.get("valueQuantity") or {}
+            rows.append((pid, coding.get("code"), coding.get("display"), quantity.get("value"), quantity.get("unit"), effective))
+    return pd.DataFrame(rows, columns=["patient_id", "code", "display", "value", "unit", "effective"])
+
+
+def chunked(items: Iterable[str], size: int) -> Iterator[list[str]]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _group(resources: Iterable[dict], wanted: set[str]) -> dict[str, list[dict]]:
+    grouped = defaultdict(list)
+    for resource in resources:
+        pid = patient_id(resource)
+        if pid in wanted:
+            grouped[pid].append(resource)
+    return grouped
+
+
+def search_by_patients(
+    client: FHIRClient,
+    resource_type: str,
+    patient_ids: Iterable[str],
+    params: dict | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> dict[str, list[dict]]:
+    """Run `resource_type?patient=a,b,c&...` per chunk and group results by patient.
+
+    Resources pulled in by `_include` (which have no patient) are dropped here;
+    use `search_chunks` directly when you need them.
+    """
+    ids = list(dict.fromkeys(patient_ids))
+    wanted, grouped = set(ids), defaultdict(list)
+    for chunk_result in search_chunks(client, resource_type, ids, params, chunk_size):
+        for pid, resources in _group(chunk_result, wanted).items():
+            grouped[pid].extend(resources)
+    return {pid: grouped.get(pid, []) for pid in ids}
+
+
+def search_chunks(
+    client: FHIRClient,
+    resource_type: str,
+    patient_ids: list[str],
+    params: dict | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> list[list[dict]]:
+    """Fetch every chunk of a patient-list search concurrently; one resource list per chunk."""
+    queries = [
+        (resource_type, {**(params or {}), "patient": ",".join(chunk)})
+        for chunk in chunked(patient_ids, chunk_size)
+    ]
+    return client.search_many(queries)
+
+
+# ---------------------------------------------------------------------------
+# Cohort selection
+# ---------------------------------------------------------------------------
+
+def cohort_patient_ids(client: FHIRClient, snomed_code: str, status: str | None = None) -> list[str]:
+    """Patient IDs with a Condition matching `snomed_code` (and clinical `status`).
+
+    Uses `Patient?_has:Condition:patient:code=` so the server de-duplicates and
+    returns one small Patient per person; falls back to a Condition search on
+    servers that do not support reverse chaining.
+    """
+    return [p["id"] for p in cohort_patients(client, snomed_code, elements="id", status=status)]
+
+
+def cohort_patients(
+    client: FHIRClient, snomed_code: str, elements: str | None = None, status: str | None = None,
+) -> list[dict]:
+    """Patient resources with a Condition matching `snomed_code`.
+
+    A server that does not know `_has` may ignore it and return every
+    Patient, so it is only used when the server confirms applying it (see
+    `FHIRClient.supports`). Otherwise, and with a clinical `status` such as
+    "active" (separate `_has` parameters need not match the same Condition),
+    the cohort comes from a Condition search and its Patients are fetched by
+    `_id`. Like `ClinicalStore.cohort`, that includes patients whose Patient
+    resource is missing, as stubs with only an id.
+    """
+    has = "_has:Condition:patient:code"
+    params = {has: snomed_code}
+    if elements:
+        params["_elements"] = elements
+    if status is None and client.supports("Patient", has, snomed_code):
+        try:
+            return client.search_all("Patient", params)
+        except requests.HTTPError:
+            pass
+    conditions = client.search("Condition", {"code": snomed_code, **({"clinical-status": status} if status else {})})
+    return patients_by_id(client, sorted({pid for pid in map(patient_id, conditions) if pid}), elements)
+
+
+def patients_by_id(
+    client: FHIRClient, ids: list[str], elements: str | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> list[dict]:
+    """Patient resources for `ids`, in order, from chunked `_id` searches.
+
+    Patients the server does not return (e.g. behind a federated client,
+    which does not translate `_id`) come back as stubs with only an id.
+    """
+    params = {"_elements": elements} if elements else {}
+    queries = [("Patient", {**params, "_id": ",".join(chunk)}) for chunk in chunked(ids, chunk_size)]
+    found = {p.get("id"): p for chunk in client.search_many(queries) for p in chunk}
+    return [found.get(pid) or {"resourceType": "Patient", "id": pid} for pid in ids]
+
+
+def cohort_with_revinclude(
+    client: FHIRClient,
+    snomed_code: str,
+    revinclude: Iterable[str] = ("MedicationRequest:patient",),
+) -> tuple[list[dict], dict[str, list[dict]]]:
+    """Fetch a cohort and resources that reference it in one paged search.
+
+    Returns (patients, {patient_id: [revincluded resources]}).
+    """
+    params = {"_has:Condition:patient:code": snomed_code, "_revinclude": list(revinclude)}
+    patients, related = [], []
+    for resource in client.search("Patient", params):
+        (patients if resource.get("resourceType") == "Patient" else related).append(resource)
+    wanted = {p["id"] for p in patients}
+    grouped = _group(related, wanted)
+    return patients, {pid: grouped.get(pid, []) for pid in wanted}
+
+
+# ---------------------------------------------------------------------------
+# Per-patient data for a cohort
+# ---------------------------------------------------------------------------
+
+def observations_by_patient(
+    client: FHIRClient,
+    patient_ids: Iterable[str],
+    loinc_code: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    code_param: str = "code",
+) -> dict[str, list[dict]]:
+    """All Observations for `loinc_code` per patient, newest first.
+
+    Use `code_param="combo-code"` for codes that live in a panel component
+    (systolic/diastolic BP).
+    """
+    grouped = search_by_patients(
+        client, "Observation", patient_ids, {code_param: loinc_code, "_sort": "-date"}, chunk_size
+    )
+    return {pid: sorted(obs, key=effective_date, reverse=True) for pid, obs in grouped.items()}
+
+
+def latest_observations(
+    client: FHIRClient,
+    patient_ids: Iterable[str],
+    loinc_code: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    code_param: str = "code",
+) -> dict[str, dict]:
+    """Most recent Observation for `loinc_code` per patient (patients without one are omitted)."""
+    grouped = observations_by_patient(client, patient_ids, loinc_code, chunk_size, code_param)
+    return {pid: obs[0] for pid, obs in grouped.items() if obs}
+
+
+def latest_observations_by_code(
+    client: FHIRClient,
+    patient_ids: Iterable[str],
+    loinc_codes: Iterable[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    code_param: str = "code",
+) -> dict[str, dict[str, dict]]:
+    """Most recent Observation per patient for several LOINCs in one pass.
+
+    Each chunk is a single search with a comma-separated code list, so every
+    patient's observations are fetched once however many codes are wanted.
+    Returns {loinc: {patient_id: Observation}}.
+    """
+    codes = list(dict.fromkeys(loinc_codes))
+    grouped = search_by_patients(client, "Observation", patient_ids, {code_param: ",".join(codes)}, chunk_size)
+    latest = {code: {} for code in codes}
+    for pid, observations in grouped.items():
+        for obs in sorted(observations, key=effective_date, reverse=True):
+            for code in observation_codes(obs) & latest.keys():
+                latest[code].setdefault(pid, obs)
+    return latest
+
+
+def latest_values(
+    client: FHIRClient,
+    patient_ids: Iterable[str],
+    loinc_code: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    code_param: str = "code",
+) -> dict[str, float | None]:
+    """Latest numeric value per patient (None when absent)."""
+    ids = list(dict.fromkeys(patient_ids))
+    latest = latest_observations(client, ids, loinc_code, chunk_size, code_param)
+    return {pid: observation_value(latest[pid], loinc_code) if pid in latest else None for pid in ids}
+
+
+def medications_by_patient(
+    client: FHIRClient,
+    patient_ids: Iterable[str],
+    status: str | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> dict[str, list[dict]]:
+    """MedicationRequests per patient.
+
+    Referenced Medication resources are pulled in the same search with
+    `_include=MedicationRequest:medication` and inlined as
+    `medicationCodeableConcept`, so `medication_name()` works either way.
+    """
+    ids = list(dict.fromkeys(patient_ids))
+    params = {"_include": "MedicationRequest:medication"}
+    if status:
+        params["status"] = status
+
+    grouped, medications = defaultdict(list), {}
+    for resources in search_chunks(client, "MedicationRequest", ids, params, chunk_size):
+        for resource in resources:
+            if resource.get("resourceType") == "Medication":
+                medications[f"Medication/{resource.get('id')}"] = resource
+            else:
+                grouped[patient_id(resource)].append(resource)
+
+    for requests_ in grouped.values():
+        for request in requests_:
+            ref = (request.get("medicationReference") or {}).get("reference")
+            if ref in medications and "medicationCodeableConcept" not in request:
+                request["medicationCodeableConcept"] = medications[ref].get("code", {})
+    return {pid: grouped.get(pid, []) for pid in ids}
+
+
+def medication_name(request: dict) -> str:
+    """Drug name from `medicationCodeableConcept.text` or its first coding display."""
+    concept = request.get("medicationCodeableConcept") or {}
+    if concept.get("text"):
+        return concept["text"]
+    coding = concept.get("coding") or [{}]
+    return coding[0].get("display", "")
+
+
+def medication_code(request: dict, system: str = RXNORM) -> str | None:
+    """Code of the medication in `system` (RxNorm by default), if coded."""
+    concept = request.get("medicationCodeableConcept") or {}
+    for coding in concept.get("coding") or []:
+        if coding.get("system") == system:
+            return coding.get("code")
+    return None
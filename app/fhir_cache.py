@@ -0,0 +1,226 @@
+"""
+Shared cache of FHIR GET responses, revalidated with conditional requests.
+
+Every `FHIRClient` in a process shares one in-memory cache. Optionally, an
+SQLite file under the cache directory backs it, so the workbench, the
+scripts and the analysis code it runs in worker processes reuse each
+other's responses:
+
+    client = FHIRClient(url)                      # uses fhir_cache.shared()
+    client.get("Patient/123")                     # network
+    client.get("Patient/123")                     # memory, no request
+    client.get("metadata", max_age=0)             # conditional GET: 304 if unchanged
+
+A response is fresh for the TTL of its resource type (`TTLS`). Once stale, it
+is revalidated with `If-None-Match` / `If-Modified-Since` when the server sent
+an ETag or Last-Modified. A 304 renews it without a body, and a server without
+validators gets a full re-fetch. The in-memory tier is an LRU bounded by total
+body bytes. The disk tier is bounded the same way and evicts least recently
+stored first.
+
+Configure with CLINICAL_FHIR_CACHE = "memory" (default), "disk" or "off", and
+size it with CLINICAL_FHIR_CACHE_MB (memory and disk each). The disk tier
+stores whole responses, patient data included, in CACHE_DIR/fhir-cache.db,
+so it is opt-in.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from llm_cache import CACHE_DIR
+
+# Seconds a response stays fresh, by resource type (the first path segment).
+# Demographics change rarely, results and prescriptions more often; history
+# and bulk-export endpoints are never cached.
+TTLS = {
+    "metadata": 24 * 3600,
+    "Patient": 3600,
+    "Condition": 600,
+    "Encounter": 600,
+    "Observation": 300,
+    "MedicationRequest": 300,
+    "_history": 0,
+    "$export": 0,
+}
+DEFAULT_TTL = 60
+DEFAULT_MAX_BYTES = int(float(os.environ.get("CLINICAL_FHIR_CACHE_MB", 256)) * 1024 * 1024)
+EVICT_EVERY = 64        # disk writes between size checks
+
+
+@dataclass
+class Entry:
+    body: bytes
+    etag: str | None
+    last_modified: str | None
+    stored: float           # when fetched or last revalidated (epoch seconds)
+
+    @property
+    def validators(self) -> dict[str, str]:
+        """Conditional-request headers for revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """Byte-bounded LRU of response bodies by URL, with an optional SQLite tier."""
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        path: str | Path | None = None,
+        ttls: dict[str, float] = TTLS,
+        default_ttl: float = DEFAULT_TTL,
+    ):
+        self.max_bytes = max_bytes
+        # One huge search result should not flush everything else.
+        self.max_entry_bytes = max_bytes // 8
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.path = Path(path) if path else None
+        self.hits = self.misses = self.revalidated = 0
+        self._entries: OrderedDict[str, Entry] = OrderedDict()
+        self._bytes = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.conn = None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Worker processes share the file: WAL lets them read while one writes.
+            self.conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, size INTEGER, stored REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_stored ON responses (stored)")
+
+    def ttl(self, resource_type: str) -> float:
+        return self.ttls.get(resource_type, self.default_ttl)
+
+    def lookup(self, key: str, resource_type: str, max_age: float | None = None) -> tuple[Entry | None, bool]:
+        """(cached entry or None, whether it can be served without asking the server).
+
+        `max_age` lowers the resource type's TTL (0 = always revalidate). A
+        stale memory entry is re-read from disk in case another process has
+        fetched or revalidated it since.
+        """
+        ttl = self.ttl(resource_type) if max_age is None else min(max_age, self.ttl(resource_type))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now - entry.stored < ttl or self.conn is None:
+                    return entry, now - entry.stored < ttl
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT body, etag, last_modified, stored FROM responses WHERE key = ? AND stored > ?",
+                    (key, entry.stored if entry else 0),
+                ).fetchone()
+                if row is not None:
+                    entry = Entry(bytes(row[0]), row[1], row[2], row[3])
+                    self._remember(key, entry)
+        return entry, entry is not None and now - entry.stored < ttl
+
+    def put(self, key: str, entry: Entry, resource_type: str):
+        """Store a response, unless its type is never cached or it is too large."""
+        if self.ttl(resource_type) <= 0 or len(entry.body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            self._remember(key, entry)
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, entry.body, entry.etag, entry.last_modified, len(entry.body), entry.stored),
+                    )
+                    self._writes += 1
+                    if self._writes % EVICT_EVERY == 0:
+                        self._evict_disk()
+
+    def renew(self, key: str, entry: Entry):
+        """Mark an entry fresh again after a 304 Not Modified."""
+        entry.stored = time.time()
+        with self._lock:
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute("UPDATE responses SET stored = ? WHERE key = ?", (entry.stored, key))
+
+    def _remember(self, key: str, entry: Entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old.body)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+
+    def _evict_disk(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Oldest first, down to 90% so the next few writes do not evict again.
+        while total > self.max_bytes * 0.9:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY stored LIMIT 256").fetchall()
+            if not rows:
+                break
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key, _ in rows])
+            total -= sum(size for _, size in rows)
+
+    def count(self, outcome: str):
+        """Record a lookup outcome: "hit", "revalidated" (304) or "miss"."""
+        with self._lock:
+            if outcome == "hit":
+                self.hits += 1
+            elif outcome == "revalidated":
+                self.revalidated += 1
+            else:
+                self.misses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "revalidated": self.revalidated, "misses": self.misses,
+            }
+            if self.conn is not None:
+                entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+                stats.update(disk_entries=entries, disk_bytes=size)
+        return stats
+
+
+_shared: ResponseCache | None = None
+_shared_lock = threading.Lock()
+_configured = False
+
+
+def shared() -> ResponseCache | None:
+    """The process-wide cache configured by CLINICAL_FHIR_CACHE (None when "off")."""
+    global _shared, _configured
+    with _shared_lock:
+        if not _configured:
+            mode = os.environ.get("CLINICAL_FHIR_CACHE", "memory").lower()
+            if mode == "disk":
+                _shared = ResponseCache(path=CACHE_DIR / "fhir-cache.db")
+            elif mode != "off":
+                _shared = ResponseCache()
+            _configured = True
+        return _shared
@@ -0,0 +1,287 @@
+"""
+Pooled, concurrent FHIR client.
+
+One keep-alive `requests.Session` per base URL, retry with exponential backoff
+on transient failures, transparent `link[relation=next]` paging, and a bounded
+thread pool for fanning out many searches at once.
+
+Used by the workbench, the scripts in `scripts/`, and the analysis code the
+LLM generates (the workbench puts this directory on PYTHONPATH):
+
+    from fhir_client import FHIRClient
+
+    client = FHIRClient("https://r4.smarthealthit.org")
+    for condition in client.search("Condition", {"code": "44054006"}):
+        ...
+
+GETs go through the shared response cache (`fhir_cache.shared()`), so
+repeat reads of the same patient or search skip the network until their
+resource type's TTL passes, and are then revalidated with a conditional GET.
+Pass `cache=False` to always fetch.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+from urllib.parse import parse_qs, urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.models import PreparedRequest
+from urllib3.util.retry import Retry
+
+import fhir_cache
+import telemetry
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_WORKERS = 8
+DEFAULT_PAGE_SIZE = 200
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CACHE_COUNTERS = {"hit": "fhir_cache_hits_total", "revalidated": "fhir_cache_revalidated_total", "miss": "fhir_cache_misses_total"}
+
+
+def next_link(bundle: dict) -> str | None:
+    """Return the `next` paging URL of a searchset Bundle, if any."""
+    for link in bundle.get("link", []):
+        if link.get("relation") == "next":
+            return link.get("url")
+    return None
+
+
+def search_params_applied(bundle: dict) -> set[str]:
+    """Names of the search parameters in a searchset Bundle's `self` link.
+
+    Servers list the parameters they actually applied there, so a lenient
+    server's ignored parameters are missing from it.
+    """
+    for link in bundle.get("link", []):
+        if link.get("relation") == "self":
+            return set(parse_qs(urlsplit(link.get("url", "")).query, keep_blank_values=True))
+    return set()
+
+
+def bundle_resources(bundle: dict) -> list[dict]:
+    """Return the resources in a Bundle (entries without a resource are skipped)."""
+    return [e["resource"] for e in bundle.get("entry", []) if "resource" in e]
+
+
+class FHIRClient:
+    """Thread-safe FHIR REST client for a single base URL."""
+
+    def __init__(
+        self,
+        base_url: str,
+        max_workers: int = DEFAULT_WORKERS,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = DEFAULT_TIMEOUT,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        cache: "fhir_cache.ResponseCache | bool" = True,
+        max_age: float | None = None,
+    ):
+        """`cache` is True for the shared response cache, False for none, or
+        a `ResponseCache`; `max_age` caps how old a cached response may be
+        before it is revalidated (0 = revalidate every read)."""
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.page_size = page_size
+        self.cache = fhir_cache.shared() if cache is True else (cache or None)
+        self.max_age = max_age
+        self._supported: dict[tuple[str, str], bool] = {}
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        # Size the pool to the worker count so concurrent searches never
+        # have to wait for (or discard) a keep-alive connection.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept"] = "application/fhir+json"
+
+    # -- single requests ---------------------------------------------------
+
+    def url(self, path: str) -> str:
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path: str, params: dict | None = None, max_age: float | None = None) -> dict:
+        """GET one resource or Bundle and return the parsed JSON.
+
+        A fresh cached response is returned without a request; a stale one is
+        revalidated. `max_age` overrides the client's for this call. Each call
+        is a `fhir.request` span (with a `cache` attribute: hit, revalidated
+        or miss) and updates the `fhir_*` counters.
+        """
+        url = self.url(path)
+        rtype = self._resource_type(url)
+        key, entry, fresh = None, None, False
+        if self.cache is not None:
+            prepared = PreparedRequest()
+            prepared.prepare_url(url, params)
+            key = prepared.url
+            entry, fresh = self.cache.lookup(key, rtype, self.max_age if max_age is None else max_age)
+        with telemetry.span("fhir.request", resource=rtype) as attrs:
+            t0 = t1 = time.perf_counter()
+            received = 0
+            if fresh:
+                outcome, body = "hit", entry.body
+            else:
+                try:
+                    r = self.session.get(url, params=params, headers=entry.validators if entry else None, timeout=self.timeout)
+                    r.raise_for_status()
+                except requests.RequestException:
+                    telemetry.count("fhir_errors_total", endpoint=self.base_url)
+                    raise
+                t1 = time.perf_counter()
+                received = len(r.content)
+                if r.status_code == 304 and entry is not None:
+                    outcome, body = "revalidated", entry.body
+                    self.cache.renew(key, entry)
+                else:
+                    outcome, body = "miss", r.content
+                    if key is not None and "no-store" not in r.headers.get("Cache-Control", ""):
+                        self.cache.put(key, fhir_cache.Entry(
+                            body, r.headers.get("ETag"), r.headers.get("Last-Modified"), time.time(),
+                        ), rtype)
+            data = json.loads(body)
+            t2 = time.perf_counter()
+            attrs.update(status=200 if fresh else r.status_code, bytes=received, parse_ms=round((t2 - t1) * 1000, 2))
+            if key is not None:
+                attrs["cache"] = outcome
+        if key is not None:
+            self.cache.count(outcome)
+            telemetry.count(CACHE_COUNTERS[outcome], endpoint=self.base_url)
+        if not fresh:
+            telemetry.count("fhir_requests_total", endpoint=self.base_url)
+            telemetry.count("fhir_bytes_total", received, endpoint=self.base_url)
+            telemetry.count("fhir_request_seconds_total", t1 - t0, endpoint=self.base_url)
+        telemetry.count("fhir_parse_seconds_total", t2 - t1, endpoint=self.base_url)
+        return data
+
+    def _resource_type(self, url: str) -> str:
+        """The cache TTL key for `url`: its resource type, or the `_history` /
+        `$export` operation anywhere in the path (never cached for long)."""
+        segments = urlsplit(url).path[len(urlsplit(self.base_url).path):].strip("/").split("/")
+        for segment in segments:
+            for operation in ("_history", "$export"):
+                if segment.startswith(operation):
+                    return operation
+        return segments[0]
+
+    # -- paged searches ----------------------------------------------------
+
+    def pages(self, path: str, params: dict | None = None, max_pages: int | None = None) -> Iterator[dict]:
+        """Yield every Bundle page of a search, following `next` links."""
+        params = dict(params or {})
+        if "_count" not in path:
+            params.setdefault("_count", self.page_size)
+
+        url, seen, count = self.url(path), set(), 0
+        while url and url not in seen:
+            seen.add(url)
+            bundle = self.get(url, params)
+            telemetry.count("fhir_pages_total", endpoint=self.base_url)
+            yield bundle
+            count += 1
+            if max_pages is not None and count >= max_pages:
+                return
+            link = next_link(bundle)
+            # The next link already carries the full query string.
+            url, params = (urljoin(url, link) if link else None), None
+
+    def search(self, path: str, params: dict | None = None, limit: int | None = None) -> Iterator[dict]:
+        """Yield resources across all pages of a search.
+
+        `path` is a resource type ("Observation") or a relative query
+        ("Observation?patient=123"); `limit` caps the number of resources.
+        """
+        yielded = 0
+        for bundle in self.pages(path, params):
+            for resource in bundle_resources(bundle):
+                yield resource
+                yielded += 1
+                if limit is not None and yielded >= limit:
+                    return
+
+    def search_all(self, path: str, params: dict | None = None, limit: int | None = None) -> list[dict]:
+        return list(self.search(path, params, limit))
+
+    def bundle(self, path: str, params: dict | None = None, max_pages: int | None = None) -> dict:
+        """Fetch the pages of a search and merge them into one searchset Bundle."""
+        entries, first = [], None
+        for page in self.pages(path, params, max_pages):
+            first = first or page
+            entries.extend(page.get("entry", []))
+        merged = {k: v for k, v in (first or {}).items() if k not in ("entry", "link")}
+        merged.update({"resourceType": "Bundle", "type": "searchset", "total": len(entries), "entry": entries})
+        return merged
+
+    def supports(self, resource_type: str, param: str, value: str) -> bool:
+        """Whether the server applies search parameter `param` to `resource_type`.
+
+        Servers may ignore parameters they do not know and answer anyway, so a
+        one-result probe search (`param=value`) checks that `param` is echoed
+        in the Bundle's self link. Answers are remembered per client; an
+        error or non-JSON response means no, and an unreachable server counts
+        as not supporting it and is asked again.
+        """
+        key = (resource_type, param)
+        if key not in self._supported:
+            try:
+                bundle = self.get(resource_type, {param: value, "_count": 1, "_elements": "id"})
+            except (requests.HTTPError, ValueError):
+                self._supported[key] = False
+            except requests.RequestException:
+                return False
+            else:
+                self._supported[key] = param in search_params_applied(bundle)
+        return self._supported[key]
+
+    # -- concurrency -------------------------------------------------------
+
+    def map(self, fn: Callable, items: Iterable) -> list:
+        """Apply `fn` to each item on the client's thread pool, preserving order."""
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            return list(pool.map(telemetry.bind(fn), items))
+
+    def search_many(self, queries: Iterable[tuple[str, dict | None]]) -> list[list[dict]]:
+        """Run several searches concurrently; returns one resource list per query."""
+        return self.map(lambda q: self.search_all(*q), queries)
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_clients: dict[str, FHIRClient] = {}
+_clients_lock = threading.Lock()
+
+
+def client_for(base_url: str) -> FHIRClient:
+    """Return the process-wide shared client for `base_url`."""
+    key = base_url.rstrip("/")
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = FHIRClient(key)
+        return _clients[key]
@@ -0,0 +1,302 @@
+"""
+Federated search across several FHIR servers.
+
+EHR, lab and pharmacy data often live on separate FHIR servers. A
+`FederatedClient` sends each search to every endpoint concurrently, so a
+cross-system query costs as much as the slowest server rather than the sum,
+then merges the results:
+
+- Patient records that share an identifier (`system|value`) are linked to
+  one federated patient ID, and references in other resources are rewritten
+  to it.
+- `patient=` / `subject=` search parameters are translated back to each
+  server's local IDs (looking patients up by identifier when a server has not
+  been seen yet), so the `fhir_batch` helpers work unchanged.
+- Resources present on more than one server are de-duplicated.
+
+    from fhir_federated import FederatedClient
+    from fhir_batch import cohort_patient_ids, latest_values
+
+    fed = FederatedClient({"EHR": ehr_url, "Lab": lab_url, "Pharmacy": rx_url})
+    ids = cohort_patient_ids(fed, "44054006")
+    a1c = latest_values(fed, ids, "4548-4")
+    fed.stats    # {"EHR": {"ok": True, "latency_ms": 212.4, "calls": 3, ...}, ...}
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+import requests
+
+import telemetry
+from fhir_client import DEFAULT_WORKERS, FHIRClient, client_for
+
+IDENTIFIER_CHUNK = 50
+# Endpoints failing this many searches in a row are skipped for the rest of
+# the client's life, so one dead server does not add its timeout to every call.
+MAX_CONSECUTIVE_FAILURES = 2
+PATIENT_PARAMS = ("patient", "subject")
+
+
+def identifier_tokens(resource: dict) -> list[str]:
+    """`system|value` tokens for a resource's identifiers."""
+    return [f"{i.get('system', '')}|{i['value']}" for i in resource.get("identifier", []) if i.get("value")]
+
+
+class PatientIndex:
+    """Links endpoint-local Patient IDs that share an identifier to one federated ID.
+
+    Union-find over record nodes ("endpoint/local id") and identifier nodes.
+    A linked group keeps the federated ID of its earliest record, so IDs
+    handed out earlier stay valid after groups merge.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._parent: dict[str, str] = {}
+        self._seq: dict[str, int] = {}
+        self._fid: dict[str, str] = {}           # record node -> federated ID
+        self._node_of: dict[str, str] = {}       # federated ID -> record node
+        self._members: dict[str, list[str]] = {}  # root -> record nodes
+        self._tokens: dict[str, set[str]] = {}    # root -> identifier tokens
+
+    def _node(self, node: str, local_id: str | None = None) -> str:
+        if node not in self._parent:
+            self._parent[node] = node
+            self._seq[node] = len(self._seq)
+            self._members[node] = []
+            self._tokens[node] = set()
+            if local_id is not None:
+                fid = local_id if local_id not in self._node_of else f"{node[:-len(local_id) - 1]}-{local_id}"
+                self._fid[node], self._node_of[fid] = fid, node
+                self._members[node].append(node)
+            else:
+                self._tokens[node].add(node[len("id:"):])
+        return node
+
+    def _find(self, node: str) -> str:
+        while self._parent[node] != node:
+            self._parent[node] = self._parent[self._parent[node]]
+            node = self._parent[node]
+        return node
+
+    def _union(self, a: str, b: str):
+        ra, rb = self._find(a), self._find(b)
+        if ra == rb:
+            return
+        # Prefer a record root, then the oldest, so the group's ID is stable.
+        if (ra not in self._fid, self._seq[ra]) > (rb not in self._fid, self._seq[rb]):
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        self._members[ra].extend(self._members.pop(rb))
+        self._tokens[ra] |= self._tokens.pop(rb)
+
+    def add(self, endpoint: str, patient: dict) -> str:
+        """Register a Patient seen on `endpoint`; returns its federated ID."""
+        with self._lock:
+            node = self._node(f"{endpoint}/{patient['id']}", patient["id"])
+            for token in identifier_tokens(patient):
+                self._union(node, self._node(f"id:{token}"))
+            return self._fid[self._find(node)]
+
+    def federated_id(self, endpoint: str, local_id: str) -> str:
+        """Federated ID for a local patient reference (registered if new)."""
+        with self._lock:
+            node = self._node(f"{endpoint}/{local_id}", local_id)
+            return self._fid[self._find(node)]
+
+    def local_ids(self, federated_id: str, endpoint: str) -> list[str]:
+        """Local IDs on `endpoint` linked to a federated ID (a raw local ID maps to itself)."""
+        with self._lock:
+            node = self._node_of.get(federated_id)
+            if node is None:
+                return [federated_id]
+            prefix = f"{endpoint}/"
+            return [m[len(prefix):] for m in self._members[self._find(node)] if m.startswith(prefix)]
+
+    def tokens(self, federated_id: str) -> set[str]:
+        with self._lock:
+            node = self._node_of.get(federated_id)
+            return set(self._tokens[self._find(node)]) if node else set()
+
+
+class FederatedClient:
+    """Fans searches out to several FHIR endpoints and merges the results.
+
+    Implements the search methods of `FHIRClient` (`search`, `search_all`,
+    `search_many`, `supports`, `map`), so it can be passed anywhere a client is expected.
+    """
+
+    def __init__(self, endpoints: dict[str, str] | Iterable[tuple[str, str]], max_workers: int = DEFAULT_WORKERS):
+        items = endpoints.items() if isinstance(endpoints, dict) else endpoints
+        self.endpoints: dict[str, FHIRClient] = {name: client_for(url) for name, url in items if url}
+        if not self.endpoints:
+            raise ValueError("no FHIR endpoints configured")
+        self.max_workers = max_workers
+        self.index = PatientIndex()
+        self.stats = {
+            name: {"url": client.base_url, "ok": None, "calls": 0, "failures": 0,
+                   "resources": 0, "latency_ms": None, "error": None, "streak": 0}
+            for name, client in self.endpoints.items()
+        }
+        self._stats_lock = threading.Lock()
+        self._resolved: set[tuple[str, str]] = set()
+        self._resolve_lock = threading.Lock()
+
+    # -- search ------------------------------------------------------------
+
+    def search_all(self, path: str, params: dict | None = None, limit: int | None = None) -> list[dict]:
+        """Run one search on every endpoint concurrently and merge the results.
+
+        Endpoints that fail are recorded in `stats` and skipped; the error is
+        raised only when every endpoint fails.
+        """
+        def one(name: str) -> list[dict]:
+            local = self._localize(name, params)
+            if local is None:
+                return []
+            return self.endpoints[name].search_all(path, local, limit)
+
+        results = self._fanout(one)
+        merged = self._merge(results)
+        return merged[:limit] if limit else merged
+
+    def search(self, path: str, params: dict | None = None, limit: int | None = None) -> Iterator[dict]:
+        yield from self.search_all(path, params, limit)
+
+    def search_many(self, queries: Iterable[tuple[str, dict | None]]) -> list[list[dict]]:
+        return self.map(lambda q: self.search_all(*q), queries)
+
+    def supports(self, resource_type: str, param: str, value: str) -> bool:
+        """Whether every endpoint applies search parameter `param` (see `FHIRClient.supports`)."""
+        return all(self.map(lambda client: client.supports(resource_type, param, value), self.endpoints.values()))
+
+    def map(self, fn: Callable, items: Iterable) -> list:
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            return list(pool.map(telemetry.bind(fn), items))
+
+    # -- internals ---------------------------------------------------------
+
+    def _fanout(self, fn: Callable[[str], list[dict]]) -> list[tuple[str, list[dict]]]:
+        def timed(name: str):
+            t0 = time.perf_counter()
+            try:
+                resources, error = fn(name), None
+            except (requests.RequestException, ValueError) as e:  # ValueError: a 200 that is not JSON
+                resources, error = e, e
+            self._record(name, (time.perf_counter() - t0) * 1000, resources, error)
+            return name, resources
+
+        with self._stats_lock:
+            live = [n for n in self.endpoints if self.stats[n]["streak"] < MAX_CONSECUTIVE_FAILURES]
+        if not live:
+            raise requests.ConnectionError("every FHIR endpoint is failing: " + "; ".join(
+                f"{n}: {s['error']}" for n, s in self.stats.items()))
+        with ThreadPoolExecutor(max_workers=len(live)) as pool:
+            outcomes = list(pool.map(telemetry.bind(timed), live))
+        failed = [r for _, r in outcomes if isinstance(r, Exception)]
+        if len(failed) == len(outcomes):
+            raise failed[0]
+        return [(name, r) for name, r in outcomes if not isinstance(r, Exception)]
+
+    def _record(self, name: str, latency_ms: float, resources, error: Exception | None):
+        with self._stats_lock:
+            s = self.stats[name]
+            s["calls"] += 1
+            s["latency_ms"] = latency_ms if s["latency_ms"] is None else max(s["latency_ms"], latency_ms)
+            if error is None:
+                s["resources"] += len(resources)
+                s["ok"] = s["ok"] is not False
+                s["streak"] = 0
+            else:
+                s["failures"] += 1
+                s["streak"] += 1
+                s["ok"], s["error"] = False, str(error)[:200]
+
+    def reset_stats(self):
+        with self._stats_lock:
+            for s in self.stats.values():
+                s.update(ok=None, calls=0, failures=0, resources=0, latency_ms=None, error=None, streak=0)
+
+    def _localize(self, name: str, params: dict | None) -> dict | None:
+        """Translate federated patient IDs in `params` to `name`'s local IDs.
+
+        Returns None when none of the requested patients exist on that server.
+        """
+        params = dict(params or {})
+        for key in PATIENT_PARAMS:
+            if key not in params:
+                continue
+            fids = [v.split("/")[-1] for v in str(params[key]).split(",") if v]
+            self._resolve(name, fids)
+            local = [lid for fid in fids for lid in self.index.local_ids(fid, name)]
+            if not local:
+                return None
+            params[key] = ",".join(dict.fromkeys(local))
+        return params
+
+    def _resolve(self, name: str, fids: list[str]):
+        """Look up, by identifier, patients not yet seen on endpoint `name`."""
+        tokens = []
+        with self._resolve_lock:
+            for fid in fids:
+                if (name, fid) in self._resolved or self.index.local_ids(fid, name):
+                    continue
+                self._resolved.add((name, fid))
+                tokens.extend(self.index.tokens(fid))
+        client = self.endpoints[name]
+        for i in range(0, len(tokens), IDENTIFIER_CHUNK):
+            chunk = tokens[i:i + IDENTIFIER_CHUNK]
+            for patient in client.search("Patient", {"identifier": ",".join(chunk), "_elements": "id,identifier"}):
+                self.index.add(name, patient)
+
+    def _merge(self, results: list[tuple[str, list[dict]]]) -> list[dict]:
+        merged: dict[str, dict] = {}
+        for name, resources in results:
+            url = self.endpoints[name].base_url
+            for resource in resources:
+                resource = self._federate(name, url, resource)
+                key = self._dedupe_key(name, resource)
+                if key not in merged:
+                    merged[key] = resource
+                elif resource.get("resourceType") == "Patient":
+                    kept = merged[key]
+                    seen = set(identifier_tokens(kept))
+                    extra = [i for i in resource.get("identifier", []) if f"{i.get('system', '')}|{i.get('value')}" not in seen]
+                    kept["identifier"] = kept.get("identifier", []) + extra
+        return list(merged.values())
+
+    def _federate(self, name: str, url: str, resource: dict) -> dict:
+        """Copy of `resource` with federated patient IDs and `meta.source` set."""
+        resource = dict(resource)
+        resource["meta"] = {"source": url, **resource.get("meta", {})}
+        if resource.get("resourceType") == "Patient" and "id" in resource:
+            resource["id"] = self.index.add(name, resource)
+            return resource
+        for field in PATIENT_PARAMS:
+            ref = (resource.get(field) or {}).get("reference", "")
+            if ref.startswith("Patient/") or (ref and "/" not in ref):
+                fid = self.index.federated_id(name, ref.split("/")[-1])
+                resource[field] = {**resource[field], "reference": f"Patient/{fid}"}
+        return resource
+
+    @staticmethod
+    def _dedupe_key(name: str, resource: dict) -> str:
+        rtype = resource.get("resourceType")
+        if rtype == "Patient":
+            return f"Patient/{resource.get('id')}"
+        tokens = identifier_tokens(resource)
+        if tokens:
+            return f"{rtype}|{tokens[0]}"
+        subject = (resource.get("subject") or resource.get("patient") or {}).get("reference")
+        if subject and ("code" in resource or "medicationCodeableConcept" in resource):
+            fields = ("code", "medicationCodeableConcept", "effectiveDateTime", "authoredOn", "onsetDateTime",
+                      "valueQuantity", "valueCodeableConcept", "component", "status")
+            return json.dumps([rtype, subject] + [resource.get(f) for f in fields], sort_keys=True)
+        return f"{name}|{rtype}/{resource.get('id')}"
@@ -0,0 +1,361 @@
+"""
+Typed columnar frames of FHIR resources.
+
+Each function turns Patient, Condition, Observation, MedicationRequest or
+Encounter resources into a pandas DataFrame in a single pass. Input can be a
+Bundle, a list of Bundles or resources, or a generator. Columns follow
+`SCHEMAS`:
+- codes, units, statuses and patient references are categoricals;
+- dates are datetime64 (UTC for date-times);
+- values are float arrays.
+
+A frame takes a small fraction of the memory of the resource dicts it came
+from, and filters, joins and groupbys on it are vectorized:
+
+    import fhir_frames
+
+    obs = fhir_frames.search(client, "Observation", {"patient": pid, "category": "laboratory"})
+    obs[obs["code"] == "4548-4"].sort_values("effective")
+
+    ids = fhir_batch.cohort_patient_ids(client, "44054006")
+    labs = fhir_frames.search_patients(client, "Observation", ids, {"code": "4548-4"})
+    latest = labs.sort_values("effective").groupby("patient_id").last()
+
+    frames = fhir_frames.frames(bundle)        # {"Patient": ..., "Observation": ..., ...}
+
+With a `FHIRClient`, `search` and `search_patients` flatten each page as it
+arrives, so at most a page of dicts per concurrent search is held at once.
+(A `FederatedClient` merges each search across endpoints first.) Panels
+such as blood pressure (55284-4) give one Observation row per component
+(8480-6, 8462-4), with `panel` set to the panel's code. Unlike the clinical
+store, there is no row for the panel itself.
+"""
+
+from functools import lru_cache
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import fhir_batch
+from fhir_client import FHIRClient
+
+ROW_CHUNK = 8192        # rows buffered as tuples before moving into the column lists
+# The dtype pandas infers for text: "str" on pandas 3, object (None for missing) before.
+STR_DTYPE = pd.Index([""]).dtype
+
+# Column -> (dtype, source) per resource type. dtypes: "str" (one value per
+# row, e.g. ids), "category", "float", "datetime" (UTC) and "date" (no time
+# or zone). Sources are FHIR element paths; [0] = the first repetition,
+# coding = its first coding.
+SCHEMAS: dict[str, dict[str, tuple[str, str]]] = {
+    "Patient": {
+        "id": ("str", "id"),
+        "family": ("str", "name[0].family"),
+        "given": ("str", "name[0].given, space-separated"),
+        "gender": ("category", "gender"),
+        "birth_date": ("date", "birthDate"),
+        "deceased": ("datetime", "deceasedDateTime"),
+        "state": ("category", "address[0].state"),
+        "postal_code": ("category", "address[0].postalCode"),
+    },
+    "Condition": {
+        "id": ("str", "id"),
+        "patient_id": ("category", "subject.reference"),
+        "encounter_id": ("category", "encounter.reference"),
+        "code": ("category", "code.coding.code (SNOMED CT in Synthea data)"),
+        "system": ("category", "code.coding.system"),
+        "display": ("category", "code.coding.display"),
+        "clinical_status": ("category", "clinicalStatus.coding.code"),
+        "verification_status": ("category", "verificationStatus.coding.code"),
+        "category": ("category", "category[0].coding.code"),
+        "onset": ("datetime", "onsetDateTime | onsetPeriod.start"),
+        "abatement": ("datetime", "abatementDateTime | abatementPeriod.start"),
+        "recorded": ("datetime", "recordedDate"),
+    },
+    "Observation": {
+        "id": ("str", "id"),
+        "patient_id": ("category", "subject.reference"),
+        "encounter_id": ("category", "encounter.reference"),
+        "status": ("category", "status"),
+        "category": ("category", "category[0].coding.code (laboratory, vital-signs, ...)"),
+        "panel": ("category", "code.coding.code of the panel, on component rows"),
+        "code": ("category", "code.coding.code (LOINC), or component.code"),
+        "system": ("category", "code.coding.system"),
+        "display": ("category", "code.coding.display"),
+        "value": ("float", "valueQuantity.value"),
+        "unit": ("category", "valueQuantity.unit"),
+        "value_text": ("category", "valueCodeableConcept text or coding.display | valueString"),
+        "effective": ("datetime", "effectiveDateTime | effectivePeriod.start | issued"),
+    },
+    "MedicationRequest": {
+        "id": ("str", "id"),
+        "patient_id": ("category", "subject.reference"),
+        "encounter_id": ("category", "encounter.reference"),
+        "status": ("category", "status"),
+        "intent": ("category", "intent"),
+        "rxnorm": ("category", "medicationCodeableConcept.coding.code where system is RxNorm"),
+        "name": ("category", "medicationCodeableConcept.text | coding.display"),
+        "dosage": ("category", "dosageInstruction[0].text"),
+        "authored": ("datetime", "authoredOn"),
+    },
+    "Encounter": {
+        "id": ("str", "id"),
+        "patient_id": ("category", "subject.reference"),
+        "status": ("category", "status"),
+        "class": ("category", "class.code (AMB, EMER, IMP, ...)"),
+        "type_code": ("category", "type[0].coding.code"),
+        "type": ("category", "type[0].text | coding.display"),
+        "reason_code": ("category", "reasonCode[0].coding.code"),
+        "start": ("datetime", "period.start"),
+        "end": ("datetime", "period.end"),
+    },
+}
+
+
+# ---------------------------------------------------------------------------
+# Row extraction: a tuple per row, in SCHEMAS column order
+# ---------------------------------------------------------------------------
+
+_EMPTY: dict = {}
+_NONE = (_EMPTY,)
+
+
+@lru_cache(maxsize=1 << 16)
+def _ref_id(ref: str) -> str:
+    # Cached: a cohort's references repeat, and every row then shares one string.
+    return ref.rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+
+
+def _ref(reference: dict | None) -> str | None:
+    """Id from a "Patient/123" or "urn:uuid:123" reference."""
+    ref = reference.get("reference") if reference else None
+    return _ref_id(ref) if ref else None
+
+
+def _coding(concept: dict | None) -> dict:
+    return (concept.get("coding") or _NONE)[0] if concept else _EMPTY
+
+
+def _text(concept: dict | None) -> str | None:
+    if not concept:
+        return None
+    return concept.get("text") or _coding(concept).get("display")
+
+
+def _first(items: list | None) -> dict:
+    return (items or _NONE)[0]
+
+
+def _patient(r: dict) -> Iterator[tuple]:
+    name, address = _first(r.get("name")), _first(r.get("address"))
+    yield (
+        r.get("id"), name.get("family"), " ".join(name.get("given") or []) or None, r.get("gender"),
+        r.get("birthDate"), r.get("deceasedDateTime"), address.get("state"), address.get("postalCode"),
+    )
+
+
+def _condition(r: dict) -> Iterator[tuple]:
+    coding = _coding(r.get("code"))
+    yield (
+        r.get("id"), _ref(r.get("subject") or r.get("patient")), _ref(r.get("encounter")),
+        coding.get("code"), coding.get("system"), coding.get("display"),
+        _coding(r.get("clinicalStatus")).get("code"), _coding(r.get("verificationStatus")).get("code"),
+        _coding(_first(r.get("category"))).get("code"),
+        r.get("onsetDateTime") or (r.get("onsetPeriod") or {}).get("start"),
+        r.get("abatementDateTime") or (r.get("abatementPeriod") or {}).get("start"),
+        r.get("recordedDate"),
+    )
+
+
+def _observation(r: dict) -> Iterator[tuple]:
+    # The hot path for large searches, so lookups are inlined.
+    get = r.get
+    rid, pid, encounter, status = get("id"), _ref(get("subject") or get("patient")), _ref(get("encounter")), get("status")
+    category = get("category")
+    category = _coding(category[0]).get("code") if category else None
+    effective = get("effectiveDateTime") or (get("effectivePeriod") or _EMPTY).get("start") or get("issued")
+    components = get("component")
+    panel = _coding(get("code")).get("code") if components else None
+    for part in components or (r,):
+        coding, quantity = _coding(part.get("code")), part.get("valueQuantity") or _EMPTY
+        text = _text(part.get("valueCodeableConcept")) or part.get("valueString")
+        yield (
+            rid, pid, encounter, status, category, panel, coding.get("code"), coding.get("system"),
+            coding.get("display"), quantity.get("value"), quantity.get("unit"), text, effective,
+        )
+
+
+def _medication_request(r: dict) -> Iterator[tuple]:
+    yield (
+        r.get("id"), _ref(r.get("subject") or r.get("patient")), _ref(r.get("encounter")),
+        r.get("status"), r.get("intent"), fhir_batch.medication_code(r), fhir_batch.medication_name(r) or None,
+        _first(r.get("dosageInstruction")).get("text"), r.get("authoredOn"),
+    )
+
+
+def _encounter(r: dict) -> Iterator[tuple]:
+    encounter_type, period = _first(r.get("type")), r.get("period") or {}
+    yield (
+        r.get("id"), _ref(r.get("subject") or r.get("patient")), r.get("status"),
+        (r.get("class") or {}).get("code"), _coding(encounter_type).get("code"), _text(encounter_type),
+        _coding(_first(r.get("reasonCode"))).get("code"), period.get("start"), period.get("end"),
+    )
+
+
+_ROWS = {
+    "Patient": _patient,
+    "Condition": _condition,
+    "Observation": _observation,
+    "MedicationRequest": _medication_request,
+    "Encounter": _encounter,
+}
+
+
+# ---------------------------------------------------------------------------
+# Typed frames
+# ---------------------------------------------------------------------------
+
+def _resources(data) -> Iterator[dict]:
+    """Resources from a Bundle, or an iterable of resources and Bundles."""
+    for item in [data] if isinstance(data, dict) else data:
+        if item.get("resourceType") == "Bundle":
+            for entry in item.get("entry") or []:
+                if "resource" in entry:
+                    yield entry["resource"]
+        else:
+            yield item
+
+
+def _dates(values: list, utc: bool):
+    # Parse each distinct string once: components and encounters repeat timestamps.
+    codes, uniques = pd.factorize(np.array(values, dtype=object))
+    parsed = pd.DatetimeIndex(pd.to_datetime(uniques, utc=utc, format="ISO8601", errors="coerce")).as_unit("us")
+    return parsed.take(codes, allow_fill=True, fill_value=pd.NaT)
+
+
+def _column(values: list, dtype: str):
+    if dtype == "category":
+        # String categories even when every value is missing, so frames concatenate cleanly.
+        codes, uniques = pd.factorize(np.array(values, dtype=object))
+        return pd.Categorical.from_codes(codes, pd.Index(uniques, dtype=STR_DTYPE))
+    if dtype == "float":
+        return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").astype(float).to_numpy()
+    if dtype in ("datetime", "date"):
+        return _dates(values, utc=dtype == "datetime")
+    return pd.array(values, dtype=STR_DTYPE)
+
+
+class _Columns:
+    """Column lists of one resource type.
+
+    Rows are moved into the column lists every `ROW_CHUNK` rows. Keeping a
+    tuple per row alive would make the garbage collector rescan every row as
+    the frame grows.
+    """
+
+    def __init__(self, resource_type: str):
+        self.resource_type = resource_type
+        self.rows_of = _ROWS[resource_type]
+        self.columns = [[] for _ in SCHEMAS[resource_type]]
+        self._rows: list[tuple] = []
+
+    def add(self, resource: dict):
+        self._rows.extend(self.rows_of(resource))
+        if len(self._rows) >= ROW_CHUNK:
+            self._flush()
+
+    def _flush(self):
+        for column, values in zip(self.columns, zip(*self._rows)):
+            column.extend(values)
+        self._rows.clear()
+
+    def frame(self) -> pd.DataFrame:
+        self._flush()
+        schema = SCHEMAS[self.resource_type]
+        return pd.DataFrame({
+            name: _column(values, dtype) for (name, (dtype, _)), values in zip(schema.items(), self.columns)
+        })
+
+
+def _concat(resource_type: str, parts: list[pd.DataFrame]) -> pd.DataFrame:
+    """Frames of one resource type, stacked; categoricals take the union of their categories."""
+    if len(parts) == 1:
+        return parts[0]
+    return pd.DataFrame({
+        name: union_categoricals([part[name] for part in parts]) if dtype == "category"
+        else pd.concat([part[name] for part in parts], ignore_index=True)
+        for name, (dtype, _) in SCHEMAS[resource_type].items()
+    })
+
+
+def frame(resource_type: str, data) -> pd.DataFrame:
+    """The `resource_type` resources in `data` as a frame with the columns of `SCHEMAS[resource_type]`."""
+    columns = _Columns(resource_type)
+    for resource in _resources(data):
+        if resource.get("resourceType") == resource_type:
+            columns.add(resource)
+    return columns.frame()
+
+
+def frames(data) -> dict[str, pd.DataFrame]:
+    """One frame per supported resource type present in `data`, from a single pass."""
+    by_type: dict[str, _Columns] = {}
+    for resource in _resources(data):
+        resource_type = resource.get("resourceType")
+        if resource_type in _ROWS:
+            if resource_type not in by_type:
+                by_type[resource_type] = _Columns(resource_type)
+            by_type[resource_type].add(resource)
+    return {resource_type: columns.frame() for resource_type, columns in by_type.items()}
+
+
+def patients(data) -> pd.DataFrame:
+    return frame("Patient", data)
+
+
+def conditions(data) -> pd.DataFrame:
+    return frame("Condition", data)
+
+
+def observations(data) -> pd.DataFrame:
+    return frame("Observation", data)
+
+
+def medication_requests(data) -> pd.DataFrame:
+    return frame("MedicationRequest", data)
+
+
+def encounters(data) -> pd.DataFrame:
+    return frame("Encounter", data)
+
+
+# ---------------------------------------------------------------------------
+# Searches straight into frames
+# ---------------------------------------------------------------------------
+
+def search(client: FHIRClient, resource_type: str, params: dict | None = None) -> pd.DataFrame:
+    """Every page of `resource_type?params` as one frame, flattened page by page."""
+    return frame(resource_type, client.search(resource_type, params))
+
+
+def search_patients(
+    client: FHIRClient,
+    resource_type: str,
+    patient_ids: Iterable[str],
+    params: dict | None = None,
+    chunk_size: int = fhir_batch.DEFAULT_CHUNK_SIZE,
+) -> pd.DataFrame:
+    """A cohort's resources as one frame, from chunked `patient=` searches like `fhir_batch`'s.
+
+    The chunks are searched concurrently. Each is flattened page by page
+    into a frame of its own, and the frames are stacked in chunk order.
+    """
+    queries = [
+        {**(params or {}), "patient": ",".join(chunk)}
+        for chunk in fhir_batch.chunked(list(dict.fromkeys(patient_ids)), chunk_size)
+    ]
+    if not queries:
+        return frame(resource_type, [])
+    return _concat(resource_type, client.map(lambda query: search(client, resource_type, query), queries))
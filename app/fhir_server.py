@@ -0,0 +1,499 @@
+"""
+Local FHIR stand-in server backed by cached data.
+
+Loads `fallback-data/` (Bundles and bulk NDJSON) or a clinical store into
+in-memory indexes and answers FHIR searches over HTTP, so the workbench,
+the scripts and generated analysis code run unchanged and deterministically
+with no network -- and there is a fast, local load-test target:
+
+    python app/fhir_server.py fallback-data/ --port 8080
+    curl 'http://localhost:8080/Observation?patient=X&code=4548-4&_sort=-date&_count=1'
+
+Supported: `GET /metadata`, `GET /<Type>/<id>` and searches with `_id`,
+`patient`/`subject`, `code`, `combo-code`, `identifier`, `status`,
+`clinical-status`, `date`, `_lastUpdated`, `_has:Condition:patient:code`,
+`_elements`, `_include=MedicationRequest:medication`, `_sort`, `_count` and
+`next`/`previous` paging links. Unknown parameters are ignored, as lenient
+FHIR servers do. Bulk Data `$export` (system or `Patient/` level, with
+`_type` and `_since`) answers with the spec's kick-off / status / NDJSON
+file flow, so `bulk_export` runs against it:
+
+    bulk_export.export(FHIRClient("http://localhost:8080"), "/tmp/bulk", types=["Patient"])
+
+Resources are serialized once at load time and bundles are assembled from
+those bytes, so a search costs an index lookup and a join. Responses carry
+an ETag of their content, and a matching `If-None-Match` gets a bodiless 304,
+so revalidating a cached response costs a round trip but no transfer.
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from clinical_store import ClinicalStore, read_resources
+
+DEFAULT_DATA = Path(__file__).resolve().parent.parent / "fallback-data"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+QUERY_CACHE_SIZE = 4096
+FHIR_JSON = "application/fhir+json"
+NDJSON = "application/fhir+ndjson"
+EXPORT_POLLS = 1        # status requests answered "in progress" before an export is ready
+
+SEARCH_PARAMS = [
+    "_id", "patient", "subject", "code", "combo-code", "identifier", "status", "clinical-status",
+    "date", "_lastUpdated", "_has:Condition:patient:code", "_elements", "_include", "_sort", "_count",
+]
+
+
+def _instant(ts: str | None) -> str:
+    """UTC ISO string for date comparisons and sorting ('' when absent)."""
+    if not ts:
+        return ""
+    try:
+        dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    except ValueError:
+        return ts
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _clinical_date(resource: dict) -> str:
+    period = resource.get("effectivePeriod") or resource.get("period") or {}
+    return _instant(
+        resource.get("effectiveDateTime") or period.get("start") or resource.get("issued")
+        or resource.get("authoredOn") or resource.get("onsetDateTime") or resource.get("recordedDate")
+    )
+
+
+def _codes(concept: dict | None) -> list[str]:
+    return [c["code"] for c in (concept or {}).get("coding", []) if c.get("code")]
+
+
+def _patient_id(resource: dict) -> str | None:
+    if resource.get("resourceType") == "Patient":
+        return resource.get("id")
+    ref = (resource.get("subject") or resource.get("patient") or {}).get("reference", "")
+    return ref.split("/")[-1] or None
+
+
+def _compare(actual: str, expr: str) -> bool:
+    """FHIR date prefix comparison (eq, ne, gt, ge, lt, le) on ISO strings."""
+    prefix, value = (expr[:2], expr[2:]) if expr[:2] in ("eq", "ne", "gt", "ge", "lt", "le") else ("eq", expr)
+    if not actual:
+        return False
+    value = _instant(value) if len(value) > 10 else value
+    head = actual[:len(value)]
+    return {
+        "eq": head == value, "ne": head != value,
+        "gt": head > value, "ge": head >= value,
+        "lt": head < value, "le": head <= value,
+    }[prefix]
+
+
+class ResourceIndex:
+    """In-memory FHIR resources with per-type search indexes."""
+
+    def __init__(self):
+        self.resources: dict[str, dict[str, dict]] = defaultdict(dict)
+        self.raw: dict[str, dict[str, bytes]] = defaultdict(dict)
+        self.by_patient: dict[str, dict[str, set]] = defaultdict(lambda: defaultdict(set))
+        self.by_code: dict[str, dict[str, set]] = defaultdict(lambda: defaultdict(set))
+        self.by_combo_code: dict[str, dict[str, set]] = defaultdict(lambda: defaultdict(set))
+        self.by_identifier: dict[str, dict[str, set]] = defaultdict(lambda: defaultdict(set))
+        self.dates: dict[str, dict[str, str]] = defaultdict(dict)
+        self.updated: dict[str, dict[str, str]] = defaultdict(dict)
+        self.order: dict[str, dict[str, int]] = defaultdict(dict)
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    # -- loading -----------------------------------------------------------
+
+    def add(self, resources: Iterable[dict]) -> int:
+        count = 0
+        for r in resources:
+            rtype, rid = r.get("resourceType"), r.get("id")
+            if not rtype or not rid:
+                continue
+            if rid in self.resources[rtype]:
+                self._unindex(rtype, rid)
+            self.order[rtype].setdefault(rid, len(self.order[rtype]))
+            self.resources[rtype][rid] = r
+            self.raw[rtype][rid] = json.dumps(r, separators=(",", ":")).encode()
+            pid = _patient_id(r)
+            if pid:
+                self.by_patient[rtype][pid].add(rid)
+            concept = r.get("code") or r.get("medicationCodeableConcept")
+            for code in _codes(concept):
+                self.by_code[rtype][code].add(rid)
+                self.by_combo_code[rtype][code].add(rid)
+            for component in r.get("component", []):
+                for code in _codes(component.get("code")):
+                    self.by_combo_code[rtype][code].add(rid)
+            for ident in r.get("identifier", []):
+                if ident.get("value"):
+                    self.by_identifier[rtype][f"{ident.get('system', '')}|{ident['value']}"].add(rid)
+                    self.by_identifier[rtype][ident["value"]].add(rid)
+            self.dates[rtype][rid] = _clinical_date(r)
+            self.updated[rtype][rid] = _instant(r.get("meta", {}).get("lastUpdated"))
+            count += 1
+        with self._lock:
+            self._cache.clear()
+        return count
+
+    def _unindex(self, rtype: str, rid: str):
+        for index in (self.by_patient, self.by_code, self.by_combo_code, self.by_identifier):
+            for ids in index[rtype].values():
+                ids.discard(rid)
+
+    def load_dir(self, directory: str | Path) -> int:
+        """Every `*.json` Bundle in a directory and every `*.ndjson` file below it."""
+        directory = Path(directory)
+        files = sorted(directory.glob("*.json")) + sorted(directory.rglob("*.ndjson"))
+        return sum(self.add(read_resources(p)) for p in files)
+
+    def load_store(self, path: str | Path) -> int:
+        with ClinicalStore(path) as store:
+            return sum(self.add(store.resources(rtype)) for rtype in store.counts())
+
+    def counts(self) -> dict[str, int]:
+        return {rtype: len(ids) for rtype, ids in self.resources.items()}
+
+    # -- search ------------------------------------------------------------
+
+    def search(self, rtype: str, params: dict[str, list[str]]) -> list[str]:
+        """Matching IDs in result order (memoized per query)."""
+        key = (rtype, tuple(sorted((k, tuple(v)) for k, v in params.items() if k not in ("_count", "_offset"))))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        ids = self._search(rtype, params)
+        with self._lock:
+            self._cache[key] = ids
+            if len(self._cache) > QUERY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return ids
+
+    def _search(self, rtype: str, params: dict[str, list[str]]) -> list[str]:
+        resources = self.resources.get(rtype, {})
+        matched: set | None = None
+
+        def narrow(candidates: set):
+            nonlocal matched
+            matched = candidates if matched is None else matched & candidates
+
+        for name, values in params.items():
+            for value in values:
+                options = [v.split("|")[-1] if name in ("code", "combo-code") else v for v in value.split(",") if v]
+                if name == "_id":
+                    narrow(set(options) & resources.keys())
+                elif name in ("patient", "subject"):
+                    index = self.by_patient.get(rtype, {})
+                    narrow(set().union(*(index.get(o.split("/")[-1], ()) for o in options)))
+                elif name in ("code", "combo-code"):
+                    index = (self.by_code if name == "code" else self.by_combo_code).get(rtype, {})
+                    narrow(set().union(*(index.get(o, ()) for o in options)))
+                elif name == "identifier":
+                    index = self.by_identifier.get(rtype, {})
+                    narrow(set().union(*(index.get(o, ()) for o in options)))
+                elif name == "_has:Condition:patient:code" and rtype == "Patient":
+                    conditions = self.by_code.get("Condition", {})
+                    cond_ids = set().union(*(conditions.get(o.split("|")[-1], ()) for o in options))
+                    narrow({_patient_id(self.resources["Condition"][c]) for c in cond_ids} & resources.keys())
+
+        if matched is None:
+            ids = list(resources)
+        else:
+            order = self.order[rtype]
+            ids = sorted(matched & resources.keys(), key=order.__getitem__)
+
+        for name, values in params.items():
+            for value in values:
+                if name == "status":
+                    wanted = set(value.split(","))
+                    ids = [rid for rid in ids if resources[rid].get("status") in wanted]
+                elif name == "clinical-status":
+                    wanted = set(value.split(","))
+                    ids = [rid for rid in ids if wanted & set(_codes(resources[rid].get("clinicalStatus")))]
+                elif name == "date":
+                    dates = self.dates[rtype]
+                    ids = [rid for rid in ids if _compare(dates[rid], value)]
+                elif name == "_lastUpdated":
+                    updated = self.updated[rtype]
+                    ids = [rid for rid in ids if _compare(updated[rid], value)]
+
+        for field in reversed(",".join(params.get("_sort", [])).split(",")):
+            if not field:
+                continue
+            desc, field = field.startswith("-"), field.lstrip("-")
+            keys = {"date": self.dates[rtype], "_lastUpdated": self.updated[rtype]}.get(field)
+            if keys is not None:
+                ids.sort(key=keys.__getitem__, reverse=desc)
+            elif field == "_id":
+                ids.sort(reverse=desc)
+        return ids
+
+    def entry_bytes(self, rtype: str, rid: str, base: str, elements: list[str] | None = None) -> bytes:
+        if elements:
+            r = self.resources[rtype][rid]
+            keep = {"resourceType", "id", "meta", *elements}
+            body = json.dumps({k: v for k, v in r.items() if k in keep}, separators=(",", ":")).encode()
+        else:
+            body = self.raw[rtype][rid]
+        return b'{"fullUrl":"%s/%s/%s","resource":%s}' % (base.encode(), rtype.encode(), rid.encode(), body)
+
+    def export(self, types: list[str] | None, since: str | None, patient_level: bool) -> dict[str, bytes]:
+        """NDJSON per resource type for a bulk export (`types` None = every type)."""
+        since = _instant(since)
+        files = {}
+        for rtype in types or sorted(self.resources):
+            ids = [
+                rid for rid, r in self.resources.get(rtype, {}).items()
+                if (not since or self.updated[rtype][rid] >= since)
+                and (not patient_level or rtype == "Patient" or _patient_id(r))
+            ]
+            if ids:
+                files[rtype] = b"".join(self.raw[rtype][rid] + b"\n" for rid in ids)
+        return files
+
+    def includes(self, rtype: str, rids: list[str], include: list[str]) -> list[tuple[str, str]]:
+        """(type, id) of resources pulled in by `_include=MedicationRequest:medication`."""
+        if rtype != "MedicationRequest" or "MedicationRequest:medication" not in include:
+            return []
+        found = []
+        for rid in rids:
+            ref = (self.resources[rtype][rid].get("medicationReference") or {}).get("reference", "")
+            mid = ref.split("/")[-1]
+            if ref.startswith("Medication/") and mid in self.resources.get("Medication", {}):
+                found.append(("Medication", mid))
+        return list(dict.fromkeys(found))
+
+
+def capability_statement(index: ResourceIndex) -> dict:
+    return {
+        "resourceType": "CapabilityStatement",
+        "status": "active",
+        "kind": "instance",
+        "fhirVersion": "4.0.1",
+        "format": ["json"],
+        "software": {"name": "clinical-intelligence local FHIR server"},
+        "rest": [{
+            "mode": "server",
+            "resource": [
+                {
+                    "type": rtype,
+                    "interaction": [{"code": "read"}, {"code": "search-type"}],
+                    "searchParam": [{"name": p, "type": "token"} for p in SEARCH_PARAMS if not p.startswith("_")],
+                }
+                for rtype in sorted(index.resources)
+            ],
+        }],
+    }
+
+
+class FHIRRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate small writes; with Nagle on, each
+    # keep-alive response stalls on the client's delayed ACK (~40 ms).
+    disable_nagle_algorithm = True
+    index: ResourceIndex
+    verbose = False
+
+    def log_message(self, fmt, *args):
+        if self.verbose:
+            super().log_message(fmt, *args)
+
+    def do_GET(self):
+        self.server.count_request()
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        base = f"http://{self.headers.get('Host') or '%s:%d' % self.server.server_address[:2]}"
+        if parts == ["metadata"]:
+            return self._send(200, json.dumps(capability_statement(self.index)).encode())
+        if parts in (["$export"], ["Patient", "$export"]):
+            return self._kick_off(parse_qs(url.query), base, patient_level=len(parts) == 2)
+        if len(parts) >= 2 and parts[0] in ("$export-status", "$export-file"):
+            return self._export_status(parts[1], base) if len(parts) == 2 else self._export_file(parts[1], parts[2])
+        if len(parts) == 2:
+            raw = self.index.raw.get(parts[0], {}).get(parts[1])
+            if raw is None:
+                return self._outcome(404, f"{parts[0]}/{parts[1]} not found")
+            return self._send(200, raw)
+        if len(parts) == 1 and parts[0][:1].isupper():
+            return self._search(parts[0], parse_qs(url.query), base)
+        return self._outcome(404, f"unsupported path {url.path}")
+
+    def _search(self, rtype: str, params: dict[str, list[str]], base: str):
+        try:
+            count = min(int(params.get("_count", [DEFAULT_PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+            offset = max(int(params.get("_offset", [0])[0]), 0)
+        except ValueError:
+            return self._outcome(400, "_count and _offset must be integers")
+        ids = self.index.search(rtype, params)
+        page = ids[offset:offset + count]
+        elements = [e for v in params.get("_elements", []) for e in v.split(",") if e] or None
+
+        def link(relation: str, start: int) -> bytes:
+            query = urlencode({**{k: v for k, v in params.items() if k != "_offset"}, "_offset": [start]}, doseq=True)
+            return b'{"relation":"%s","url":"%s/%s?%s"}' % (relation.encode(), base.encode(), rtype.encode(), query.encode())
+
+        links = [link("self", offset)]
+        if offset + count < len(ids):
+            links.append(link("next", offset + count))
+        if offset > 0:
+            links.append(link("previous", max(offset - count, 0)))
+        entries = [self.index.entry_bytes(rtype, rid, base, elements) for rid in page]
+        for itype, iid in self.index.includes(rtype, page, params.get("_include", [])):
+            entries.append(self.index.entry_bytes(itype, iid, base)[:-1] + b',"search":{"mode":"include"}}')
+        body = b'{"resourceType":"Bundle","type":"searchset","total":%d,"link":[%s],"entry":[%s]}' % (
+            len(ids), b",".join(links), b",".join(entries)
+        )
+        self._send(200, body)
+
+    # -- bulk export -----------------------------------------------------------
+
+    def _kick_off(self, params: dict[str, list[str]], base: str, patient_level: bool):
+        types = [t for v in params.get("_type", []) for t in v.split(",") if t] or None
+        since = params.get("_since", [None])[0]
+        export_id = self.server.add_export(self.index.export(types, since, patient_level), base + self.path)
+        self.send_response(202)
+        self.send_header("Content-Location", f"{base}/$export-status/{export_id}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _export_status(self, export_id: str, base: str):
+        export = self.server.exports.get(export_id)
+        if export is None:
+            return self._outcome(404, f"no export {export_id}")
+        if export["polls"] < EXPORT_POLLS:
+            export["polls"] += 1
+            self.send_response(202)
+            self.send_header("X-Progress", "in progress")
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            return self.end_headers()
+        manifest = {
+            "transactionTime": export["time"],
+            "request": export["request"],
+            "requiresAccessToken": False,
+            "output": [{"type": t, "url": f"{base}/$export-file/{export_id}/{t}"} for t in export["files"]],
+            "error": [],
+        }
+        self._send(200, json.dumps(manifest).encode(), "application/json")
+
+    def _export_file(self, export_id: str, rtype: str):
+        body = self.server.exports.get(export_id, {}).get("files", {}).get(rtype)
+        if body is None:
+            return self._outcome(404, f"no {rtype} file in export {export_id}")
+        self._send(200, body, NDJSON)
+
+    def do_DELETE(self):
+        parts = [p for p in urlsplit(self.path).path.split("/") if p]
+        if len(parts) == 2 and parts[0] == "$export-status" and self.server.exports.pop(parts[1], None) is not None:
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            return self.end_headers()
+        self._outcome(404, f"unsupported path {self.path}")
+
+    def _outcome(self, status: int, message: str):
+        outcome = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing", "diagnostics": message}]}
+        self._send(status, json.dumps(outcome).encode())
+
+    def _send(self, status: int, body: bytes, content_type: str = FHIR_JSON):
+        if status == 200:
+            etag = 'W/"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+            if etag in self.headers.get("If-None-Match", ""):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 200:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FHIRServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+    requests_served = 0     # GET requests answered (for load tests and benchmarks)
+    _count_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.exports: dict[str, dict] = {}      # bulk exports by id, until DELETEd
+
+    def count_request(self):
+        with self._count_lock:
+            self.requests_served += 1
+
+    def add_export(self, files: dict[str, bytes], request: str) -> str:
+        export_id = uuid.uuid4().hex[:12]
+        self.exports[export_id] = {
+            "files": files, "request": request, "polls": 0,
+            "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        return export_id
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def make_server(index: ResourceIndex, host: str = "127.0.0.1", port: int = 0, verbose: bool = False) -> FHIRServer:
+    """Server for `index` (port 0 picks a free port; see `.base_url`)."""
+    handler = type("Handler", (FHIRRequestHandler,), {"index": index, "verbose": verbose})
+    return FHIRServer((host, port), handler)
+
+
+def serve_in_background(index: ResourceIndex, host: str = "127.0.0.1", port: int = 0) -> FHIRServer:
+    """Start a server on a daemon thread; call `.shutdown()` to stop it."""
+    server = make_server(index, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve cached FHIR data with real search semantics.")
+    parser.add_argument("paths", nargs="*", help=f"Bundle/NDJSON files or directories (default: {DEFAULT_DATA})")
+    parser.add_argument("--store", help="also load every resource from this clinical store (SQLite)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    index = ResourceIndex()
+    for path in args.paths or ([] if args.store else [DEFAULT_DATA]):
+        n = index.load_dir(path) if Path(path).is_dir() else index.add(read_resources(path))
+        print(f"  {path}: {n} resources")
+    if args.store:
+        print(f"  {args.store}: {index.load_store(args.store)} resources")
+    print(f"Loaded {index.counts()}")
+
+    server = make_server(index, args.host, args.port, args.verbose)
+    print(f"Serving FHIR at {server.base_url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Incremental (delta) sync of cached FHIR searches.
+
+A sync state file records a high-water mark per resource type: the newest
+`meta.lastUpdated` seen so far. A refresh re-runs each cached search with
+`_lastUpdated=gt<mark>` so only changed resources come back, reads deletions
+from `<Type>/_history?_since=<mark>`, and merges both into the cached Bundle.
+Refresh cost scales with churn rather than population size.
+"""
+
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+
+from fhir_client import FHIRClient
+
+
+def resource_type(path: str) -> str:
+    """Resource type a search path targets ("/Condition?patient=1" -> "Condition")."""
+    return urlparse(path).path.strip("/").split("/")[0]
+
+
+def _parse(ts: str) -> datetime | None:
+    try:
+        return datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def newest(timestamps, current: str | None = None) -> str | None:
+    """Latest of `current` and `timestamps` (ISO strings, compared as instants)."""
+    best, best_dt = current, _parse(current) if current else None
+    for ts in timestamps:
+        dt = _parse(ts) if ts else None
+        if dt is not None and (best_dt is None or dt > best_dt):
+            best, best_dt = ts, dt
+    return best
+
+
+def high_water_mark(resources, current: str | None = None) -> str | None:
+    return newest((r.get("meta", {}).get("lastUpdated") for r in resources), current)
+
+
+# ---------------------------------------------------------------------------
+# State
+# ---------------------------------------------------------------------------
+
+def load_state(path: str | Path) -> dict:
+    """Sync state: {"base_url": ..., "marks": {resource_type: lastUpdated}}."""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"marks": {}}
+
+
+def save_state(path: str | Path, state: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+def record_marks(state: dict, resources) -> dict:
+    """Advance the per-type high-water marks past `resources`."""
+    marks = state.setdefault("marks", {})
+    by_type: dict[str, list[dict]] = {}
+    for r in resources:
+        by_type.setdefault(r.get("resourceType"), []).append(r)
+    for rtype, items in by_type.items():
+        mark = high_water_mark(items, marks.get(rtype))
+        if mark:
+            marks[rtype] = mark
+    return state
+
+
+# ---------------------------------------------------------------------------
+# Fetching changes
+# ---------------------------------------------------------------------------
+
+def fetch_changes(client: FHIRClient, path: str, since: str | None) -> list[dict]:
+    """Resources matching the search at `path` that changed after `since`."""
+    params = {"_lastUpdated": f"gt{since}"} if since else None
+    return client.search_all(path, params)
+
+
+def fetch_deletions(client: FHIRClient, rtype: str, since: str) -> set[str]:
+    """References ("Type/id") of `rtype` resources deleted after `since`.
+
+    Read from the type's `_history`, which lists newest versions first, so a
+    resource that was deleted and then re-created is not reported. Servers
+    without `_history` support return an empty set (deletions are then only
+    picked up by a full refresh).
+    """
+    seen, deleted = set(), set()
+    try:
+        for page in client.pages(f"{rtype}/_history", {"_since": since}):
+            for entry in page.get("entry", []):
+                request = entry.get("request", {})
+                rid = (entry.get("resource") or {}).get("id") or request.get("url", "").split("/_history")[0].rstrip("/").split("/")[-1]
+                if not rid or rid in seen:
+                    continue
+                seen.add(rid)
+                if request.get("method") == "DELETE":
+                    deleted.add(f"{rtype}/{rid}")
+    except requests.HTTPError:
+        return set()
+    return deleted
+
+
+def merge(
+    bundle: dict,
+    upserts: list[dict],
+    deleted: set[str] = frozenset(),
+    base_url: str | None = None,
+    replace_only: bool = False,
+) -> tuple[dict, dict]:
+    """Merge changed and deleted ("Type/id") resources into a cached searchset Bundle.
+
+    With `replace_only`, changed resources not already cached are skipped
+    (for page-limited searches like "first 20 patients").
+    Returns (bundle, {"added": n, "updated": n, "removed": n}).
+    """
+    entries = bundle.get("entry", [])
+    index = {f"{e['resource']['resourceType']}/{e['resource']['id']}": i for i, e in enumerate(entries) if "resource" in e}
+    stats = {"added": 0, "updated": 0, "removed": 0}
+
+    for resource in upserts:
+        ref = f"{resource['resourceType']}/{resource['id']}"
+        if ref in index:
+            entries[index[ref]]["resource"] = resource
+            stats["updated"] += 1
+        elif not replace_only:
+            entry = {"fullUrl": f"{base_url}/{ref}"} if base_url else {}
+            entry["resource"] = resource
+            index[ref] = len(entries)
+            entries.append(entry)
+            stats["added"] += 1
+
+    if deleted:
+        kept = [
+            e for e in entries
+            if f"{e.get('resource', {}).get('resourceType')}/{e.get('resource', {}).get('id')}" not in deleted
+        ]
+        stats["removed"] = len(entries) - len(kept)
+        entries = kept
+
+    bundle["entry"] = entries
+    bundle["total"] = len(entries)
+    return bundle, stats
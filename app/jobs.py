@@ -0,0 +1,383 @@
+"""
+Background job queue for workbench workflows.
+
+Workflows are submitted as jobs instead of running inside a Streamlit script
+run, so a long cohort analysis does not block the user's session and every
+user shares the same admission control. A job is a sequence of stages, each
+bound to a resource with its own concurrency limit:
+
+- `GPU` -- LLM generation. Defaults to one slot: a single local GPU serves
+  one generation at a time faster than several interleaved ones.
+- `CPU` -- code execution and measure evaluation, sized to the execution pool.
+
+Each resource has a FIFO queue and a fixed set of slot threads. A job waiting
+for a resource reports its position in that queue and an ETA estimated from
+recent stage durations. Jobs and their results are persisted in SQLite, so a
+user can navigate away and come back to a finished job by its ID.
+
+    queue = JobQueue(slots={GPU: 1, CPU: 2})
+    queue.register("measure", [(CPU, evaluate_measure)])
+    job_id = queue.submit("measure", "Diabetes gap analysis", {"condition": "..."})
+    queue.get(job_id).status      # "queued", "running", "done", "failed" or "cancelled"
+    queue.eta(job_id)             # seconds until done (estimate)
+
+A stage is a callable taking the `Job`; it reads `job.params`, writes into
+`job.result` and may update `job.progress` for live display. A stage that
+refines its result step by step can check `job.stop_requested` between steps
+and finish early with what it has when the user stops the job.
+
+`job.work_dir` is scratch space, removed when the job finishes unless
+`job.result` still refers to files in it (a stage that keeps files for good
+moves them out first, into the artifact store). Work directories left behind
+are pruned when the queue starts, once older than the artifact store's
+expiry. A run served from an earlier identical one is stored directly as
+finished with `record()`.
+"""
+
+import json
+import os
+import queue as queue_module
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import telemetry
+from artifact_store import DEFAULT_TTL
+from llm_cache import CACHE_DIR
+
+GPU, CPU = "gpu", "cpu"
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+DEFAULT_STAGE_SECONDS = 30.0    # ETA guess for a stage that has never run
+EWMA_ALPHA = 0.3
+HISTORY = 50                    # finished jobs used to seed the duration estimates
+
+Stage = Callable[["Job"], None]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    owner TEXT,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage INTEGER NOT NULL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    timings TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted);
+"""
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    name: str
+    params: dict
+    owner: str | None = None
+    status: str = QUEUED
+    stage: int = 0                      # index of the current (or next) stage
+    submitted: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    error: str | None = None
+    timings: dict = field(default_factory=dict)    # stage index (str) -> seconds
+    result: dict = field(default_factory=dict)
+    work_dir: str | None = None         # per-job scratch directory; removed when the job finishes, unless the result refers to it
+    progress: str = ""                  # live status text; not persisted
+    stage_started: float | None = None
+    stop_requested: bool = False        # set by JobQueue.stop(); not persisted
+    trace: telemetry.Trace | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+
+def _jsonable(value):
+    # numpy scalars (pandas summaries) -> Python numbers; anything else as text
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def _refers_to(value, path: str) -> bool:
+    """Whether any string in `value` is `path` or a path under it."""
+    if isinstance(value, str):
+        return value == path or value.startswith(path + os.sep)
+    if isinstance(value, (list, tuple)):
+        return any(_refers_to(v, path) for v in value)
+    if isinstance(value, dict):
+        return any(_refers_to(v, path) for v in value.values())
+    return False
+
+
+class JobQueue:
+    """Persistent multi-stage job queue with per-resource concurrency limits."""
+
+    def __init__(
+        self,
+        path: str | Path = CACHE_DIR / "jobs.db",
+        slots: dict[str, int] | None = None,
+        trace_log: str | None = None,
+        work_dir_ttl: float = DEFAULT_TTL,
+    ):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.slots = {GPU: 1, CPU: 2, **(slots or {})}
+        self.artifacts = Path(path).parent / "jobs"
+        self.trace_log = trace_log
+        self._stages: dict[str, list[tuple[str, Stage]]] = {}
+        self._lock = threading.RLock()
+        self._jobs: dict[str, Job] = {}              # unfinished jobs
+        self._waiting: dict[str, list[str]] = {r: [] for r in self.slots}
+        self._queues: dict[str, queue_module.Queue] = {r: queue_module.Queue() for r in self.slots}
+        self._avg: dict[tuple[str, int], float] = {}
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        with self.conn:
+            # Jobs that were queued or running when the process stopped cannot resume.
+            interrupted = self.conn.execute("SELECT id FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchall()
+            for (job_id,) in interrupted:
+                shutil.rmtree(self.artifacts / job_id, ignore_errors=True)
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE status IN (?, ?)",
+                (FAILED, "interrupted by a workbench restart", time.time(), QUEUED, RUNNING),
+            )
+        self._prune_work_dirs(time.time() - work_dir_ttl)
+        self._seed_estimates()
+        for resource, count in self.slots.items():
+            for i in range(count):
+                threading.Thread(target=self._slot, args=(resource,), name=f"job-{resource}-{i}", daemon=True).start()
+
+    # -- registration and submission ----------------------------------------
+
+    def register(self, kind: str, stages: list[tuple[str, Stage]]):
+        """Define a job kind as a list of (resource, stage function)."""
+        unknown = {r for r, _ in stages} - set(self.slots)
+        if unknown:
+            raise ValueError(f"unknown resources {sorted(unknown)}")
+        self._stages[kind] = stages
+
+    def submit(
+        self, kind: str, name: str, params: dict, owner: str | None = None, result: dict | None = None,
+    ) -> str:
+        """Queue a job; `result` pre-fills what earlier work already produced."""
+        if kind not in self._stages:
+            raise ValueError(f"unknown job kind {kind!r}")
+        job = Job(uuid.uuid4().hex[:12], kind, name, params, owner, result=dict(result or {}))
+        job.work_dir = str(self.artifacts / job.id)
+        Path(job.work_dir).mkdir(parents=True, exist_ok=True)
+        job.trace = telemetry.Trace(name, job_id=job.id, **{k: v for k, v in params.items() if k in ("model", "condition")})
+        with self._lock:
+            self._jobs[job.id] = job
+            self._save(job)
+            self._enqueue(job)
+        telemetry.count("jobs_submitted_total", kind=kind)
+        return job.id
+
+    def record(
+        self, kind: str, name: str, params: dict, owner: str | None = None, result: dict | None = None,
+    ) -> str:
+        """Store a job that needs no work (e.g. served from an earlier identical run) as done."""
+        if kind not in self._stages:
+            raise ValueError(f"unknown job kind {kind!r}")
+        job = Job(uuid.uuid4().hex[:12], kind, name, params, owner, result=dict(result or {}))
+        job.started = job.submitted
+        job.trace = telemetry.Trace(name, job_id=job.id, **{k: v for k, v in params.items() if k in ("model", "condition")})
+        with self._lock:
+            self._finish(job, DONE)
+        telemetry.count("jobs_submitted_total", kind=kind)
+        return job.id
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job that has not started its current stage yet."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != QUEUED:
+                return False
+            resource = self._stages[job.kind][job.stage][0]
+            self._waiting[resource].remove(job_id)
+            self._finish(job, CANCELLED)
+        return True
+
+    def stop(self, job_id: str) -> bool:
+        """Ask a running job to finish early; stages that support it check `job.stop_requested`."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != RUNNING:
+                return False
+            job.stop_requested = True
+        return True
+
+    # -- inspection -----------------------------------------------------------
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            if job_id in self._jobs:
+                return self._jobs[job_id]
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def jobs(self, owner: str | None = None, limit: int = 20) -> list[Job]:
+        """Most recent jobs first (optionally only `owner`'s)."""
+        sql, params = "SELECT * FROM jobs", []
+        if owner:
+            sql, params = sql + " WHERE owner = ?", [owner]
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY submitted DESC LIMIT ?", [*params, limit]).fetchall()
+            return [self._jobs.get(row[0]) or self._from_row(row) for row in rows]
+
+    def resource(self, job: Job) -> str | None:
+        stages = self._stages.get(job.kind, [])
+        return stages[job.stage][0] if not job.done and job.stage < len(stages) else None
+
+    def position(self, job_id: str) -> int | None:
+        """1-based place in the queue of the resource the job is waiting for."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != QUEUED:
+                return None
+            return self._waiting[self.resource(job)].index(job_id) + 1
+
+    def eta(self, job_id: str) -> float | None:
+        """Estimated seconds until the job finishes."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            stages = self._stages[job.kind]
+            remaining = sum(self._estimate(job.kind, i) for i in range(job.stage, len(stages)))
+            if job.status == RUNNING:
+                return max(remaining - (time.time() - job.stage_started), 0.0)
+            resource = stages[job.stage][0]
+            ahead = self._waiting[resource][:self._waiting[resource].index(job_id)]
+            busy = [j for j in self._jobs.values() if j.status == RUNNING and self.resource(j) == resource]
+            # Everything ahead of us on this resource, spread over its slots.
+            backlog = sum(self._estimate(self._jobs[j].kind, self._jobs[j].stage) for j in ahead)
+            backlog += sum(max(self._estimate(j.kind, j.stage) - (time.time() - j.stage_started), 0.0) for j in busy)
+            return backlog / self.slots[resource] + remaining
+
+    def stats(self) -> dict[str, dict]:
+        """Per resource: slots, running and queued job counts."""
+        with self._lock:
+            running = [self.resource(j) for j in self._jobs.values() if j.status == RUNNING]
+            return {r: {"slots": n, "running": running.count(r), "queued": len(self._waiting[r])} for r, n in self.slots.items()}
+
+    # -- execution --------------------------------------------------------------
+
+    def _enqueue(self, job: Job):
+        resource = self._stages[job.kind][job.stage][0]
+        job.status = QUEUED
+        self._waiting[resource].append(job.id)
+        self._queues[resource].put(job.id)
+
+    def _slot(self, resource: str):
+        while True:
+            job_id = self._queues[resource].get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status != QUEUED:
+                    continue        # cancelled while waiting
+                self._waiting[resource].remove(job_id)
+                job.status, job.stage_started = RUNNING, time.time()
+                job.started = job.started or job.stage_started
+                self._save(job)
+            self._run_stage(job)
+
+    def _run_stage(self, job: Job):
+        index = job.stage
+        resource, fn = self._stages[job.kind][index]
+        t0 = time.perf_counter()
+        try:
+            with telemetry.activate(job.trace), telemetry.span(f"job.{resource}", stage=fn.__name__):
+                fn(job)
+        except Exception as e:
+            job.timings[str(index)] = time.perf_counter() - t0
+            with self._lock:
+                job.error = f"{type(e).__name__}: {e}"
+                self._finish(job, FAILED)
+            return
+        elapsed = time.perf_counter() - t0
+        job.timings[str(index)] = elapsed
+        with self._lock:
+            key = (job.kind, index)
+            self._avg[key] = elapsed if key not in self._avg else (1 - EWMA_ALPHA) * self._avg[key] + EWMA_ALPHA * elapsed
+            if job.error:
+                # A stage may end the job early with a user-facing error (e.g. no code generated).
+                self._finish(job, FAILED)
+            elif index + 1 < len(self._stages[job.kind]):
+                job.stage = index + 1
+                job.progress = ""
+                self._save(job)
+                self._enqueue(job)
+            else:
+                self._finish(job, DONE)
+
+    def _finish(self, job: Job, status: str):
+        job.status, job.finished, job.progress = status, time.time(), ""
+        if job.work_dir is not None and not _refers_to(job.result, job.work_dir):
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+        if job.trace is not None:
+            job.trace.finish(self.trace_log)
+            job.result["trace"] = job.trace.to_dict()
+        self._save(job)
+        self._jobs.pop(job.id, None)
+        telemetry.count("jobs_finished_total", kind=job.kind, status=status)
+
+    def _prune_work_dirs(self, cutoff: float):
+        """Remove work directories kept by finished jobs and not modified since `cutoff`."""
+        if not self.artifacts.is_dir():
+            return
+        for work_dir in self.artifacts.iterdir():
+            try:
+                stale = work_dir.stat().st_mtime < cutoff
+            except FileNotFoundError:
+                continue
+            if stale:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    # -- persistence ------------------------------------------------------------
+
+    def _save(self, job: Job):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.kind, job.name, job.owner, json.dumps(job.params), job.status, job.stage,
+                 job.submitted, job.started, job.finished, job.error, json.dumps(job.timings),
+                 json.dumps(job.result, default=_jsonable)),
+            )
+
+    def _from_row(self, row) -> Job:
+        (id_, kind, name, owner, params, status, stage, submitted, started, finished, error, timings, result) = row
+        job = Job(id_, kind, name, json.loads(params), owner, status, stage, submitted, started, finished, error,
+                  json.loads(timings or "{}"), json.loads(result or "{}"), str(self.artifacts / id_))
+        if "trace" in job.result:
+            job.trace = telemetry.Trace.from_dict(job.result["trace"])
+        return job
+
+    def _seed_estimates(self):
+        rows = self.conn.execute(
+            "SELECT kind, timings FROM (SELECT * FROM jobs WHERE status = ? ORDER BY finished DESC LIMIT ?) "
+            "ORDER BY finished", (DONE, HISTORY),
+        ).fetchall()
+        for kind, timings in rows:
+            for index, seconds in json.loads(timings or "{}").items():
+                key = (kind, int(index))
+                self._avg[key] = seconds if key not in self._avg else (1 - EWMA_ALPHA) * self._avg[key] + EWMA_ALPHA * seconds
+
+    def _estimate(self, kind: str, index: int) -> float:
+        return self._avg.get((kind, index), DEFAULT_STAGE_SECONDS)
+
+    def close(self):
+        self.conn.close()
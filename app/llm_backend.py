@@ -0,0 +1,164 @@
+"""
+LLM backend adapters.
+
+Probes a server once to learn whether it speaks the Ollama API (`/api/chat`)
+or the OpenAI-compatible API (`/v1/chat/completions`, e.g. vLLM), caches the
+answer, and keeps a pooled keep-alive session per server. Generation then
+goes straight to the right protocol instead of failing over on every call.
+
+    backend = backend_for("http://localhost:11434")
+    for piece in backend.stream(model, messages, stats):
+        ...
+    backend.health()   # {"ok": True, "protocol": "ollama", "latency_ms": 3.1, ...}
+"""
+
+import json
+import threading
+import time
+from typing import Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+
+PROBE_TIMEOUT = 3
+GENERATE_TIMEOUT = 300
+HEALTH_MAX_AGE = 30
+
+OLLAMA = "ollama"
+OPENAI = "openai"
+
+
+class LLMBackendError(RuntimeError):
+    pass
+
+
+class LLMBackend:
+    """Protocol-aware client for one LLM server."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Authorization"] = "Bearer not-needed"
+        self.protocol: str | None = None
+        self._health: dict | None = None
+        self._lock = threading.Lock()
+
+    # -- detection ---------------------------------------------------------
+
+    def probe(self) -> dict:
+        """Detect the server's protocol and measure round-trip latency."""
+        checks = ((OLLAMA, "/api/tags", "models", "name"), (OPENAI, "/v1/models", "data", "id"))
+        health = {"ok": False, "protocol": None, "latency_ms": None, "models": [], "error": "no response"}
+        for protocol, path, key, field in checks:
+            t0 = time.perf_counter()
+            try:
+                r = self.session.get(f"{self.base_url}{path}", timeout=PROBE_TIMEOUT)
+            except requests.RequestException as e:
+                # Connection-level failures will not differ by path.
+                health["error"] = str(e)
+                break
+            latency_ms = (time.perf_counter() - t0) * 1000
+            if not r.ok:
+                health["error"] = f"HTTP {r.status_code} from {path}"
+                continue
+            try:
+                models = [m.get(field) for m in r.json().get(key, [])]
+            except (ValueError, AttributeError):
+                health["error"] = f"unexpected response from {path}"
+                continue
+            health.update(ok=True, protocol=protocol, latency_ms=latency_ms, models=models, error=None)
+            break
+        health["checked"] = time.time()
+        with self._lock:
+            self.protocol = health["protocol"]
+            self._health = health
+        return health
+
+    def health(self, max_age: float = HEALTH_MAX_AGE) -> dict:
+        """Cached probe result, refreshed when older than `max_age` seconds."""
+        with self._lock:
+            health = self._health
+        if health is None or time.time() - health["checked"] > max_age:
+            health = self.probe()
+        return health
+
+    # -- generation --------------------------------------------------------
+
+    def stream(self, model: str, messages: list[dict], stats: dict | None = None) -> Iterator[str]:
+        """Yield response text as it is generated; fills `stats` with token usage."""
+        stats = {} if stats is None else stats
+        if self.protocol is None:
+            health = self.probe()
+            if not health["ok"]:
+                raise LLMBackendError(f"LLM server at {self.base_url} is unreachable: {health['error']}")
+        stats["protocol"] = self.protocol
+        try:
+            if self.protocol == OLLAMA:
+                yield from self._stream_ollama(model, messages, stats)
+            else:
+                yield from self._stream_openai(model, messages, stats)
+        except requests.ConnectionError:
+            # The server may have been restarted as a different backend.
+            self.protocol = None
+            raise
+
+    def _stream_ollama(self, model: str, messages: list[dict], stats: dict) -> Iterator[str]:
+        with self.session.post(
+            f"{self.base_url}/api/chat",
+            json={"model": model, "messages": messages, "stream": True},
+            stream=True, timeout=GENERATE_TIMEOUT,
+        ) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    yield piece
+                if chunk.get("done"):
+                    stats["tokens_in"] = chunk.get("prompt_eval_count")
+                    stats["tokens_out"] = chunk.get("eval_count")
+
+    def _stream_openai(self, model: str, messages: list[dict], stats: dict) -> Iterator[str]:
+        with self.session.post(
+            f"{self.base_url}/v1/chat/completions",
+            json={"model": model, "messages": messages, "max_tokens": 4096, "temperature": 0.2,
+                  "stream": True, "stream_options": {"include_usage": True}},
+            stream=True, timeout=GENERATE_TIMEOUT,
+        ) as r:
+            r.raise_for_status()
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    stats["tokens_in"] = chunk["usage"].get("prompt_tokens")
+                    stats["tokens_out"] = chunk["usage"].get("completion_tokens")
+                    # vLLM reports prefix-cache hits when --enable-prompt-tokens-details is set.
+                    cached = (chunk["usage"].get("prompt_tokens_details") or {}).get("cached_tokens")
+                    if cached is not None:
+                        stats["tokens_cached"] = cached
+                for choice in chunk.get("choices", []):
+                    piece = (choice.get("delta") or {}).get("content")
+                    if piece:
+                        yield piece
+
+
+_backends: dict[str, LLMBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def backend_for(base_url: str) -> LLMBackend:
+    """Return the process-wide shared backend for `base_url`."""
+    key = base_url.rstrip("/")
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = LLMBackend(key)
+        return _backends[key]
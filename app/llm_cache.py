@@ -0,0 +1,97 @@
+"""
+Persistent cache of LLM responses and the code extracted from them.
+
+Preset workflows send byte-identical prompts, so a repeat run can skip GPU
+generation entirely. Entries are keyed by a hash of (system prompt, user
+prompt, model, endpoint) and evicted by age (TTL) and total size (least
+recently used first).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get("CLINICAL_CACHE_DIR", Path.home() / ".cache" / "clinical-intelligence"))
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def cache_key(system_prompt: str, prompt: str, model: str, endpoint: str) -> str:
+    payload = json.dumps([system_prompt, prompt, model, endpoint.rstrip("/")], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LLMCache:
+    """SQLite-backed response cache with TTL and LRU size eviction."""
+
+    def __init__(
+        self,
+        path: str | Path = CACHE_DIR / "llm-cache.db",
+        ttl: float = DEFAULT_TTL,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, response TEXT, code TEXT,"
+            " size INTEGER, created REAL, accessed REAL)"
+        )
+
+    def get(self, key: str) -> dict | None:
+        """Cached {"response", "code", "created"} for `key`, or None if missing/expired."""
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute(
+                "SELECT response, code, created FROM responses WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return {"response": row[0], "code": row[1], "created": row[2]}
+
+    def put(self, key: str, model: str, response: str, code: str | None):
+        now = time.time()
+        size = len(response.encode()) + len((code or "").encode())
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, code, size, now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self.conn.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def invalidate(self, key: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,561 @@
+"""
+Built-in quality-measure engine for the preset gap analyses.
+
+Each entry in `PRESET_CONDITIONS` fully specifies a measure: the cohort
+(SNOMED condition), the lab (LOINC) and its threshold, the age band of the
+denominator and the drug classes that count as treatment. `run_measure()`
+evaluates one as a vectorized pandas pipeline -- cohort selection, latest
+value per patient, threshold, medication-class exclusion -- so preset runs
+are deterministic and need no LLM round trip.
+
+    from clinical_store import ClinicalStore
+    from measures import run_measure, report
+
+    result = run_measure("Diabetes Mellitus Type 2", store=ClinicalStore())
+    print(report(result))
+    result.frame[result.frame["gap"]]          # one row per gap patient
+
+Data comes from a `ClinicalStore` or, with `client=`, straight from a FHIR
+server through the batched `fhir_batch` helpers.
+
+The preset cohorts overlap heavily, so `run_all_measures()` evaluates every
+preset in one pass: it loads the union of the cohorts, fetches each
+patient's labs and medications once, and evaluates each measure against the
+shared frames.
+
+    batch = run_all_measures(client=FHIRClient(base_url))
+    print(batch_report(batch))
+    batch.results["Hypertension"].gaps
+
+For a quick read on a large cohort, `progressive_measure()` evaluates a
+random sample first and then growing batches of the rest. After each batch
+it yields the gap rate so far with a confidence interval, ending with the
+exact result:
+
+    for estimate in progressive_measure("Hypertension", client=client):
+        print(f"{estimate.gap_rate:.1%} ({estimate.low:.1%}-{estimate.high:.1%}), {estimate.sampled}/{estimate.cohort}")
+"""
+
+import math
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+import fhir_batch
+import fhir_frames
+import telemetry
+import terminology
+from clinical_store import ClinicalStore
+from fhir_client import FHIRClient
+
+DRUG_CLASSES = terminology.DRUG_CLASSES  # re-exported; callers imported it from here
+
+# `threshold` and `gap_meds` are the display strings; `value`/`direction`
+# and `drug_classes` are what the engine evaluates. `ages` bounds the
+# denominator (inclusive, None = open). `code_param` is "combo-code" for
+# LOINCs that live in a panel component (systolic BP in 55284-4).
+PRESET_CONDITIONS = {
+    "Diabetes Mellitus Type 2": {
+        "snomed": "44054006", "lab": "HbA1c", "loinc": "4548-4", "threshold": "9%",
+        "gap_meds": "insulin or GLP-1 agonist",
+        "measure": "CMS122", "value": 9.0, "unit": "%", "direction": "above", "ages": (18, 75),
+        "drug_classes": ["insulin", "glp1_agonist"], "code_param": "code",
+    },
+    "Hypertension": {
+        "snomed": "38341003", "lab": "Systolic BP", "loinc": "8480-6", "threshold": "140 mmHg",
+        "gap_meds": "any antihypertensive",
+        "measure": "CMS165", "value": 140.0, "unit": "mmHg", "direction": "above", "ages": (18, 85),
+        "drug_classes": ["ace_inhibitor", "arb", "arni", "beta_blocker", "ccb", "diuretic"], "code_param": "combo-code",
+    },
+    "Heart Failure": {
+        "snomed": "84114007", "lab": "BNP", "loinc": "42637-9", "threshold": "400 pg/mL",
+        "gap_meds": "ACE inhibitor, ARB, or beta-blocker",
+        "measure": "CMS135", "value": 400.0, "unit": "pg/mL", "direction": "above", "ages": (18, None),
+        "drug_classes": ["ace_inhibitor", "arb", "arni", "beta_blocker"], "code_param": "code",
+    },
+    "Chronic Kidney Disease": {
+        "snomed": "40055000", "lab": "eGFR", "loinc": "33914-3", "threshold": "below 30 mL/min",
+        "gap_meds": "ACE inhibitor or ARB",
+        "measure": None, "value": 30.0, "unit": "mL/min/1.73m2", "direction": "below", "ages": (18, None),
+        "drug_classes": ["ace_inhibitor", "arb"], "code_param": "code",
+    },
+}
+
+DISCLAIMER = "For research and operational purposes only. Clinical decisions should be made by qualified clinicians."
+
+SAMPLE_START = 250      # patients in the first batch of a progressive run
+SAMPLE_GROWTH = 2       # each further batch is this many times the previous one
+Z_95 = 1.959964
+
+
+@dataclass
+class MeasureResult:
+    condition: str
+    preset: dict
+    frame: pd.DataFrame
+    summary: dict
+    timings: dict = field(default_factory=dict)
+
+    @property
+    def gaps(self) -> pd.DataFrame:
+        return self.frame[self.frame["gap"]]
+
+
+@dataclass
+class BatchResult:
+    """Every requested preset, evaluated against one shared load."""
+
+    results: dict[str, MeasureResult]
+    fetched: dict          # patients (union of cohorts), memberships, labs, medications
+    timings: dict = field(default_factory=dict)
+
+
+@dataclass
+class GapEstimate:
+    """The gap rate of a random sample of a cohort, with a 95% confidence interval."""
+
+    condition: str
+    sampled: int            # cohort patients evaluated so far
+    cohort: int
+    summary: dict           # `summarize()` of the sample
+    low: float
+    high: float
+    elapsed: float          # seconds since the run started
+    result: MeasureResult | None = None     # the exact result, once every patient is evaluated
+
+    @property
+    def gap_rate(self) -> float:
+        return self.summary["gap_rate"]
+
+    @property
+    def exact(self) -> bool:
+        return self.result is not None
+
+
+# ---------------------------------------------------------------------------
+# Loading
+# ---------------------------------------------------------------------------
+
+def load_from_store(store: ClinicalStore, preset: dict) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """(patients, latest labs, active medications) for the preset's cohort.
+
+    The cohort is every patient with an active Condition for the preset.
+    """
+    ids = store.cohort(preset["snomed"], status="active")
+    labs = store.latest_observations(preset["loinc"], ids)
+    meds = store.medications(ids, status="active")
+    return _store_patients(store, ids), labs, meds[["patient_id", "name", "rxnorm"]]
+
+
+def _store_patients(store: ClinicalStore, ids: list[str]) -> pd.DataFrame:
+    """patient_id, gender, birth_date for every id; demographics are empty without a Patient record."""
+    found = store.patients(ids).rename(columns={"id": "patient_id"})[["patient_id", "gender", "birth_date"]]
+    return pd.DataFrame({"patient_id": ids}, dtype=found["patient_id"].dtype).merge(found, on="patient_id", how="left")
+
+
+def load_from_fhir(client: FHIRClient, preset: dict) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Same frames as `load_from_store`, fetched with batched FHIR searches."""
+    cohort = fhir_batch.cohort_patients(client, preset["snomed"], elements="id,gender,birthDate", status="active")
+    patients = pd.DataFrame(
+        [(p["id"], p.get("gender"), p.get("birthDate")) for p in cohort],
+        columns=["patient_id", "gender", "birth_date"],
+    )
+    ids = patients["patient_id"].tolist()
+    latest = fhir_batch.latest_observations(client, ids, preset["loinc"], code_param=preset["code_param"])
+    labs = pd.DataFrame(
+        [
+            (pid, fhir_batch.observation_value(obs, preset["loinc"]), fhir_batch.effective_date(obs))
+            for pid, obs in latest.items()
+        ],
+        columns=["patient_id", "value", "effective"],
+    )
+    meds = _active_medications(client, ids)
+    return patients, labs, meds
+
+
+def _active_medications(client: FHIRClient, ids: list[str]) -> pd.DataFrame:
+    """patient_id, name, rxnorm of the patients' active MedicationRequests."""
+    by_patient = fhir_batch.medications_by_patient(client, ids, status="active")
+    requests_ = fhir_frames.medication_requests(request for requests_ in by_patient.values() for request in requests_)
+    return requests_[["patient_id", "name", "rxnorm"]]
+
+
+def cohorts_from_store(store: ClinicalStore, presets: dict[str, dict]) -> tuple[dict[str, list[str]], pd.DataFrame]:
+    """(cohort ids per condition, patients) for the union of the presets' cohorts."""
+    cohorts = {condition: store.cohort(p["snomed"], status="active") for condition, p in presets.items()}
+    ids = sorted({pid for members in cohorts.values() for pid in members})
+    return cohorts, _store_patients(store, ids)
+
+
+def patient_data_from_store(
+    store: ClinicalStore, presets: dict[str, dict], ids: list[str]
+) -> tuple[dict[str, pd.DataFrame], pd.DataFrame]:
+    """(latest labs per LOINC, active medications) for the patients `ids`."""
+    loincs = dict.fromkeys(p["loinc"] for p in presets.values())
+    labs = {loinc: store.latest_observations(loinc, ids) for loinc in loincs}
+    meds = store.medications(ids, status="active")
+    return labs, meds[["patient_id", "name", "rxnorm"]]
+
+
+def cohorts_from_fhir(client: FHIRClient, presets: dict[str, dict]) -> tuple[dict[str, list[str]], pd.DataFrame]:
+    """Same frames as `cohorts_from_store`, from one Patient search per preset."""
+    cohorts, rows = {}, {}
+    for condition, p in presets.items():
+        members = fhir_batch.cohort_patients(client, p["snomed"], elements="id,gender,birthDate", status="active")
+        cohorts[condition] = [m["id"] for m in members]
+        rows.update((m["id"], (m["id"], m.get("gender"), m.get("birthDate"))) for m in members)
+    return cohorts, pd.DataFrame(list(rows.values()), columns=["patient_id", "gender", "birth_date"])
+
+
+def patient_data_from_fhir(
+    client: FHIRClient, presets: dict[str, dict], ids: list[str]
+) -> tuple[dict[str, pd.DataFrame], pd.DataFrame]:
+    """Same frames as `patient_data_from_store`, fetched with batched FHIR searches.
+
+    Observations for every preset's LOINC come back from one search per
+    chunk of patients. `combo-code` also matches plain codes, so it is used
+    for all of them as soon as one preset needs it.
+    """
+    code_param = "combo-code" if any(p["code_param"] == "combo-code" for p in presets.values()) else "code"
+    loincs = list(dict.fromkeys(p["loinc"] for p in presets.values()))
+    latest = fhir_batch.latest_observations_by_code(client, ids, loincs, code_param=code_param)
+    labs = {
+        loinc: pd.DataFrame(
+            [
+                (pid, fhir_batch.observation_value(obs, loinc), fhir_batch.effective_date(obs))
+                for pid, obs in by_patient.items()
+            ],
+            columns=["patient_id", "value", "effective"],
+        )
+        for loinc, by_patient in latest.items()
+    }
+    meds = _active_medications(client, ids)
+    return labs, meds
+
+
+def load_all(
+    presets: dict[str, dict], store: ClinicalStore | None = None, client: FHIRClient | None = None
+) -> tuple[dict[str, list[str]], pd.DataFrame, dict[str, pd.DataFrame], pd.DataFrame]:
+    """(cohort ids per condition, patients, latest labs per LOINC, active
+    medications) for the union of the presets' cohorts, from a store or a client."""
+    if store is not None:
+        cohorts, patients = cohorts_from_store(store, presets)
+        labs, meds = patient_data_from_store(store, presets, patients["patient_id"].tolist())
+    else:
+        cohorts, patients = cohorts_from_fhir(client, presets)
+        labs, meds = patient_data_from_fhir(client, presets, patients["patient_id"].tolist())
+    return cohorts, patients, labs, meds
+
+
+# ---------------------------------------------------------------------------
+# Evaluation
+# ---------------------------------------------------------------------------
+
+def evaluate(
+    preset: dict,
+    patients: pd.DataFrame,
+    labs: pd.DataFrame,
+    meds: pd.DataFrame,
+    as_of: date | None = None,
+) -> pd.DataFrame:
+    """One row per cohort patient with the measure's flags.
+
+    Columns: patient_id, gender, age, value, effective, in_denominator,
+    uncontrolled, on_therapy, gap. Patients without a recorded birth date
+    stay in the denominator. Patients without the lab are never gaps: the
+    gap rate covers only patients with a result, and `summarize()` reports
+    the eligible patients without one as `no_lab`.
+    """
+    as_of = pd.Timestamp(as_of or date.today())
+    frame = (
+        patients.drop_duplicates("patient_id")
+        .merge(labs[["patient_id", "value", "effective"]], on="patient_id", how="left")
+        .sort_values("patient_id", ignore_index=True)
+    )
+
+    birth = pd.to_datetime(frame["birth_date"], errors="coerce")
+    frame["age"] = np.floor((as_of - birth).dt.days / 365.25)
+    low, high = preset.get("ages") or (None, None)
+    in_band = pd.Series(True, index=frame.index)
+    if low is not None:
+        in_band &= ~(frame["age"] < low)
+    if high is not None:
+        in_band &= ~(frame["age"] > high)
+    frame["in_denominator"] = in_band
+
+    value = pd.to_numeric(frame["value"], errors="coerce")
+    frame["value"] = value
+    over = value > preset["value"] if preset["direction"] == "above" else value < preset["value"]
+    frame["uncontrolled"] = over.fillna(False) & in_band
+
+    treated = meds.loc[terminology.in_classes(meds, preset["drug_classes"]), "patient_id"]
+    frame["on_therapy"] = frame["patient_id"].isin(treated)
+    frame["gap"] = frame["uncontrolled"] & ~frame["on_therapy"]
+    return frame.drop(columns=["birth_date"])
+
+
+def evaluate_all(
+    presets: dict[str, dict],
+    cohorts: dict[str, list[str]],
+    patients: pd.DataFrame,
+    labs: dict[str, pd.DataFrame],
+    meds: pd.DataFrame,
+    as_of: date | None = None,
+) -> dict[str, pd.DataFrame]:
+    """`evaluate()` for every preset against shared frames (see `load_all`).
+
+    Rows depend only on the patient's own data, so evaluating disjoint
+    slices of `patients` and concatenating gives the same frames.
+    """
+    frames = {}
+    for condition, preset in presets.items():
+        with telemetry.span("measure.evaluate", measure=preset["measure"], condition=condition):
+            members = patients[patients["patient_id"].isin(cohorts[condition])]
+            frames[condition] = evaluate(preset, members, labs[preset["loinc"]], meds, as_of)
+    return frames
+
+
+def summarize(frame: pd.DataFrame) -> dict:
+    eligible = frame[frame["in_denominator"]]
+    with_lab = int(eligible["value"].notna().sum())
+    gaps = int(frame["gap"].sum())
+    return {
+        "cohort": len(frame),
+        "eligible": len(eligible),
+        "with_lab": with_lab,
+        "no_lab": len(eligible) - with_lab,
+        "uncontrolled": int(frame["uncontrolled"].sum()),
+        "on_therapy": int(eligible["on_therapy"].sum()),
+        "gaps": gaps,
+        "gap_rate": gaps / with_lab if with_lab else 0.0,
+    }
+
+
+def run_measure(
+    condition: str,
+    store: ClinicalStore | None = None,
+    client: FHIRClient | None = None,
+    as_of: date | None = None,
+) -> MeasureResult:
+    """Evaluate the preset for `condition` against a store or a FHIR client."""
+    if (store is None) == (client is None):
+        raise ValueError("pass exactly one of store= or client=")
+    preset = PRESET_CONDITIONS[condition]
+    t0 = time.perf_counter()
+    with telemetry.span("measure.load", source="store" if store is not None else "fhir") as attrs:
+        patients, labs, meds = load_from_store(store, preset) if store is not None else load_from_fhir(client, preset)
+        attrs.update(patients=len(patients), labs=len(labs), medications=len(meds))
+    t1 = time.perf_counter()
+    with telemetry.span("measure.evaluate", measure=preset["measure"]):
+        frame = evaluate(preset, patients, labs, meds, as_of)
+    t2 = time.perf_counter()
+    return MeasureResult(condition, preset, frame, summarize(frame), {"load": t1 - t0, "evaluate": t2 - t1})
+
+
+def run_all_measures(
+    conditions: list[str] | None = None,
+    store: ClinicalStore | None = None,
+    client: FHIRClient | None = None,
+    as_of: date | None = None,
+) -> BatchResult:
+    """Evaluate several presets (default: all of them) from one shared load."""
+    if (store is None) == (client is None):
+        raise ValueError("pass exactly one of store= or client=")
+    presets = {condition: PRESET_CONDITIONS[condition] for condition in conditions or PRESET_CONDITIONS}
+    t0 = time.perf_counter()
+    with telemetry.span("measure.load", source="store" if store is not None else "fhir", measures=len(presets)) as attrs:
+        cohorts, patients, labs, meds = load_all(presets, store, client)
+        attrs.update(patients=len(patients), labs=sum(map(len, labs.values())), medications=len(meds))
+    t1 = time.perf_counter()
+
+    results = {}
+    for condition, preset in presets.items():
+        e0 = time.perf_counter()
+        frame = evaluate_all({condition: preset}, cohorts, patients, labs, meds, as_of)[condition]
+        results[condition] = MeasureResult(
+            condition, preset, frame, summarize(frame), {"evaluate": time.perf_counter() - e0}
+        )
+    fetched = {
+        "patients": len(patients),
+        "memberships": sum(map(len, cohorts.values())),
+        "labs": sum(map(len, labs.values())),
+        "medications": len(meds),
+    }
+    return BatchResult(results, fetched, {"load": t1 - t0, "evaluate": time.perf_counter() - t1})
+
+
+def wilson_interval(successes: int, n: int, z: float = Z_95, population: float | None = None) -> tuple[float, float]:
+    """Wilson score interval for the proportion successes / n.
+
+    With `population`, the sample was drawn without replacement from that
+    many units: the interval narrows with the finite-population correction
+    and closes on the observed rate once n reaches it (0 for an empty
+    population, like `summarize`'s gap rate).
+    """
+    p = successes / n if n else 0.0
+    if population is not None and n >= population:
+        return p, p     # every unit observed: the rate is exact
+    if n == 0:
+        return 0.0, 1.0
+    if population is not None:
+        z *= math.sqrt((population - n) / (population - 1))
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def progressive_measure(
+    condition: str,
+    store: ClinicalStore | None = None,
+    client: FHIRClient | None = None,
+    as_of: date | None = None,
+    first: int = SAMPLE_START,
+    growth: float = SAMPLE_GROWTH,
+    seed: int | None = None,
+) -> Iterator[GapEstimate]:
+    """Evaluate a preset on a random sample of its cohort, then on growing batches.
+
+    The cohort (ids and demographics) is loaded up front; labs and
+    medications are fetched per batch: `first` patients, then `growth`
+    times as many each time. Each batch yields a `GapEstimate` of the gap
+    rate so far. The last one covers the whole cohort and carries the same
+    `MeasureResult` as `run_measure`. Stop iterating to stop fetching.
+    """
+    if (store is None) == (client is None):
+        raise ValueError("pass exactly one of store= or client=")
+    preset = PRESET_CONDITIONS[condition]
+    presets = {condition: preset}
+    t0 = time.perf_counter()
+    with telemetry.span("measure.load", source="store" if store is not None else "fhir", stage="cohort") as attrs:
+        cohorts, patients = cohorts_from_store(store, presets) if store is not None else cohorts_from_fhir(client, presets)
+        attrs.update(patients=len(patients))
+    order = patients.sample(frac=1, random_state=np.random.default_rng(seed), ignore_index=True)
+    timings = {"load": time.perf_counter() - t0, "evaluate": 0.0}
+
+    frames, start, size = [], 0, first
+    while True:
+        batch = order.iloc[start:start + int(size)]
+        ids = batch["patient_id"].tolist()
+        t1 = time.perf_counter()
+        with telemetry.span("measure.load", source="store" if store is not None else "fhir", patients=len(ids)):
+            labs, meds = patient_data_from_store(store, presets, ids) if store is not None else patient_data_from_fhir(client, presets, ids)
+        t2 = time.perf_counter()
+        frames.append(evaluate_all(presets, cohorts, batch, labs, meds, as_of)[condition])
+        timings["load"] += t2 - t1
+        timings["evaluate"] += time.perf_counter() - t2
+        start, size = start + len(batch), size * growth
+
+        frame = pd.concat(frames, ignore_index=True)
+        summary = summarize(frame)
+        # The gap rate's denominator is patients with the lab. Once every
+        # patient is evaluated that count is exact; before that, scale the
+        # sample's count up to the cohort for the finite-population correction
+        # (with none yet there is nothing to scale, and the interval stays open).
+        done = start >= len(order)
+        if done:
+            with_lab = summary["with_lab"]
+        else:
+            with_lab = summary["with_lab"] * len(order) / start if summary["with_lab"] else None
+        low, high = wilson_interval(summary["gaps"], summary["with_lab"], population=with_lab)
+        elapsed = time.perf_counter() - t0
+        result = None
+        if done:
+            frame = frame.sort_values("patient_id", ignore_index=True)
+            result = MeasureResult(condition, preset, frame, summary, timings)
+        yield GapEstimate(condition, start, len(order), summary, low, high, elapsed, result)
+        if result is not None:
+            return
+
+
+# ---------------------------------------------------------------------------
+# Output
+# ---------------------------------------------------------------------------
+
+def _pct(n: int, d: int) -> str:
+    return f"{n}/{d} ({n / d:.1%})" if d else f"{n}/0"
+
+
+def report(result: MeasureResult, max_listed: int = 25) -> str:
+    """Plain-text summary matching what the generated scripts used to print."""
+    p, s = result.preset, result.summary
+    lab = p["lab"]
+    op = ">" if p["direction"] == "above" else "<"
+    low, high = p.get("ages") or (None, None)
+    band = f"aged {low or 0}-{high}" if high else f"aged {low}+" if low else "all ages"
+    title = f"{p['measure']} -- {result.condition}" if p["measure"] else result.condition
+    lines = [
+        title,
+        "=" * len(title),
+        f"Cohort (SNOMED {p['snomed']}): {s['cohort']} patients, {s['eligible']} {band}",
+        f"With a {lab} result: {_pct(s['with_lab'], s['eligible'])}",
+        f"No {lab} result: {_pct(s['no_lab'], s['eligible'])} (not counted in the gap rate)",
+        f"{lab} {op} {p['value']:g} {p['unit']}: {_pct(s['uncontrolled'], s['with_lab'])}",
+        f"On {p['gap_meds']}: {_pct(s['on_therapy'], s['eligible'])}",
+        f"Care gaps ({lab} {op} {p['value']:g} and not on {p['gap_meds']}): {_pct(s['gaps'], s['with_lab'])}",
+        "",
+    ]
+    gaps = result.gaps
+    if len(gaps):
+        lines.append("Patients that may warrant review:")
+        for row in gaps.head(max_listed).itertuples():
+            lines.append(f"  {row.patient_id}  {lab} {row.value:g} {p['unit']}  ({str(row.effective)[:10]})")
+        if len(gaps) > max_listed:
+            lines.append(f"  ... and {len(gaps) - max_listed} more")
+        lines.append("")
+    lines.append(
+        f"Summary: {s['gaps']} of {s['with_lab']} patients with {result.condition.lower()} and a recent "
+        f"{lab} have a value {'above' if op == '>' else 'below'} {p['threshold'].removeprefix('below ')} "
+        f"without {p['gap_meds']} on record. {s['no_lab']} eligible patients have no {lab} result "
+        "and are not counted as gaps."
+    )
+    lines.append(DISCLAIMER)
+    return "\n".join(lines)
+
+
+def batch_report(batch: BatchResult, max_listed: int = 25) -> str:
+    """Overview table of every measure in the batch, then each measure's report."""
+    f = batch.fetched
+    lines = [
+        "Quality gap analysis -- all measures",
+        "=" * 36,
+        f"{f['patients']} unique patients across {len(batch.results)} cohorts "
+        f"({f['memberships']} cohort memberships), each fetched once",
+        "Gap rates are of patients with a lab result; patients without one are not counted as gaps.",
+        "",
+        f"{'Condition':<26} {'Measure':<8} {'Eligible':>8} {'With lab':>8} {'No lab':>8} {'Gaps':>6} {'Gap rate':>8}",
+    ]
+    for condition, result in batch.results.items():
+        s = result.summary
+        lines.append(
+            f"{condition:<26} {result.preset['measure'] or '--':<8} {s['eligible']:>8} "
+            f"{s['with_lab']:>8} {s['no_lab']:>8} {s['gaps']:>6} {s['gap_rate']:>8.1%}"
+        )
+    for result in batch.results.values():
+        body = report(result, max_listed).removesuffix(DISCLAIMER).rstrip()
+        lines += ["", body]
+    lines += ["", DISCLAIMER]
+    return "\n".join(lines)
+
+
+def chart(result: MeasureResult, path: str) -> str:
+    """Histogram of the lab distribution with the threshold marked; returns `path`."""
+    from matplotlib.figure import Figure  # no pyplot: safe off the main thread
+
+    p = result.preset
+    values = result.frame.loc[result.frame["in_denominator"], "value"].dropna()
+    fig = Figure(figsize=(8, 4.5))
+    ax = fig.subplots()
+    ax.hist(values, bins=min(30, max(5, len(values) // 3)), color="#76B900", edgecolor="#1a1a1a")
+    ax.axvline(p["value"], color="#e5484d", linestyle="--", label=f"threshold {p['value']:g} {p['unit']}")
+    ax.set_xlabel(f"{p['lab']} ({p['unit']})")
+    ax.set_ylabel("Patients")
+    ax.set_title(f"{result.condition}: latest {p['lab']} (n={len(values)})")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(path, dpi=120)
+    return path
@@ -0,0 +1,158 @@
+"""
+Lab reference ranges by LOINC, and vectorized abnormal-value flagging.
+
+`RANGES` is the reference table from skills/clinical-knowledge, keyed by the
+LOINC codes in skills/fhir-basics, with sex-specific rows where the table
+has them. `flag()` joins a whole observations frame against it and adds the
+flags in one vectorized pass, instead of per-row if/else logic.
+
+    import reference_ranges
+
+    obs = store.observations(patient_id)                  # code, value, unit, effective, ...
+    flagged = reference_ranges.flag(obs, sex="female")    # + lab, reference, flag, concerning
+    flagged[flagged["flag"].isin(["high", "low"])]
+
+    rows = fhir_frames.search(client, "Observation", {"patient": pid})
+    reference_ranges.flag(rows, sex=patient["gender"])
+
+A `gender` column (e.g. after merging `store.patients()`) is used per row
+instead of `sex=`. For patients with no recorded sex, a sex-specific lab is
+flagged only when the value is outside the ranges of both sexes. Values are
+compared in the table's unit.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# (LOINC, lab, unit, sex, normal, concerning), as written in the skill's
+# table. "<7.0" means normal below 7.0, "70-100" an inclusive range, ">60"
+# normal above 60; a concerning value is beyond the concerning bound.
+RANGES = [
+    ("4548-4", "HbA1c", "%", None, "<7.0", ">9.0"),
+    ("2345-7", "Glucose", "mg/dL", None, "70-100", ">126"),
+    ("1558-6", "Fasting Glucose", "mg/dL", None, "70-100", ">126"),
+    ("2160-0", "Creatinine", "mg/dL", "male", "0.7-1.3", ">1.5"),
+    ("2160-0", "Creatinine", "mg/dL", "female", "0.6-1.1", ">1.5"),
+    ("33914-3", "eGFR", "mL/min/1.73m2", None, ">60", "<30"),
+    ("2093-3", "Total Cholesterol", "mg/dL", None, "<200", ">240"),
+    ("18262-6", "LDL", "mg/dL", None, "<100", ">160"),
+    ("2085-9", "HDL", "mg/dL", "male", ">40", "<40"),
+    ("2085-9", "HDL", "mg/dL", "female", ">50", "<40"),
+    ("8480-6", "Systolic BP", "mmHg", None, "<120", ">140"),
+    ("8462-4", "Diastolic BP", "mmHg", None, "<80", ">90"),
+]
+
+SEXES = ("male", "female", "")   # "" = not recorded
+FLAGS = ["low", "normal", "high"]
+
+
+def _bounds(spec: str) -> tuple[float, float, bool, bool]:
+    """(low, high, low_inclusive, high_inclusive) of a normal-range spec."""
+    if spec.startswith("<"):
+        return -math.inf, float(spec[1:]), True, False
+    if spec.startswith(">"):
+        return float(spec[1:]), math.inf, False, True
+    low, high = spec.split("-")
+    return float(low), float(high), True, True
+
+
+def _table(ranges: list[tuple]) -> pd.DataFrame:
+    """One row per (LOINC, sex), including sex "" for patients with no recorded sex."""
+    rows = []
+    for loinc, lab, unit, sex, normal, concerning in ranges:
+        low, high, low_inc, high_inc = _bounds(normal)
+        c_low, c_high = (float(concerning[1:]), math.inf) if concerning.startswith("<") else (-math.inf, float(concerning[1:]))
+        rows.append({
+            "code": loinc, "sex": sex, "lab": lab, "reference": f"{normal} {unit}", "low": low, "high": high,
+            "low_inclusive": low_inc, "high_inclusive": high_inc, "concerning_low": c_low, "concerning_high": c_high,
+        })
+    table = pd.DataFrame(rows)
+
+    shared = table[table["sex"].isna()]
+    expanded = [shared.assign(sex=sex) for sex in SEXES]
+    # Sex-specific labs for an unknown sex: normal if normal for either sex.
+    specific = table[table["sex"].notna()]
+    if len(specific):
+        expanded.append(specific)
+        widest = specific.groupby("code", as_index=False).agg({
+            "lab": "first", "low": "min", "high": "max", "low_inclusive": "max", "high_inclusive": "max",
+            "concerning_low": "min", "concerning_high": "max",
+            "reference": lambda refs: " / ".join(f"{ref} ({sex})" for ref, sex in zip(refs, specific.loc[refs.index, "sex"])),
+        })
+        expanded.append(widest.assign(sex=""))
+    return pd.concat(expanded, ignore_index=True)
+
+
+TABLE = _table(RANGES)
+_ROW = {(c, sex): i for i, (c, sex) in enumerate(zip(TABLE["code"], TABLE["sex"]))}
+# Text columns are returned as categoricals: (categories, code of each TABLE row).
+_CATEGORIES = {name: pd.factorize(TABLE[name])[::-1] for name in ("lab", "reference")}
+
+
+def _sex(value) -> str:
+    value = value.lower() if isinstance(value, str) else ""
+    return value if value in SEXES else ""
+
+
+def reference(loinc: str, sex: str | None = None) -> dict | None:
+    """The range row for one LOINC and sex, or None when the lab has no range."""
+    i = _ROW.get((loinc, _sex(sex)))
+    return None if i is None else TABLE.iloc[i].to_dict()
+
+
+def flag(
+    obs: pd.DataFrame,
+    sex: str | None = None,
+    code: str = "code",
+    value: str = "value",
+    gender: str = "gender",
+) -> pd.DataFrame:
+    """Copy of `obs` with `lab`, `reference`, `flag` and `concerning` columns.
+
+    `flag` is a categorical of "low", "normal" or "high", missing when the
+    code has no reference range or the value is missing. `concerning` marks
+    values beyond the table's concerning threshold (e.g. HbA1c > 9%).
+    """
+    # Resolve each distinct (code, sex) to a TABLE row once, then gather
+    # every range column for all rows by position; -1 = no range.
+    code_idx, codes = pd.factorize(obs[code])
+    if gender in obs:
+        sex_idx, sexes = pd.factorize(obs[gender])
+    else:
+        sex_idx, sexes = np.zeros(len(obs), dtype=np.intp), [sex]
+    # factorize marks missing values -1, which picks the trailing None entries.
+    lookup = np.array(
+        [[_ROW.get((str(c).rsplit("|", 1)[-1], _sex(s)), -1) for s in [*sexes, None]] for c in [*codes, None]],
+        dtype=np.intp,
+    )
+    row = lookup[code_idx, sex_idx]
+
+    def column(name: str, missing):
+        return np.append(TABLE[name].to_numpy(), [missing])[row]
+
+    def categorical(name: str) -> pd.Categorical:
+        categories, codes = _CATEGORIES[name]
+        return pd.Categorical.from_codes(np.append(codes, -1)[row], categories)
+
+    v = pd.to_numeric(obs[value], errors="coerce").to_numpy(dtype=float)
+    has = ~np.isnan(v) & (row >= 0)
+    low, high = column("low", np.nan).astype(float), column("high", np.nan).astype(float)
+    with np.errstate(invalid="ignore"):
+        is_low = np.where(column("low_inclusive", True).astype(bool), v < low, v <= low)
+        is_high = np.where(column("high_inclusive", True).astype(bool), v > high, v >= high)
+        concerning = (v < column("concerning_low", np.nan).astype(float)) | (v > column("concerning_high", np.nan).astype(float))
+
+    out = obs.copy()
+    out["lab"] = categorical("lab")
+    out["reference"] = categorical("reference")
+    out["flag"] = pd.Categorical.from_codes(np.select([~has, is_low, is_high], [-1, 0, 2], default=1), FLAGS)
+    out["concerning"] = has & concerning
+    return out
+
+
+def abnormal(obs: pd.DataFrame, **kwargs) -> pd.DataFrame:
+    """Only the flagged rows (high or low) of `flag(obs, ...)`."""
+    flagged = flag(obs, **kwargs)
+    return flagged[flagged["flag"].isin(["high", "low"])]
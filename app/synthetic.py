@@ -0,0 +1,280 @@
+"""
+Synthetic FHIR population generator for benchmarks and load tests.
+
+Produces Patient, Condition, Observation and MedicationRequest resources
+shaped like the Synthea records in `fallback-data/` (same coding systems,
+references, meta tags and value types), with the conditions, labs and drugs
+the preset measures look at. Generation is streamed and deterministic: a
+given (`n_patients`, `seed`) always yields the same resources, and patient
+`i` does not depend on how many patients come before it, so large cohorts
+can be generated in shards.
+
+    from synthetic import generate, write_ndjson
+
+    for resource in generate(1_000, seed=7):
+        ...
+    write_ndjson("/tmp/synthetic-10k", 10_000)   # {"Patient": 10000, ...}
+
+The NDJSON directory loads into `clinical_store.ClinicalStore.ingest_dir()`
+and `fhir_server.ResourceIndex.load_dir()`. From the command line:
+
+    python app/synthetic.py 100k --out /tmp/synthetic-100k
+"""
+
+import argparse
+import json
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator
+
+SIZES = {"k": 1_000, "m": 1_000_000}
+RESOURCE_TYPES = ["Patient", "Condition", "Observation", "MedicationRequest"]
+
+SNOMED = "http://snomed.info/sct"
+LOINC = "http://loinc.org"
+RXNORM = "http://www.nlm.nih.gov/research/umls/rxnorm"
+SYNTHEA_ID = "https://github.com/synthetichealth/synthea"
+MRN_SYSTEM = "http://hospital.smarthealthit.org"
+META_TAG = [{"system": "https://smarthealthit.org/tags", "code": "synthea-5-2019"}]
+
+# Generated records are dated relative to this, not to the wall clock, so a
+# seed reproduces the same data on any day.
+REFERENCE_DATE = datetime(2026, 1, 1, 9, 0, tzinfo=timezone.utc)
+
+# (SNOMED code, display, base prevalence). Comorbidities raise the
+# prevalence of later conditions, roughly as in a primary-care population.
+CONDITIONS = [
+    ("44054006", "Diabetes mellitus type 2 (disorder)", 0.10),
+    ("38341003", "Hypertension", 0.30),
+    ("84114007", "Heart failure (disorder)", 0.03),
+    ("40055000", "Chronic kidney disease stage 3 (disorder)", 0.05),
+]
+
+# Lab per condition: (LOINC, display, unit, value sampler). Patients without
+# the condition get a normal-range value at a lower rate.
+LABS = {
+    "44054006": ("4548-4", "Hemoglobin A1c/Hemoglobin.total in Blood", "%",
+                 lambda r: min(max(r.gauss(7.9, 1.6), 5.0), 14.0)),
+    "40055000": ("33914-3", "Glomerular filtration rate/1.73 sq M.predicted", "mL/min/{1.73_m2}",
+                 lambda r: r.uniform(12, 59)),
+    "84114007": ("42637-9", "Natriuretic peptide B [Mass/volume] in Blood", "pg/mL",
+                 lambda r: r.lognormvariate(5.8, 0.7)),
+}
+NORMAL_LABS = {
+    "44054006": lambda r: r.uniform(4.6, 5.9),
+    "40055000": lambda r: r.uniform(60, 120),
+}
+
+# (RxNorm code, display, probability) per condition.
+MEDICATIONS = {
+    "44054006": [
+        ("860975", "24 HR Metformin hydrochloride 500 MG Extended Release Oral Tablet", 0.70),
+        ("311041", "Insulin Glargine 100 UNT/ML Injectable Solution", 0.25),
+        ("1991306", "Semaglutide 1.34 MG/ML Pen Injector", 0.15),
+    ],
+    "38341003": [
+        ("314076", "lisinopril 10 MG Oral Tablet", 0.35),
+        ("197361", "Amlodipine 5 MG Oral Tablet", 0.25),
+        ("316049", "Hydrochlorothiazide 25 MG", 0.25),
+        ("979485", "losartan potassium 50 MG Oral Tablet", 0.15),
+    ],
+    "84114007": [
+        ("866924", "Metoprolol Tartrate 25 MG Oral Tablet", 0.55),
+        ("1656340", "sacubitril 49 MG / valsartan 51 MG Oral Tablet", 0.25),
+        ("313988", "Furosemide 40 MG Oral Tablet", 0.50),
+    ],
+    "40055000": [
+        ("979485", "losartan potassium 50 MG Oral Tablet", 0.40),
+    ],
+}
+
+GIVEN = {
+    "male": ["Omar", "James", "Luis", "Wei", "Daniel", "Ahmed", "Robert", "Kenji"],
+    "female": ["Maria", "Aisha", "Emily", "Mei", "Sofia", "Grace", "Linda", "Priya"],
+}
+FAMILY = ["Abernathy", "Garcia", "Nguyen", "Smith", "Okafor", "Kowalski", "Patel", "Johnson", "Kim", "Rossi"]
+
+
+def parse_size(size: str | int) -> int:
+    """Patient count from `1000`, `"10k"` or `"1m"`."""
+    if isinstance(size, int):
+        return size
+    size = size.strip().lower().replace("_", "")
+    if size[-1:] in SIZES:
+        return int(float(size[:-1]) * SIZES[size[-1]])
+    return int(size)
+
+
+# ---------------------------------------------------------------------------
+# Generation
+# ---------------------------------------------------------------------------
+
+def _uuid(rnd: random.Random) -> str:
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def _timestamp(rnd: random.Random, max_days: int, min_days: int = 0) -> str:
+    when = REFERENCE_DATE - timedelta(days=rnd.randint(min_days, max_days), seconds=rnd.randint(0, 86399))
+    return when.isoformat()
+
+
+def _meta(rnd: random.Random) -> dict:
+    return {"versionId": str(rnd.randint(1, 200)), "lastUpdated": _timestamp(rnd, 900), "tag": META_TAG}
+
+
+def _concept(system: str, code: str, display: str) -> dict:
+    return {"coding": [{"system": system, "code": code, "display": display}], "text": display}
+
+
+def _patient(rnd: random.Random, pid: str) -> dict:
+    gender = rnd.choice(("male", "female"))
+    mrn = _uuid(rnd)
+    birth = REFERENCE_DATE.date() - timedelta(days=rnd.randint(18 * 365, 95 * 365))
+    return {
+        "resourceType": "Patient",
+        "id": pid,
+        "meta": _meta(rnd),
+        "identifier": [
+            {"system": SYNTHEA_ID, "value": mrn},
+            {
+                "type": _concept("http://terminology.hl7.org/CodeSystem/v2-0203", "MR", "Medical Record Number"),
+                "system": MRN_SYSTEM,
+                "value": mrn,
+            },
+        ],
+        "name": [{"use": "official", "family": rnd.choice(FAMILY), "given": [rnd.choice(GIVEN[gender])]}],
+        "gender": gender,
+        "birthDate": birth.isoformat(),
+    }
+
+
+def _condition(rnd: random.Random, pid: str, code: str, display: str) -> dict:
+    return {
+        "resourceType": "Condition",
+        "id": _uuid(rnd),
+        "meta": _meta(rnd),
+        "clinicalStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-clinical", "code": "active"}]},
+        "verificationStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-ver-status", "code": "confirmed"}]},
+        "code": _concept(SNOMED, code, display),
+        "subject": {"reference": f"Patient/{pid}"},
+        "onsetDateTime": _timestamp(rnd, 20 * 365, 365),
+    }
+
+
+def _observation(rnd: random.Random, pid: str, code: str, display: str, category: str, **value) -> dict:
+    effective = _timestamp(rnd, 3 * 365)
+    return {
+        "resourceType": "Observation",
+        "id": _uuid(rnd),
+        "meta": _meta(rnd),
+        "status": "final",
+        "category": [{"coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": category, "display": category,
+        }]}],
+        "code": _concept(LOINC, code, display),
+        "subject": {"reference": f"Patient/{pid}"},
+        "effectiveDateTime": effective,
+        "issued": effective,
+        **value,
+    }
+
+
+def _quantity(value: float, unit: str) -> dict:
+    return {"value": round(value, 1), "unit": unit, "system": "http://unitsofmeasure.org", "code": unit}
+
+
+def _blood_pressure(rnd: random.Random, pid: str, hypertensive: bool) -> dict:
+    systolic = rnd.gauss(145, 16) if hypertensive else rnd.gauss(120, 10)
+    diastolic = systolic * rnd.uniform(0.58, 0.7)
+    return _observation(rnd, pid, "55284-4", "Blood Pressure", "vital-signs", component=[
+        {"code": _concept(LOINC, "8462-4", "Diastolic Blood Pressure"), "valueQuantity": _quantity(diastolic, "mm[Hg]")},
+        {"code": _concept(LOINC, "8480-6", "Systolic Blood Pressure"), "valueQuantity": _quantity(systolic, "mm[Hg]")},
+    ])
+
+
+def _medication_request(rnd: random.Random, pid: str, code: str, display: str, status: str) -> dict:
+    return {
+        "resourceType": "MedicationRequest",
+        "id": _uuid(rnd),
+        "meta": _meta(rnd),
+        "status": status,
+        "intent": "order",
+        "medicationCodeableConcept": _concept(RXNORM, code, display),
+        "subject": {"reference": f"Patient/{pid}"},
+        "authoredOn": _timestamp(rnd, 5 * 365),
+    }
+
+
+def patient_resources(index: int, seed: int = 0) -> list[dict]:
+    """Every resource for synthetic patient number `index` (Patient first)."""
+    rnd = random.Random(seed * 1_000_003 + index)
+    pid = _uuid(rnd)
+    resources = [_patient(rnd, pid)]
+
+    conditions = []
+    for code, display, prevalence in CONDITIONS:
+        if rnd.random() < prevalence * (1 + len(conditions)):
+            conditions.append(code)
+            resources.append(_condition(rnd, pid, code, display))
+
+    for _ in range(rnd.randint(1, 3)):
+        resources.append(_blood_pressure(rnd, pid, "38341003" in conditions))
+    for code in conditions:
+        if code in LABS:
+            loinc, display, unit, sample = LABS[code]
+            for _ in range(rnd.randint(1, 3)):
+                resources.append(_observation(rnd, pid, loinc, display, "laboratory", valueQuantity=_quantity(sample(rnd), unit)))
+    for code, sample in NORMAL_LABS.items():
+        if code not in conditions and rnd.random() < 0.3:
+            loinc, display, unit, _ = LABS[code]
+            resources.append(_observation(rnd, pid, loinc, display, "laboratory", valueQuantity=_quantity(sample(rnd), unit)))
+
+    prescribed = set()
+    for code in conditions:
+        for rxnorm, display, probability in MEDICATIONS.get(code, []):
+            if rxnorm not in prescribed and rnd.random() < probability:
+                prescribed.add(rxnorm)
+                status = "active" if rnd.random() < 0.85 else "stopped"
+                resources.append(_medication_request(rnd, pid, rxnorm, display, status))
+    return resources
+
+
+def generate(n_patients: int, seed: int = 0, start: int = 0) -> Iterator[dict]:
+    """Stream the resources of patients `start` .. `start + n_patients - 1`."""
+    for index in range(start, start + n_patients):
+        yield from patient_resources(index, seed)
+
+
+def write_ndjson(out_dir: str | Path, n_patients: int, seed: int = 0) -> dict[str, int]:
+    """Write one `<ResourceType>.ndjson` file per type; returns resource counts."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = {rtype: open(out_dir / f"{rtype}.ndjson", "w") for rtype in RESOURCE_TYPES}
+    counts = dict.fromkeys(RESOURCE_TYPES, 0)
+    try:
+        for resource in generate(n_patients, seed):
+            rtype = resource["resourceType"]
+            files[rtype].write(json.dumps(resource, separators=(",", ":")) + "\n")
+            counts[rtype] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic FHIR population as NDJSON")
+    parser.add_argument("size", help="number of patients, e.g. 1000, 10k, 1m")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = write_ndjson(args.out, parse_size(args.size), args.seed)
+    for rtype, count in counts.items():
+        print(f"{rtype:<18} {count:>10,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Tracing spans and counters for workflow runs.
+
+A trace collects timed spans (LLM prefill and generation, FHIR requests,
+script execution, measure loading, chart rendering, ...) and counters (FHIR
+requests, bytes and pages, LLM tokens) for one workflow run. Counters also
+accumulate in the process-wide `METRICS` registry, so throughput across every
+user of a workbench can be scraped as Prometheus text.
+
+    import telemetry
+
+    with telemetry.trace("case summary") as t:
+        with telemetry.span("llm", model=model):
+            ...
+        telemetry.count("fhir_requests_total", endpoint=url)
+    t.spans                      # [{"name": "llm", "duration_ms": 812.4, ...}]
+    t.to_jsonl()                 # one JSON line per span, then one for the trace
+    telemetry.METRICS.prometheus()
+
+Spans and counters recorded outside a trace still update `METRICS`. Code run
+on a thread pool joins the caller's trace when the pool is given
+`telemetry.bind(fn)` instead of `fn`. Scripts executed by `exec_pool` run
+inside their own trace, which the pool ships back to be merged into the
+caller's with `absorb()`.
+
+Set `CLINICAL_METRICS_PORT` to serve `/metrics` from the workbench, and
+`CLINICAL_TRACE_LOG` to append every finished trace to a JSONL file.
+"""
+
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+PREFIX = "clinical_"
+MAX_SPANS = 5000   # per trace; a runaway per-patient loop should not eat memory
+
+_log_lock = threading.Lock()
+
+
+def _span_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Thread-safe registry of monotonically increasing counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, tuple], float] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def total(self, name: str, **labels) -> float:
+        """Sum of `name` across every label set matching `labels`."""
+        wanted = set(_labels(labels))
+        with self._lock:
+            return sum(v for (n, lbl), v in self._counters.items() if n == name and wanted <= set(lbl))
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            items = sorted(self._counters.items())
+        return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in items]
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+    def prometheus(self) -> str:
+        """Counters in the Prometheus text exposition format."""
+        lines, typed = [], set()
+        for c in self.snapshot():
+            name = PREFIX + c["name"]
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            labels = ",".join(f'{k}="{_escape(v)}"' for k, v in c["labels"].items())
+            value = int(c["value"]) if float(c["value"]).is_integer() else c["value"]
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class Trace:
+    """Spans and counters of one workflow run."""
+
+    def __init__(self, name: str, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration_ms: float | None = None
+        self.spans: list[dict] = []
+        self.dropped = 0
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Trace":
+        """Rebuild a trace saved with `to_dict()` (e.g. from a persisted job)."""
+        t = cls(data["name"], **data["attrs"])
+        t.trace_id, t.start, t.duration_ms = data["trace_id"], data["start"], data["duration_ms"]
+        t.spans, t.dropped = list(data["spans"]), data["dropped_spans"]
+        for c in data["counters"]:
+            t.metrics.inc(c["name"], c["value"], **c["labels"])
+        return t
+
+    def finish(self, log_path: str | None = None):
+        """Close the trace: fix its duration, count the run and optionally log it."""
+        self.duration_ms = (time.time() - self.start) * 1000
+        METRICS.inc("workflows_total", workflow=self.name)
+        METRICS.inc("workflow_seconds_total", self.duration_ms / 1000, workflow=self.name)
+        if log_path:
+            with _log_lock, open(log_path, "a") as f:
+                f.write(self.to_jsonl())
+
+    def add(self, span: dict):
+        with self._lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.trace_id, "name": self.name, "attrs": self.attrs, "start": self.start,
+            "duration_ms": self.duration_ms, "spans": spans, "dropped_spans": self.dropped,
+            "counters": self.metrics.snapshot(),
+        }
+
+    def to_jsonl(self) -> str:
+        data = self.to_dict()
+        lines = [json.dumps({"type": "span", "trace_id": self.trace_id, "trace": self.name, **s}) for s in data.pop("spans")]
+        lines.append(json.dumps({"type": "trace", **data}))
+        return "\n".join(lines) + "\n"
+
+    def rows(self) -> list[dict]:
+        """Spans in start order with their nesting depth, for display."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        depth = {}
+        rows = []
+        for s in spans:
+            depth[s["span_id"]] = depth.get(s["parent_id"], -1) + 1
+            rows.append({
+                "span": "  " * depth[s["span_id"]] + s["name"],
+                "start_ms": round((s["start"] - self.start) * 1000, 1),
+                "duration_ms": round(s["duration_ms"], 1),
+                "attrs": ", ".join(f"{k}={v}" for k, v in s["attrs"].items()),
+            })
+        return rows
+
+
+_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+_parent: contextvars.ContextVar[str | None] = contextvars.ContextVar("span_parent", default=None)
+
+
+def current() -> Trace | None:
+    return _trace.get()
+
+
+@contextmanager
+def activate(t: Trace):
+    """Record into an existing trace (e.g. one job's trace across worker threads)."""
+    trace_token, parent_token = _trace.set(t), _parent.set(None)
+    try:
+        yield t
+    finally:
+        _trace.reset(trace_token)
+        _parent.reset(parent_token)
+
+
+@contextmanager
+def trace(name: str, log_path: str | None = None, **attrs):
+    """Collect every span and counter recorded in this context into a new `Trace`.
+
+    With `log_path`, the finished trace is appended to that JSONL file.
+    """
+    t = Trace(name, **attrs)
+    try:
+        with activate(t):
+            yield t
+    finally:
+        t.finish(log_path)
+
+
+def _record(span: dict) -> dict:
+    METRICS.inc("spans_total", span=span["name"])
+    METRICS.inc("span_seconds_total", span["duration_ms"] / 1000, span=span["name"])
+    t = _trace.get()
+    if t is not None:
+        t.add(span)
+    return span
+
+
+def add_span(name: str, start: float, duration: float, **attrs) -> dict:
+    """Record an already-measured span (`start` is epoch seconds)."""
+    return _record({
+        "span_id": _span_id(), "parent_id": _parent.get(), "name": name,
+        "start": start, "duration_ms": duration * 1000, "attrs": attrs,
+    })
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time the enclosed block as a span; yields its attrs dict for late additions."""
+    span_id = _span_id()
+    token = _parent.set(span_id)
+    start, t0 = time.time(), time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _parent.reset(token)
+        _record({
+            "span_id": span_id, "parent_id": _parent.get(), "name": name,
+            "start": start, "duration_ms": (time.perf_counter() - t0) * 1000, "attrs": attrs,
+        })
+
+
+def count(name: str, value: float = 1, **labels):
+    """Increment a counter globally and in the current trace."""
+    METRICS.inc(name, value, **labels)
+    t = _trace.get()
+    if t is not None:
+        t.metrics.inc(name, value, **labels)
+
+
+def bind(fn: Callable) -> Callable:
+    """`fn` wrapped to run in the caller's trace, for use on thread pools."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+
+def absorb(data: dict | None):
+    """Merge a trace exported with `Trace.to_dict()` (e.g. from a worker process) into the current one."""
+    if not data:
+        return
+    parent = _parent.get()
+    for s in data["spans"]:
+        _record({**s, "parent_id": s["parent_id"] or parent})
+    for c in data["counters"]:
+        count(c["name"], c["value"], **c["labels"])
+
+
+# ---------------------------------------------------------------------------
+# /metrics endpoint
+# ---------------------------------------------------------------------------
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            return self.send_error(404)
+        body = METRICS.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve `METRICS` at http://host:port/metrics on a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,229 @@
+"""
+Medication terminology: drug classes by RxNorm code and by name.
+
+`DRUG_CLASSES` lists the ingredients of each class (see
+skills/clinical-knowledge), `BRAND_NAMES` common brands, and
+`RXNORM_CLASSES` the classes of RxNorm ingredient and clinical-drug codes.
+Free-text names are matched against every ingredient and brand at once by a
+precompiled Aho-Corasick automaton, so one scan of a name finds all of its
+classes (combination products such as sacubitril/valsartan get both). Each
+unique name is scanned once and memoized; the DataFrame helpers look up the
+unique names and codes of a column and broadcast the result to every row.
+
+    import terminology
+
+    terminology.classify("sacubitril 49 MG / valsartan 51 MG Oral Tablet")   # frozenset({"arni", "arb"})
+    terminology.classify("", code="860975")                                 # frozenset({"biguanide"})
+
+    meds = store.medications(ids)                   # patient_id, name, rxnorm, ...
+    flags = terminology.class_frame(meds)           # one bool column per class
+    on_raas = terminology.in_classes(meds, ["ace_inhibitor", "arb"])
+"""
+
+import threading
+from collections import defaultdict, deque
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+# Ingredient names per drug class (see skills/clinical-knowledge). A name
+# matches at the start of a word, so "insulin" also covers "insulins".
+DRUG_CLASSES = {
+    "insulin": ["insulin"],
+    "glp1_agonist": ["liraglutide", "semaglutide", "dulaglutide", "exenatide", "lixisenatide", "tirzepatide"],
+    "biguanide": ["metformin"],
+    "sulfonylurea": ["glipizide", "glyburide", "glimepiride"],
+    "sglt2_inhibitor": ["empagliflozin", "dapagliflozin", "canagliflozin", "ertugliflozin"],
+    "dpp4_inhibitor": ["sitagliptin", "saxagliptin", "linagliptin", "alogliptin"],
+    "thiazolidinedione": ["pioglitazone", "rosiglitazone"],
+    "ace_inhibitor": ["lisinopril", "enalapril", "ramipril", "captopril", "benazepril", "quinapril", "fosinopril"],
+    "arb": ["losartan", "valsartan", "irbesartan", "candesartan", "olmesartan", "telmisartan"],
+    "arni": ["sacubitril"],
+    "beta_blocker": ["metoprolol", "atenolol", "carvedilol", "bisoprolol", "propranolol", "nebivolol"],
+    "ccb": ["amlodipine", "nifedipine", "diltiazem", "verapamil", "felodipine"],
+    "diuretic": ["hydrochlorothiazide", "chlorthalidone", "indapamide", "furosemide", "spironolactone", "eplerenone"],
+    "statin": ["atorvastatin", "rosuvastatin", "simvastatin", "pravastatin", "lovastatin", "pitavastatin"],
+}
+
+BRAND_NAMES = {
+    "lantus": ["insulin"], "levemir": ["insulin"], "tresiba": ["insulin"], "humalog": ["insulin"], "novolog": ["insulin"],
+    "ozempic": ["glp1_agonist"], "wegovy": ["glp1_agonist"], "victoza": ["glp1_agonist"],
+    "trulicity": ["glp1_agonist"], "mounjaro": ["glp1_agonist"],
+    "jardiance": ["sglt2_inhibitor"], "farxiga": ["sglt2_inhibitor"], "januvia": ["dpp4_inhibitor"],
+    "entresto": ["arni", "arb"],
+    "lipitor": ["statin"], "crestor": ["statin"], "zocor": ["statin"],
+}
+
+# RxNorm ingredients, and the clinical drugs that appear in Synthea data.
+RXNORM_CLASSES = {
+    "274783": ["insulin"],                  # insulin glargine
+    "311041": ["insulin"],                  # insulin glargine 100 UNT/ML Injectable Solution
+    "475968": ["glp1_agonist"],             # liraglutide
+    "1991302": ["glp1_agonist"],            # semaglutide
+    "1991306": ["glp1_agonist"],            # semaglutide 1.34 MG/ML Pen Injector
+    "6809": ["biguanide"],                  # metformin
+    "860975": ["biguanide"],                # 24 HR metformin hydrochloride 500 MG Extended Release Oral Tablet
+    "29046": ["ace_inhibitor"],             # lisinopril
+    "314076": ["ace_inhibitor"],            # lisinopril 10 MG Oral Tablet
+    "3827": ["ace_inhibitor"],              # enalapril
+    "35296": ["ace_inhibitor"],             # ramipril
+    "52175": ["arb"],                       # losartan
+    "979485": ["arb"],                      # losartan potassium 50 MG Oral Tablet
+    "69749": ["arb"],                       # valsartan
+    "1656340": ["arni", "arb"],             # sacubitril 49 MG / valsartan 51 MG Oral Tablet
+    "6918": ["beta_blocker"],               # metoprolol
+    "866924": ["beta_blocker"],             # metoprolol tartrate 25 MG Oral Tablet
+    "1202": ["beta_blocker"],               # atenolol
+    "20352": ["beta_blocker"],              # carvedilol
+    "17767": ["ccb"],                       # amlodipine
+    "197361": ["ccb"],                      # amlodipine 5 MG Oral Tablet
+    "5487": ["diuretic"],                   # hydrochlorothiazide
+    "316049": ["diuretic"],                 # hydrochlorothiazide 25 MG
+    "4603": ["diuretic"],                   # furosemide
+    "313988": ["diuretic"],                 # furosemide 40 MG Oral Tablet
+    "9997": ["diuretic"],                   # spironolactone
+    "83367": ["statin"],                    # atorvastatin
+    "301542": ["statin"],                   # rosuvastatin
+    "36567": ["statin"],                    # simvastatin
+    "42463": ["statin"],                    # pravastatin
+}
+
+MEMO_SIZE = 100_000   # unique medication names kept; cleared when full
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+class Matcher:
+    """Aho-Corasick automaton finding every keyword in a text in one pass.
+
+    Keywords are matched case-insensitively at the start of a word (like the
+    regex `\\bkeyword`), and each one carries a set of labels.
+    """
+
+    def __init__(self, keywords: dict[str, Iterable[str]]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[list[tuple[int, frozenset]]] = [[]]
+        for word, labels in keywords.items():
+            state = 0
+            for ch in word.lower():
+                if ch not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][ch] = len(self._goto) - 1
+                state = self._goto[state][ch]
+            self._out[state].append((len(word), frozenset(labels)))
+
+        # Breadth-first: a state's failure link is the longest proper suffix
+        # of its path that is also a path, and it inherits that state's output.
+        pending = deque(self._goto[0].values())   # depth-1 states fail to the root
+        while pending:
+            state = pending.popleft()
+            for ch, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                pending.append(child)
+
+    def labels(self, text: str) -> frozenset:
+        """Union of the labels of every keyword found in `text`."""
+        goto, fail, out = self._goto, self._fail, self._out
+        text = text.lower()
+        found = set()
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length, labels in out[state]:
+                start = i - length + 1
+                if start == 0 or not _is_word_char(text[start - 1]):
+                    found |= labels
+        return frozenset(found)
+
+
+class TerminologyIndex:
+    """Drug classes of medications by RxNorm code and free-text name, memoized."""
+
+    def __init__(
+        self,
+        drug_classes: dict[str, list[str]] = DRUG_CLASSES,
+        brand_names: dict[str, list[str]] = BRAND_NAMES,
+        rxnorm: dict[str, list[str]] = RXNORM_CLASSES,
+    ):
+        keywords = defaultdict(set)
+        for cls, names in drug_classes.items():
+            for name in names:
+                keywords[name].add(cls)
+        for brand, classes in brand_names.items():
+            keywords[brand].update(classes)
+        self.classes = list(drug_classes)
+        self._column = {cls: i for i, cls in enumerate(self.classes)}
+        self.matcher = Matcher(keywords)
+        self.rxnorm = {code: frozenset(classes) for code, classes in rxnorm.items()}
+        self._memo: dict[str, frozenset] = {}
+        self._lock = threading.Lock()
+
+    def classify_name(self, name: str | None) -> frozenset:
+        """Every class named in a free-text medication name (memoized)."""
+        name = name or ""
+        classes = self._memo.get(name)
+        if classes is None:
+            classes = self.matcher.labels(name)
+            with self._lock:
+                if len(self._memo) >= MEMO_SIZE:
+                    self._memo.clear()
+                self._memo[name] = classes
+        return classes
+
+    def classify(self, name: str | None, code: str | None = None) -> frozenset:
+        """Classes of one medication: its RxNorm code's plus every class named in it."""
+        return self.classify_name(name) | self.rxnorm.get(code or "", frozenset())
+
+    def _table(self, meds: pd.DataFrame, name: str, code: str) -> np.ndarray:
+        """Row x class boolean matrix: each unique name and code is looked up
+        once, then broadcast back to the rows."""
+        table = np.zeros((len(meds), len(self.classes)), dtype=bool)
+        for col, lookup in ((name, self.classify_name), (code, lambda c: self.rxnorm.get(c, frozenset()))):
+            if col not in meds:
+                continue
+            # Missing values get code -1, which picks the trailing all-False row.
+            rows, uniques = pd.factorize(meds[col])
+            per_unique = np.zeros((len(uniques) + 1, len(self.classes)), dtype=bool)
+            for i, value in enumerate(uniques):
+                for cls in lookup(str(value)):
+                    per_unique[i, self._column[cls]] = True
+            table |= per_unique[rows]
+        return table
+
+    def class_frame(self, meds: pd.DataFrame, name: str = "name", code: str = "rxnorm") -> pd.DataFrame:
+        """One boolean column per drug class, aligned with the rows of `meds`."""
+        return pd.DataFrame(self._table(meds, name, code), index=meds.index, columns=self.classes)
+
+    def in_classes(
+        self, meds: pd.DataFrame, classes: Iterable[str], name: str = "name", code: str = "rxnorm"
+    ) -> pd.Series:
+        """Boolean Series: is each row's medication in any of `classes`?"""
+        wanted = [self._column[cls] for cls in classes]   # KeyError for an unknown class
+        return pd.Series(self._table(meds, name, code)[:, wanted].any(axis=1), index=meds.index)
+
+
+INDEX = TerminologyIndex()
+
+
+def classify(name: str | None, code: str | None = None) -> frozenset:
+    return INDEX.classify(name, code)
+
+
+def class_frame(meds: pd.DataFrame, name: str = "name", code: str = "rxnorm") -> pd.DataFrame:
+    return INDEX.class_frame(meds, name, code)
+
+
+def in_classes(meds: pd.DataFrame, classes: Iterable[str], name: str = "name", code: str = "rxnorm") -> pd.Series:
+    return INDEX.in_classes(meds, classes, name, code)
@@ -4,132 +4,131 @@ NVIDIA-themed GUI for building clinical data workflows on FHIR endpoints.
 Talks to a local LLM (Ollama / vLLM) with clinical skills loaded.
 """
 
-import json
 import os
-import subprocess
-import tempfile
+import re
 import time
+import uuid
 from pathlib import Path
 
+import pandas as pd
 import requests
 import streamlit as st
 
+import fhir_cache
+import telemetry
+from artifact_store import ArtifactStore, data_snapshot
+from clinical_store import DEFAULT_STORE
+from exec_pool import ExecutionPool
+from fhir_client import client_for
+from jobs import CANCELLED, CPU, DONE, GPU, QUEUED, RUNNING, Job, JobQueue
+from llm_backend import backend_for
+from llm_cache import LLMCache
+from measures import PRESET_CONDITIONS
+from workflow import (
+    CASE_SUMMARY,
+    CUSTOM_QUERY,
+    DEFAULT_FHIR,
+    WORKFLOW_SKILLS,
+    case_summary_prompt,
+    custom_query_prompt,
+    data_source,
+    llm_job_kinds,
+    measure_batch_job_stages,
+    measure_job_stages,
+    measure_preview_job_stages,
+    submit_llm_job,
+    submit_measure_job,
+)
+
 # ---------------------------------------------------------------------------
 # Constants
 # ---------------------------------------------------------------------------
 
 NVIDIA_GREEN = "#76B900"
-SKILLS_DIR = Path(__file__).resolve().parent.parent / "skills"
-
-PRESET_CONDITIONS = {
-    "Diabetes Mellitus Type 2": {"snomed": "44054006", "lab": "HbA1c", "loinc": "4548-4", "threshold": "9%", "gap_meds": "insulin or GLP-1 agonist"},
-    "Hypertension": {"snomed": "38341003", "lab": "Systolic BP", "loinc": "8480-6", "threshold": "140 mmHg", "gap_meds": "any antihypertensive"},
-    "Heart Failure": {"snomed": "84114007", "lab": "BNP", "loinc": "42637-9", "threshold": "400 pg/mL", "gap_meds": "ACE inhibitor, ARB, or beta-blocker"},
-    "Chronic Kidney Disease": {"snomed": "40055000", "lab": "eGFR", "loinc": "33914-3", "threshold": "below 30 mL/min", "gap_meds": "ACE inhibitor or ARB"},
-}
-
-DEFAULT_FHIR = "https://r4.smarthealthit.org"
+# "120/500", "120 of 500" or "24%" in a running script's last output line.
+PROGRESS_PATTERN = re.compile(r"(\d[\d,]*)\s*(?:/|of)\s*(\d[\d,]*)|(\d+(?:\.\d+)?)\s*%")
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
-def load_skill(name: str) -> str:
-    path = SKILLS_DIR / name / "SKILL.md"
-    if path.exists():
-        return path.read_text()
-    return ""
-
-
-def build_system_prompt() -> str:
-    fhir = load_skill("fhir-basics")
-    clinical = load_skill("clinical-knowledge")
-    analysis = load_skill("analysis-methods")
-    return (
-        "You are a clinical data analyst with expertise in FHIR APIs and healthcare quality measures.\n\n"
-        "# FHIR Knowledge\n" + fhir + "\n\n"
-        "# Clinical Knowledge\n" + clinical + "\n\n"
-        "# Analysis Methods\n" + analysis + "\n\n"
-        "When asked to analyze data, write complete, self-contained Python scripts that:\n"
-        "- Use only requests, pandas, matplotlib, json (no other libraries)\n"
-        "- Print all results clearly\n"
-        "- Save any charts as PNG files in the current directory\n"
-        "- Include sample sizes with every percentage\n"
-        "- End with a plain-English summary\n"
-        "- Add disclaimer: 'For research and operational purposes only. Clinical decisions should be made by qualified clinicians.'\n"
-        "Return ONLY the Python code block, no explanation before or after."
-    )
+@st.cache_resource
+def get_exec_pool() -> ExecutionPool:
+    return ExecutionPool(size=int(os.environ.get("CLINICAL_EXEC_WORKERS", "2")))
 
 
-def query_llm(prompt: str, base_url: str, model: str) -> str:
-    try:
-        r = requests.post(
-            f"{base_url}/api/chat",
-            json={"model": model, "messages": [
-                {"role": "system", "content": build_system_prompt()},
-                {"role": "user", "content": prompt},
-            ], "stream": False},
-            timeout=300,
-        )
-        r.raise_for_status()
-        return r.json()["message"]["content"]
-    except Exception:
-        pass
+def output_progress(line: str) -> float | None:
+    """Fraction complete reported by a progress line such as "Processed 120/500", if any."""
+    match = PROGRESS_PATTERN.search(line)
+    if match is None:
+        return None
+    if match.group(3):
+        return min(float(match.group(3)) / 100, 1.0)
+    done, total = (int(g.replace(",", "")) for g in match.group(1, 2))
+    return min(done / total, 1.0) if total else None
 
-    try:
-        r = requests.post(
-            f"{base_url}/v1/chat/completions",
-            json={"model": model, "messages": [
-                {"role": "system", "content": build_system_prompt()},
-                {"role": "user", "content": prompt},
-            ], "max_tokens": 4096, "temperature": 0.2},
-            headers={"Authorization": "Bearer not-needed"},
-            timeout=300,
-        )
-        r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
-    except Exception as e:
-        return f"Error contacting LLM: {e}"
-
-
-def extract_code(response: str) -> str | None:
-    if "```python" in response:
-        start = response.index("```python") + len("```python")
-        end = response.index("```", start)
-        return response[start:end].strip()
-    if "```" in response:
-        start = response.index("```") + 3
-        if response[start] == "\n":
-            start += 1
-        end = response.index("```", start)
-        return response[start:end].strip()
-    return None
-
-
-def run_code(code: str, work_dir: str) -> tuple[str, list[str]]:
-    script_path = os.path.join(work_dir, "_analysis.py")
-    with open(script_path, "w") as f:
-        f.write(code)
-
-    result = subprocess.run(
-        ["python3", script_path],
-        capture_output=True, text=True, timeout=120,
-        cwd=work_dir,
+
+def configured_endpoints() -> dict[str, str]:
+    """{name: url} for every endpoint in the sidebar that has a URL."""
+    endpoints = st.session_state.get("endpoints") or [{"name": "Default", "url": DEFAULT_FHIR}]
+    return {ep["name"] or ep["url"]: ep["url"].rstrip("/") for ep in endpoints if ep["url"]}
+
+
+@st.cache_resource
+def get_metrics_server():
+    """Serve Prometheus metrics on CLINICAL_METRICS_PORT, if set (one server per process)."""
+    port = os.environ.get("CLINICAL_METRICS_PORT")
+    return telemetry.serve_metrics(int(port)) if port else None
+
+
+@st.cache_resource
+def get_llm_cache() -> LLMCache:
+    return LLMCache()
+
+
+@st.cache_resource
+def get_artifact_store() -> ArtifactStore:
+    return ArtifactStore()
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Process-wide job queue: one GPU slot for generation, one CPU slot per exec worker."""
+    queue = JobQueue(
+        slots={GPU: int(os.environ.get("CLINICAL_LLM_SLOTS", "1")), CPU: get_exec_pool().size},
+        trace_log=os.environ.get("CLINICAL_TRACE_LOG"),
     )
-    output = result.stdout
-    if result.returncode != 0:
-        output += "\n\nSTDERR:\n" + result.stderr
+    artifacts = get_artifact_store()
+    for kind, stages in llm_job_kinds(get_llm_cache(), get_exec_pool(), artifacts).items():
+        queue.register(kind, stages)
+    queue.register("measure", measure_job_stages(artifacts))
+    queue.register("measure-all", measure_batch_job_stages(artifacts))
+    queue.register("measure-preview", measure_preview_job_stages(artifacts))
+    return queue
+
+
+def session_owner() -> str:
+    """Owner ID for this user's jobs, kept in the URL so a reload or bookmark finds them again."""
+    if "owner" not in st.session_state:
+        st.session_state.owner = st.query_params.get("session") or uuid.uuid4().hex[:12]
+        st.query_params["session"] = st.session_state.owner
+    return st.session_state.owner
+
 
-    pngs = sorted(Path(work_dir).glob("*.png"))
-    return output, [str(p) for p in pngs]
+def open_job(job_id: str):
+    """Show `job_id` as the current job; the URL keeps it across reloads."""
+    st.session_state.job = job_id
+    st.query_params["job"] = job_id
 
 
 def test_fhir_connection(url: str) -> tuple[bool, str]:
+    # max_age=0: always reach the server, but a cached CapabilityStatement
+    # is only revalidated (304) rather than downloaded again.
     try:
-        r = requests.get(f"{url}/metadata", timeout=10)
-        if r.status_code == 200:
-            return True, "Connected"
-        return False, f"HTTP {r.status_code}"
+        client_for(url).get("metadata", max_age=0)
+        return True, "Connected"
+    except requests.HTTPError as e:
+        return False, f"HTTP {e.response.status_code}"
     except Exception as e:
         return False, str(e)
 
@@ -262,6 +261,51 @@ def render_sidebar():
         st.markdown(f"**<span style='color:{NVIDIA_GREEN}'>LLM Connection</span>**", unsafe_allow_html=True)
         llm_url = st.text_input("LLM Base URL", value="http://localhost:11434", help="Ollama default: http://localhost:11434")
         llm_model = st.text_input("Model Name", value="glm-4.7-flash:bf16")
+        backend = backend_for(llm_url)
+        if st.button("Check", key="check_llm"):
+            backend.probe()
+        health = backend.health()
+        if health["ok"]:
+            st.markdown(
+                f"<span class='status-dot status-green'></span>"
+                f"<span style='font-size:0.8rem;'>{'Ollama' if health['protocol'] == 'ollama' else 'OpenAI-compatible'}"
+                f" &middot; {health['latency_ms']:.0f} ms &middot; {len(health['models'])} models</span>",
+                unsafe_allow_html=True,
+            )
+            if health["models"] and llm_model not in health["models"]:
+                st.caption(f"Model not listed by server. Available: {', '.join(health['models'][:5])}")
+        else:
+            st.markdown(
+                f"<span class='status-dot status-red'></span>"
+                f"<span style='font-size:0.8rem;'>Unreachable: {health['error'][:80]}</span>",
+                unsafe_allow_html=True,
+            )
+        st.checkbox(
+            "Force regenerate", key="force_regenerate",
+            help="Ignore cached LLM responses and stored results of identical runs",
+        )
+        cache_stats = get_llm_cache().stats()
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.caption(
+                f"Response cache: {cache_stats['entries']} entries, {cache_stats['bytes'] / 1024:.0f} KB "
+                f"({cache_stats['hits']} hits / {cache_stats['misses']} misses)"
+            )
+        with col2:
+            if st.button("Clear", key="clear_llm_cache"):
+                get_llm_cache().clear()
+                st.rerun()
+        artifact_stats = get_artifact_store().stats()
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.caption(
+                f"Stored runs: {artifact_stats['entries']}, {artifact_stats['bytes'] / 1e6:.1f} of "
+                f"{artifact_stats['max_bytes'] / 1e6:.0f} MB ({artifact_stats['hits']} reused / {artifact_stats['misses']} misses)"
+            )
+        with col2:
+            if st.button("Clear", key="clear_artifacts"):
+                get_artifact_store().clear()
+                st.rerun()
 
         st.markdown("---")
         st.markdown(f"**<span style='color:{NVIDIA_GREEN}'>FHIR Endpoints</span>**", unsafe_allow_html=True)
@@ -278,6 +322,7 @@ def render_sidebar():
                 if st.button("Test", key=f"test_{i}"):
                     ok, msg = test_fhir_connection(ep["url"])
                     ep["status"] = "ok" if ok else "error"
+                    ep["error"] = None if ok else msg
                     if ok:
                         st.success("OK")
                     else:
@@ -287,6 +332,47 @@ def render_sidebar():
             st.session_state.endpoints.append({"name": "", "url": "", "status": "unknown"})
             st.rerun()
 
+        st.markdown("---")
+        st.markdown(f"**<span style='color:{NVIDIA_GREEN}'>Data Source</span>**", unsafe_allow_html=True)
+        source = st.radio("Query", ["FHIR endpoint", "Local clinical store"], label_visibility="collapsed")
+        store_path = None
+        if source == "Local clinical store":
+            store_path = st.text_input("Store path", value=str(DEFAULT_STORE), help="Build with: python app/clinical_store.py fallback-data/")
+            if not Path(store_path).exists():
+                st.warning("Store not found -- build it first")
+
+        st.markdown("---")
+        st.markdown(f"**<span style='color:{NVIDIA_GREEN}'>Telemetry</span>**", unsafe_allow_html=True)
+        metrics = telemetry.METRICS
+        st.caption(
+            f"{metrics.total('workflows_total'):.0f} workflows · "
+            f"{metrics.total('fhir_requests_total'):.0f} FHIR requests "
+            f"({metrics.total('fhir_bytes_total') / 1e6:.1f} MB) · "
+            f"{metrics.total('llm_tokens_in_total'):.0f} / {metrics.total('llm_tokens_out_total'):.0f} LLM tokens in / out"
+            + "".join(
+                f" · {workflow}: {metrics.total('llm_tokens_in_total', workflow=workflow):.0f} in"
+                for workflow in WORKFLOW_SKILLS if metrics.total("llm_requests_total", workflow=workflow)
+            )
+        )
+        render_fhir_cache_stats(metrics)
+        st.download_button(
+            "Metrics (Prometheus)", metrics.prometheus(), file_name="metrics.txt", mime="text/plain", key="dl_metrics",
+        )
+
+        st.markdown("---")
+        st.markdown(f"**<span style='color:{NVIDIA_GREEN}'>Jobs</span>**", unsafe_allow_html=True)
+        queue = get_job_queue()
+        st.caption(" · ".join(
+            f"{resource.upper()}: {s['running']}/{s['slots']} busy, {s['queued']} queued"
+            for resource, s in queue.stats().items()
+        ))
+        recent = {job.id: f"{job.name} · {job.status}" for job in queue.jobs(owner=session_owner(), limit=10)}
+        if recent:
+            st.selectbox(
+                "Recent jobs", list(recent), format_func=recent.get, index=None, placeholder="Open a previous job",
+                key="recent_job", on_change=lambda: st.session_state.recent_job and open_job(st.session_state.recent_job),
+            )
+
         st.markdown("---")
         st.markdown(
             "<p style='color:#555; font-size:0.75rem;'>"
@@ -297,14 +383,14 @@ def render_sidebar():
             unsafe_allow_html=True,
         )
 
-    return llm_url, llm_model
+    return llm_url, llm_model, store_path
 
 
 # ---------------------------------------------------------------------------
 # Main Page
 # ---------------------------------------------------------------------------
 
-def render_main(llm_url: str, llm_model: str):
+def render_main(llm_url: str, llm_model: str, store_path: str | None = None):
     # Header
     st.markdown(
         "<div class='nvidia-header'>"
@@ -314,19 +400,9 @@ def render_main(llm_url: str, llm_model: str):
         unsafe_allow_html=True,
     )
 
-    # Endpoint status bar
-    cols = st.columns(len(st.session_state.endpoints))
-    for i, ep in enumerate(st.session_state.endpoints):
-        status_class = {"ok": "status-green", "error": "status-red"}.get(ep["status"], "status-gray")
-        with cols[i]:
-            st.markdown(
-                f"<div class='endpoint-card'>"
-                f"<span class='status-dot {status_class}'></span>"
-                f"<strong>{ep['name'] or 'Unnamed'}</strong><br>"
-                f"<span style='color:#888; font-size:0.8rem;'>{ep['url'][:40]}...</span>"
-                f"</div>",
-                unsafe_allow_html=True,
-            )
+    # Endpoint status bar (re-rendered after a federated run updates it)
+    status_bar = st.empty()
+    render_endpoint_status(status_bar)
 
     st.markdown("---")
 
@@ -338,24 +414,19 @@ def render_main(llm_url: str, llm_model: str):
         st.markdown("### Single Patient Case Summary")
         st.markdown("Pull demographics, conditions, labs, and medications for one patient.")
 
-        fhir_url = st.session_state.endpoints[0]["url"] if st.session_state.endpoints else DEFAULT_FHIR
+        endpoints = configured_endpoints()
         patient_query = st.text_input("Patient search", value="first patient", placeholder="e.g., patient name or 'first patient'")
 
         if st.button("Generate Case Summary", key="btn_case"):
-            prompt = (
-                f"Using the FHIR endpoint at {fhir_url}, prepare a complete case summary for {patient_query}. "
-                "Query the Patient, Condition, Observation, and MedicationRequest endpoints. "
-                "Flag any abnormal lab values based on clinical reference ranges. "
-                "Write a Python script that does all of this and prints a formatted case summary."
-            )
-            run_workflow(prompt, llm_url, llm_model)
+            prompt = case_summary_prompt(data_source(endpoints, store_path), patient_query)
+            submit_workflow("Case summary", CASE_SUMMARY, prompt, llm_url, llm_model, data_snapshot(endpoints, store_path))
 
     # --- Tab 2: Quality Gap Analysis ---
     with tab2:
         st.markdown("### Population Quality Gap Analysis")
         st.markdown("Screen patients for care gaps based on CMS quality measures.")
 
-        fhir_url = st.session_state.endpoints[0]["url"] if st.session_state.endpoints else DEFAULT_FHIR
+        endpoints = configured_endpoints()
 
         condition = st.selectbox("Condition", list(PRESET_CONDITIONS.keys()))
         preset = PRESET_CONDITIONS[condition]
@@ -365,28 +436,35 @@ def render_main(llm_url: str, llm_model: str):
             st.markdown(f"**SNOMED Code:** `{preset['snomed']}`")
             st.markdown(f"**Lab Metric:** {preset['lab']} (LOINC `{preset['loinc']}`)")
         with col2:
-            st.markdown(f"**Threshold:** {preset['threshold']}")
+            st.markdown(f"**Measure:** {preset['measure'] or 'local measure'}, threshold {preset['threshold']}")
             st.markdown(f"**Gap if not on:** {preset['gap_meds']}")
 
-        if st.button("Run Gap Analysis", key="btn_gap"):
-            prompt = (
-                f"Using the FHIR endpoint at {fhir_url}, find all patients with {condition} "
-                f"(SNOMED code {preset['snomed']}). For each patient, get their latest "
-                f"{preset['lab']} (LOINC {preset['loinc']}) and medication list. "
-                f"Find patients with {preset['lab']} above {preset['threshold']} "
-                f"who are NOT on {preset['gap_meds']}. "
-                f"Write a Python script that builds a pandas DataFrame, identifies gap patients, "
-                f"creates a histogram of the {preset['lab']} distribution (save as gap_chart.png), "
-                f"and prints a summary with counts and percentages."
-            )
-            run_workflow(prompt, llm_url, llm_model)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if st.button("Run Gap Analysis", key="btn_gap"):
+                params = {"condition": condition, "endpoints": endpoints, "store_path": store_path}
+                open_job(submit_measure_job(
+                    get_job_queue(), "measure", f"{condition} gap analysis", params, session_owner(),
+                    get_artifact_store(), force=st.session_state.get("force_regenerate", False),
+                ))
+        with col2:
+            if st.button("Preview Gap Rate", key="btn_gap_preview", help="Estimate from a random sample within seconds, refined until exact or stopped"):
+                params = {"condition": condition, "endpoints": endpoints, "store_path": store_path}
+                open_job(get_job_queue().submit("measure-preview", f"{condition} gap preview", params, session_owner()))
+        with col3:
+            if st.button("Run All Measures", key="btn_gap_all", help="Every preset condition from one shared fetch of the overlapping cohorts"):
+                params = {"endpoints": endpoints, "store_path": store_path}
+                open_job(submit_measure_job(
+                    get_job_queue(), "measure-all", "All measures gap analysis", params, session_owner(),
+                    get_artifact_store(), force=st.session_state.get("force_regenerate", False),
+                ))
 
     # --- Tab 3: Custom Query ---
     with tab3:
         st.markdown("### Custom Query")
         st.markdown("Ask any clinical data question in plain English.")
 
-        fhir_url = st.session_state.endpoints[0]["url"] if st.session_state.endpoints else DEFAULT_FHIR
+        endpoints = configured_endpoints()
         custom = st.text_area(
             "Your question",
             height=120,
@@ -394,83 +472,376 @@ def render_main(llm_url: str, llm_model: str):
         )
 
         if st.button("Run Query", key="btn_custom") and custom.strip():
-            prompt = (
-                f"Using the FHIR endpoint at {fhir_url}, answer this clinical data question:\n\n"
-                f"{custom}\n\n"
-                "Write a Python script that queries the relevant FHIR endpoints, "
-                "analyzes the data, creates any relevant visualizations (save as PNG), "
-                "and prints a clear summary."
+            prompt = custom_query_prompt(data_source(endpoints, store_path), custom)
+            submit_workflow("Custom query", CUSTOM_QUERY, prompt, llm_url, llm_model, data_snapshot(endpoints, store_path))
+
+    job_id = st.session_state.get("job") or st.query_params.get("job")
+    if job_id:
+        st.markdown("---")
+        render_job(job_id)
+
+    render_endpoint_status(status_bar)
+
+
+def render_fhir_cache_stats(metrics: telemetry.Metrics):
+    """Hits and misses of the shared FHIR response cache, including generated scripts' lookups."""
+    cache = fhir_cache.shared()
+    if cache is None:
+        st.caption("FHIR cache: off")
+        return
+    stats = cache.stats()
+    hits, revalidated = metrics.total("fhir_cache_hits_total"), metrics.total("fhir_cache_revalidated_total")
+    lookups = hits + revalidated + metrics.total("fhir_cache_misses_total")
+    st.caption(
+        f"FHIR cache: {hits:.0f} hits, {revalidated:.0f} revalidated, {lookups - hits - revalidated:.0f} misses"
+        + (f" ({(hits + revalidated) / lookups:.0%} served from cache)" if lookups else "")
+        + f" · {stats['bytes'] / 1e6:.1f} MB in memory"
+        + (f", {stats['disk_bytes'] / 1e6:.1f} MB on disk" if "disk_bytes" in stats else "")
+    )
+
+
+def render_endpoint_status(container):
+    endpoints = st.session_state.endpoints
+    with container.container():
+        for col, ep in zip(st.columns(len(endpoints)), endpoints):
+            status_class = {"ok": "status-green", "error": "status-red"}.get(ep["status"], "status-gray")
+            detail = ""
+            if ep.get("error"):
+                detail = f"<br><span style='color:#e5484d; font-size:0.75rem;'>{ep['error'][:80]}</span>"
+            elif ep.get("latency_ms") is not None:
+                detail = f"<br><span style='color:#888; font-size:0.75rem;'>{ep['latency_ms']:.0f} ms · {ep['resources']} resources</span>"
+            with col:
+                st.markdown(
+                    f"<div class='endpoint-card'>"
+                    f"<span class='status-dot {status_class}'></span>"
+                    f"<strong>{ep['name'] or 'Unnamed'}</strong><br>"
+                    f"<span style='color:#888; font-size:0.8rem;'>{ep['url'][:40]}...</span>"
+                    f"{detail}"
+                    f"</div>",
+                    unsafe_allow_html=True,
+                )
+
+
+def record_endpoint_stats(stats: dict[str, dict]):
+    """Copy a federated run's per-endpoint latency and failures onto the sidebar endpoints."""
+    for ep in st.session_state.endpoints:
+        s = stats.get(ep["name"] or ep["url"])
+        if s is None or not s["calls"]:
+            continue
+        ep["status"] = "ok" if s["ok"] else "error"
+        ep["latency_ms"], ep["resources"] = s["latency_ms"], s["resources"]
+        ep["error"] = s["error"] if not s["ok"] else None
+
+
+def submit_workflow(name: str, workflow: str, prompt: str, llm_url: str, llm_model: str, snapshot: dict):
+    job_id = submit_llm_job(
+        get_job_queue(), get_llm_cache(), name, prompt, llm_url, llm_model,
+        force=st.session_state.get("force_regenerate", False), owner=session_owner(), workflow=workflow,
+        artifacts=get_artifact_store(), snapshot=snapshot,
+    )
+    open_job(job_id)
+
+
+def render_job(job_id: str):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        st.warning(f"Job {job_id} not found")
+        return
+    st.markdown(f"### {job.name}")
+    if not job.done:
+        render_job_progress(job_id)
+        return
+
+    waited = (job.started or job.finished) - job.submitted
+    st.caption(
+        f"Job {job.id} · submitted {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job.submitted))} · "
+        f"{waited:.1f}s in queue · finished in {job.finished - job.submitted:.1f}s"
+    )
+    if job.result.get("reused_at"):
+        ran = time.strftime("%Y-%m-%d %H:%M", time.localtime(job.result["reused_at"]))
+        st.caption(f"Served from an identical run on the same data at {ran}, without re-executing (tick 'Force regenerate' to run it again)")
+    if job.status == CANCELLED:
+        st.info("Job cancelled")
+    elif job.kind == "measure":
+        render_measure_result(job)
+    elif job.kind == "measure-preview":
+        render_measure_preview_result(job)
+    elif job.kind == "measure-all":
+        render_measure_batch_result(job)
+    else:
+        render_llm_result(job)
+    if job.trace is not None:
+        render_trace(job.trace)
+
+
+@st.fragment(run_every=1.0)
+def render_job_progress(job_id: str):
+    """Queue position / ETA and live output of an unfinished job, refreshed every second."""
+    queue = get_job_queue()
+    job = queue.get(job_id)
+    if job.done:
+        st.rerun()  # re-render the page with the results
+    resource = queue.resource(job)
+    label = {GPU: "LLM generation (GPU)", CPU: "code execution (CPU)"}[resource]
+    eta = queue.eta(job_id)
+    eta_text = f" · ETA ~{eta:.0f}s" if eta is not None else ""
+    if job.status == QUEUED:
+        st.info(f"Queued for {label}: position {queue.position(job_id)}{eta_text}")
+        if st.button("Cancel", key=f"cancel_{job_id}"):
+            queue.cancel(job_id)
+            st.rerun()
+    else:
+        st.info(f"Running {label} · {time.time() - job.stage_started:.0f}s elapsed{eta_text}")
+    if job.kind == "measure-preview" and job.result.get("estimates"):
+        render_gap_estimates(job.result["estimates"])
+        if job.status == RUNNING and st.button("Stop at this estimate", key=f"stop_{job_id}", disabled=job.stop_requested):
+            queue.stop(job_id)
+    if job.progress:
+        if job.kind == "llm" and resource == GPU:
+            st.code(job.progress, language="python")
+        elif job.kind.startswith("llm") and "\n\n" in job.progress:
+            # Script output: a line-count header, then the last lines printed.
+            header, lines = job.progress.split("\n\n", 1)
+            fraction = output_progress(lines.rsplit("\n", 1)[-1])
+            if fraction is not None:
+                st.progress(fraction)
+            st.caption(header)
+            st.code(lines, language=None)
+        else:
+            st.write(job.progress)
+
+
+def render_llm_result(job: Job):
+    result = job.result
+    if result.get("cached_at"):
+        generated = time.strftime("%Y-%m-%d %H:%M", time.localtime(result["cached_at"]))
+        st.write(f"Reused cached LLM response from {generated} (tick 'Force regenerate' to skip the cache)")
+    if result.get("code"):
+        with st.expander("Generated Code", expanded=False):
+            st.code(result["code"], language="python")
+    if job.status != DONE:
+        st.error(job.error)
+        if "response" in result and not result.get("code"):
+            st.markdown("**LLM Response:**")
+            st.markdown(f"<div class='result-box'>{result['response']}</div>", unsafe_allow_html=True)
+        # A timed-out script keeps what it printed before it was stopped.
+        output_path = Path(result.get("output_path") or "")
+        if output_path.is_file():
+            st.markdown(f"<div class='result-box'>{result.get('output', '')}</div>", unsafe_allow_html=True)
+            st.download_button(
+                "Download Partial Output (TXT)", output_path.read_bytes(), file_name="results.txt", mime="text/plain",
             )
-            run_workflow(prompt, llm_url, llm_model)
+        return
+
+    cached = bool(result.get("cached_at"))
+    llm_stats = result.get("llm") or {}
+    llm_time = llm_stats.get("total", 0.0)
+    exec_time = result["exec_time"]
+    render_metrics([
+        ("cached" if cached else f"{llm_stats.get('ttft', llm_time):.1f}s", "Time to First Token"),
+        ("--" if cached else f"{llm_stats.get('tokens_per_sec', 0):.0f}", "Tokens / sec"),
+        ("cached" if cached else f"{llm_time:.1f}s", "LLM Generation"),
+        (f"{exec_time:.1f}s", "Code Execution"),
+        (f"{llm_time + exec_time:.1f}s", "Total Time"),
+    ])
+    if llm_stats.get("skills"):
+        cached_tokens = llm_stats.get("tokens_cached")
+        st.caption(
+            f"Skills: {', '.join(llm_stats['skills'])} (system prompt ~{llm_stats['system_tokens']:,} tokens) · "
+            f"{llm_stats.get('tokens_in') or 0:,} prompt tokens"
+            + (f", {cached_tokens:,} from the prefix cache" if cached_tokens else "")
+        )
 
+    output = result["output"]
+    st.markdown("### Results")
+    st.markdown(f"<div class='result-box'>{output}</div>", unsafe_allow_html=True)
+    # The box holds the last lines only; the download has everything.
+    output_path = Path(result.get("output_path") or "")
+    truncated = result.get("output_lines", 0) > output.count("\n") and output_path.is_file()
+    if truncated:
+        st.caption(f"{result['output_lines']:,} lines of output; download for the full text")
 
-def run_workflow(prompt: str, llm_url: str, llm_model: str):
-    work_dir = tempfile.mkdtemp(prefix="clinical_")
+    charts = [path for path in result["charts"] if Path(path).exists()]
+    if charts:
+        st.markdown("### Visualizations")
+        for chart_path in charts:
+            st.image(chart_path)
 
-    with st.status("Running workflow...", expanded=True) as status:
-        st.write("Sending query to LLM...")
-        t0 = time.time()
-        response = query_llm(prompt, llm_url, llm_model)
-        llm_time = time.time() - t0
-        st.write(f"LLM responded in {llm_time:.1f}s")
+    col1, col2 = st.columns(2)
+    with col1:
+        full = output_path.read_bytes() if truncated else output
+        st.download_button("Download Results (TXT)", full, file_name="results.txt", mime="text/plain")
+    with col2:
+        st.download_button("Download Code (PY)", result["code"], file_name="analysis.py", mime="text/x-python")
+
+    render_disclaimer()
+
+
+def record_job_endpoint_stats(job: Job):
+    """Copy a measure job's endpoint health onto the status bar once."""
+    if "endpoint_stats" in job.result and not st.session_state.get(f"stats_{job.id}"):
+        record_endpoint_stats(job.result["endpoint_stats"])
+        st.session_state[f"stats_{job.id}"] = True
+
+
+def render_measure_result(job: Job):
+    """Results of a preset evaluated with the built-in measure engine (no LLM involved)."""
+    result = job.result
+    record_job_endpoint_stats(job)
+    if job.status != DONE:
+        st.error(f"Measure evaluation failed: {job.error}")
+        return
+
+    timings, summary = result["timings"], result["summary"]
+    no_lab = summary["eligible"] - summary["with_lab"]
+    st.caption(f"Loaded in {timings['load']:.1f}s, evaluated in {timings['evaluate']:.2f}s")
+    render_metrics([
+        (f"{summary['eligible']}", "Eligible Patients"),
+        (f"{summary['with_lab']}", f"With {result['lab']}"),
+        (f"{no_lab}", f"No {result['lab']}"),
+        (f"{summary['gaps']}", "Care Gaps"),
+        (f"{summary['gap_rate']:.1%}", "Gap Rate"),
+        (f"{sum(timings.values()):.1f}s", "Total Time"),
+    ])
+    st.caption(
+        f"The gap rate is of patients with a {result['lab']} result; the {no_lab} "
+        f"without one are not counted as gaps."
+    )
 
-        code = extract_code(response)
-        if not code:
-            status.update(label="LLM did not return executable code", state="error")
-            st.markdown("**LLM Response:**")
-            st.markdown(f"<div class='result-box'>{response}</div>", unsafe_allow_html=True)
-            return
+    output = result["report"]
+    st.markdown("### Results")
+    st.markdown(f"<div class='result-box'>{output}</div>", unsafe_allow_html=True)
+    if summary["with_lab"] and Path(result["chart"]).exists():
+        st.markdown("### Visualizations")
+        st.image(result["chart"])
 
-        st.write("Executing analysis code...")
-        with st.expander("Generated Code", expanded=False):
-            st.code(code, language="python")
-
-        t1 = time.time()
-        try:
-            output, charts = run_code(code, work_dir)
-        except subprocess.TimeoutExpired:
-            status.update(label="Code execution timed out", state="error")
-            return
-        exec_time = time.time() - t1
-        st.write(f"Code executed in {exec_time:.1f}s")
-        status.update(label="Workflow complete", state="complete")
-
-    # Metrics
-    col1, col2, col3 = st.columns(3)
+    col1, col2 = st.columns(2)
     with col1:
-        st.markdown(
-            f"<div class='metric-card'><div class='value'>{llm_time:.1f}s</div><div class='label'>LLM Generation</div></div>",
-            unsafe_allow_html=True,
-        )
+        st.download_button("Download Results (TXT)", output, file_name="results.txt", mime="text/plain")
     with col2:
-        st.markdown(
-            f"<div class='metric-card'><div class='value'>{exec_time:.1f}s</div><div class='label'>Code Execution</div></div>",
-            unsafe_allow_html=True,
-        )
-    with col3:
-        st.markdown(
-            f"<div class='metric-card'><div class='value'>{llm_time + exec_time:.1f}s</div><div class='label'>Total Time</div></div>",
-            unsafe_allow_html=True,
-        )
+        if Path(result["gaps_csv"]).exists():
+            st.download_button(
+                "Download Gap Patients (CSV)", Path(result["gaps_csv"]).read_text(),
+                file_name="gap_patients.csv", mime="text/csv",
+            )
 
-    # Output
+    render_disclaimer()
+
+
+def render_gap_estimates(estimates: list[dict]):
+    """The latest sampled gap rate with its confidence interval, and how it converged."""
+    latest = estimates[-1]
+    st.progress(latest["sampled"] / latest["cohort"] if latest["cohort"] else 1.0)
+    render_metrics([
+        (f"{latest['gap_rate']:.1%}", "Estimated Gap Rate"),
+        (f"{latest['low']:.1%} - {latest['high']:.1%}", "95% Confidence Interval"),
+        (f"{latest['sampled']:,} / {latest['cohort']:,}", "Patients Sampled"),
+        (f"{latest['elapsed']:.1f}s", "Elapsed"),
+    ])
+    if len(estimates) > 1:
+        frame = pd.DataFrame(estimates).set_index("sampled")[["low", "gap_rate", "high"]]
+        st.line_chart(frame, height=180)
+
+
+def render_measure_preview_result(job: Job):
+    """A sampled gap measure: the exact result if it ran to the end, else the estimate it stopped at."""
+    result = job.result
+    if job.status == DONE and "report" in result:
+        estimates = result["estimates"]
+        if len(estimates) > 1:
+            first = estimates[0]
+            st.caption(
+                f"First estimate {first['gap_rate']:.1%} ({first['low']:.1%} - {first['high']:.1%}) "
+                f"from {first['sampled']:,} patients after {first['elapsed']:.1f}s; exact after {len(estimates)} batches"
+            )
+        render_measure_result(job)
+        return
+    record_job_endpoint_stats(job)
+    if job.status != DONE:
+        st.error(f"Measure evaluation failed: {job.error}")
+        return
+    latest = result["estimates"][-1]
+    st.caption(
+        f"Stopped after {latest['sampled']:,} of {latest['cohort']:,} patients: {latest['gaps']} gaps "
+        f"among {latest['with_lab']} with {PRESET_CONDITIONS[job.params['condition']]['lab']}. "
+        "Run the full gap analysis for the exact rate and the patient list."
+    )
+    render_gap_estimates(result["estimates"])
+    render_disclaimer()
+
+
+def render_measure_batch_result(job: Job):
+    """Every preset evaluated from one shared load: overview, combined report, one chart per condition."""
+    result = job.result
+    record_job_endpoint_stats(job)
+    if job.status != DONE:
+        st.error(f"Measure evaluation failed: {job.error}")
+        return
+
+    timings, fetched, results = result["timings"], result["fetched"], result["measures"]
+    st.caption(
+        f"Loaded {fetched['patients']} unique patients ({fetched['memberships']} cohort memberships) "
+        f"in {timings['load']:.1f}s, evaluated {len(results)} measures in {timings['evaluate']:.2f}s"
+    )
+    render_metrics([
+        (f"{fetched['patients']}", "Unique Patients"),
+        (f"{sum(m['summary']['eligible'] for m in results.values())}", "Eligible (all measures)"),
+        (f"{sum(m['summary']['gaps'] for m in results.values())}", "Care Gaps"),
+        (f"{sum(timings.values()):.1f}s", "Total Time"),
+    ])
+
+    output = result["report"]
     st.markdown("### Results")
     st.markdown(f"<div class='result-box'>{output}</div>", unsafe_allow_html=True)
 
-    # Charts
+    charts = [(condition, m["chart"]) for condition, m in results.items() if m["summary"]["with_lab"] and Path(m["chart"]).exists()]
     if charts:
         st.markdown("### Visualizations")
-        for chart_path in charts:
-            st.image(chart_path)
+        for col, (condition, chart_path) in zip(st.columns(2) * len(charts), charts):
+            with col:
+                st.image(chart_path, caption=condition)
 
-    # Downloads
     col1, col2 = st.columns(2)
     with col1:
         st.download_button("Download Results (TXT)", output, file_name="results.txt", mime="text/plain")
     with col2:
-        st.download_button("Download Code (PY)", code, file_name="analysis.py", mime="text/x-python")
+        if Path(result["gaps_csv"]).exists():
+            st.download_button(
+                "Download Gap Patients (CSV)", Path(result["gaps_csv"]).read_text(),
+                file_name="gap_patients.csv", mime="text/csv",
+            )
+
+    render_disclaimer()
+
+
+def render_trace(trace: telemetry.Trace):
+    counters = trace.metrics
+    with st.expander(f"Trace: {len(trace.spans)} spans in {trace.duration_ms / 1000:.1f}s"):
+        st.caption(
+            f"FHIR: {counters.total('fhir_requests_total'):.0f} requests, "
+            f"{counters.total('fhir_pages_total'):.0f} pages, {counters.total('fhir_bytes_total') / 1e6:.2f} MB, "
+            f"{counters.total('fhir_request_seconds_total'):.2f}s network + {counters.total('fhir_parse_seconds_total'):.2f}s JSON parsing, "
+            f"{counters.total('fhir_cache_hits_total'):.0f} cache hits / {counters.total('fhir_cache_revalidated_total'):.0f} revalidated · "
+            f"LLM: {counters.total('llm_tokens_in_total'):.0f} tokens in, {counters.total('llm_tokens_out_total'):.0f} out"
+            + (f" · {trace.dropped} spans dropped" if trace.dropped else "")
+        )
+        st.dataframe(trace.rows(), hide_index=True)
+        st.download_button(
+            "Download Trace (JSONL)", trace.to_jsonl(), file_name=f"trace-{trace.trace_id[:8]}.jsonl",
+            mime="application/x-ndjson", key=f"dl_trace_{trace.trace_id}",
+        )
+
+
+def render_metrics(metrics: list[tuple[str, str]]):
+    for col, (value, label) in zip(st.columns(len(metrics)), metrics):
+        with col:
+            st.markdown(
+                f"<div class='metric-card'><div class='value'>{value}</div><div class='label'>{label}</div></div>",
+                unsafe_allow_html=True,
+            )
+
 
-    # Disclaimer
+def render_disclaimer():
     st.markdown(
         "<div class='disclaimer'>"
         "⚠ This analysis uses synthetic FHIR data for research and demonstration purposes. "
@@ -493,8 +864,11 @@ def main():
         initial_sidebar_state="expanded",
     )
     inject_css()
-    llm_url, llm_model = render_sidebar()
-    render_main(llm_url, llm_model)
+    get_exec_pool()  # warm the workers before the first workflow needs them
+    get_job_queue()
+    get_metrics_server()
+    llm_url, llm_model, store_path = render_sidebar()
+    render_main(llm_url, llm_model, store_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,533 @@
+"""
+The stages of an LLM workflow, free of any UI code.
+
+The workbench and `scripts/benchmark.py` both drive a workflow through the
+same functions: build the prompt, generate with `stream_llm` / `query_llm`,
+pull the script out with `extract_code`, and execute it with `run_code`.
+
+Each LLM workflow sends only the skills listed for it in `WORKFLOW_SKILLS`.
+Skill files are cached in memory until their mtime changes. The system
+prompt starts with the same fixed text and then the skills in one canonical
+order, so every workflow's prompt shares its prefix with the larger ones and
+the server's prefix (KV) cache can reuse it across requests.
+
+The workbench runs them as background jobs (see `jobs.py`): an LLM workflow
+is a GPU generation stage followed by a CPU execution stage, a preset gap
+analysis (one preset, or all of them from one shared load) a single CPU
+stage. Finished runs are moved into the artifact store, keyed by what ran on
+which data, and an identical later submission is served from there without
+running anything.
+"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from datetime import date
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+import measures
+import telemetry
+from artifact_store import ArtifactStore, artifact_key, data_snapshot, reuse_max_age, run_key
+from clinical_store import store_for
+from exec_pool import STDOUT_NAME, ExecutionPool
+from fhir_federated import FederatedClient
+from jobs import CPU, GPU, Job, JobQueue
+from llm_backend import backend_for
+from llm_cache import LLMCache, cache_key
+
+APP_DIR = Path(__file__).resolve().parent
+SKILLS_DIR = APP_DIR.parent / "skills"
+DEFAULT_FHIR = "https://r4.smarthealthit.org"
+EXEC_TIMEOUT = 120
+PROGRESS_LINES = 30     # output lines shown while a script runs
+
+
+# Skills in system-prompt order, with their section headings. Every
+# workflow's skills are a subset, kept in this order, so prompts share a prefix.
+SKILL_SECTIONS = {
+    "fhir-basics": "FHIR Knowledge",
+    "clinical-knowledge": "Clinical Knowledge",
+    "analysis-methods": "Analysis Methods",
+}
+CASE_SUMMARY = "case-summary"
+CUSTOM_QUERY = "custom-query"
+# A single-patient summary needs no cohort batching, store or chart guidance.
+WORKFLOW_SKILLS = {
+    CASE_SUMMARY: ["fhir-basics", "clinical-knowledge"],
+    CUSTOM_QUERY: ["fhir-basics", "clinical-knowledge", "analysis-methods"],
+}
+
+SYSTEM_PREAMBLE = (
+    "You are a clinical data analyst with expertise in FHIR APIs and healthcare quality measures.\n\n"
+    "When asked to analyze data, write complete, self-contained Python scripts that:\n"
+    "- Use only fhir_client, fhir_batch, fhir_frames, fhir_federated, clinical_store, measures, terminology, reference_ranges, requests, pandas, matplotlib, json (no other libraries)\n"
+    "- Fetch cohort data with fhir_batch, never with one request per patient\n"
+    "- Print all results clearly\n"
+    "- Save any charts as PNG files in the current directory\n"
+    "- Include sample sizes with every percentage\n"
+    "- End with a plain-English summary\n"
+    "- Add disclaimer: 'For research and operational purposes only. Clinical decisions should be made by qualified clinicians.'\n"
+    "Return ONLY the Python code block, no explanation before or after."
+)
+
+_skills: dict[str, tuple[int, str]] = {}    # name -> (mtime_ns, text)
+_prompts: dict[tuple, str] = {}             # (workflow, skill mtimes) -> system prompt
+_skills_lock = threading.Lock()
+
+
+def load_skill(name: str) -> str:
+    """A skill's SKILL.md, cached until the file's mtime changes ("" if missing)."""
+    path = SKILLS_DIR / name / "SKILL.md"
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return ""
+    cached = _skills.get(name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    text = path.read_text()
+    with _skills_lock:
+        _skills[name] = (mtime, text)
+    return text
+
+
+def workflow_skills(workflow: str = CUSTOM_QUERY) -> list[str]:
+    """The workflow's skills in canonical (prefix-sharing) order."""
+    wanted = set(WORKFLOW_SKILLS[workflow])
+    return [name for name in SKILL_SECTIONS if name in wanted]
+
+
+def build_system_prompt(workflow: str = CUSTOM_QUERY) -> str:
+    """The system prompt for `workflow`, rebuilt only when one of its skills changes."""
+    skills = workflow_skills(workflow)
+    key = (workflow, *(_skill_mtime(name) for name in skills))
+    prompt = _prompts.get(key)
+    if prompt is None:
+        prompt = SYSTEM_PREAMBLE + "".join(f"\n\n# {SKILL_SECTIONS[name]}\n{load_skill(name)}" for name in skills)
+        with _skills_lock:
+            _prompts[key] = prompt
+    return prompt
+
+
+def _skill_mtime(name: str) -> int | None:
+    try:
+        return (SKILLS_DIR / name / "SKILL.md").stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for prompt-size reporting."""
+    return (len(text) + 3) // 4
+
+
+def prompt_stats(workflow: str = CUSTOM_QUERY) -> dict:
+    """Skills and estimated system-prompt tokens, in total and per skill."""
+    skills = workflow_skills(workflow)
+    return {
+        "workflow": workflow,
+        "skills": skills,
+        "system_tokens": estimate_tokens(build_system_prompt(workflow)),
+        "skill_tokens": {name: estimate_tokens(load_skill(name)) for name in skills},
+    }
+
+
+def stream_llm(
+    prompt: str, base_url: str, model: str, stats: dict | None = None, workflow: str = CUSTOM_QUERY,
+):
+    """Yield response text as it is generated by the server's detected backend.
+
+    Fills `stats` with protocol, ttft, total, tokens_in, tokens_out,
+    tokens_per_sec, workflow, skills and system_tokens (estimated), plus
+    tokens_cached when the server reports prefix-cache hits.
+    """
+    stats = {} if stats is None else stats
+    system = build_system_prompt(workflow)
+    stats.update(workflow=workflow, skills=workflow_skills(workflow), system_tokens=estimate_tokens(system))
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt},
+    ]
+    t0 = time.time()
+    chunks = 0
+    try:
+        for piece in backend_for(base_url).stream(model, messages, stats):
+            if chunks == 0:
+                stats["ttft"] = time.time() - t0
+            chunks += 1
+            yield piece
+    except Exception as e:
+        stats["total"] = time.time() - t0
+        telemetry.count("llm_errors_total", model=model, workflow=workflow)
+        if chunks:
+            raise
+        yield f"Error contacting LLM: {e}"
+        return
+
+    stats["total"] = time.time() - t0
+    # Servers that omit usage still stream roughly one token per chunk.
+    stats["tokens_out"] = stats.get("tokens_out") or chunks
+    gen_time = stats["total"] - stats.get("ttft", 0.0)
+    stats["tokens_per_sec"] = stats["tokens_out"] / gen_time if gen_time > 0 else 0.0
+    record_llm(stats, t0, model)
+
+
+def record_llm(stats: dict, start: float, model: str):
+    """Spans for prompt prefill (time to first token) and generation, plus token counters per workflow."""
+    ttft = stats.get("ttft", 0.0)
+    tokens_in, tokens_out = stats.get("tokens_in") or 0, stats.get("tokens_out") or 0
+    workflow, cached = stats.get("workflow"), stats.get("tokens_cached")
+    prefill = {"tokens_in": tokens_in} if cached is None else {"tokens_in": tokens_in, "tokens_cached": cached}
+    telemetry.add_span("llm.prefill", start, ttft, model=model, workflow=workflow, **prefill)
+    telemetry.add_span("llm.generate", start + ttft, stats["total"] - ttft, model=model, tokens_out=tokens_out)
+    telemetry.count("llm_requests_total", model=model, protocol=stats.get("protocol"), workflow=workflow)
+    telemetry.count("llm_tokens_in_total", tokens_in, model=model, workflow=workflow)
+    telemetry.count("llm_tokens_cached_total", cached or 0, model=model, workflow=workflow)
+    telemetry.count("llm_tokens_out_total", tokens_out, model=model, workflow=workflow)
+    telemetry.count("llm_prefill_seconds_total", ttft, model=model, workflow=workflow)
+    telemetry.count("llm_generate_seconds_total", stats["total"] - ttft, model=model, workflow=workflow)
+
+
+def query_llm(prompt: str, base_url: str, model: str, workflow: str = CUSTOM_QUERY, stats: dict | None = None) -> str:
+    return "".join(stream_llm(prompt, base_url, model, stats, workflow))
+
+
+def extract_code(response: str) -> str | None:
+    if "```python" in response:
+        start = response.index("```python") + len("```python")
+        end = response.index("```", start)
+        return response[start:end].strip()
+    if "```" in response:
+        start = response.index("```") + 3
+        if response[start] == "\n":
+            start += 1
+        end = response.index("```", start)
+        return response[start:end].strip()
+    return None
+
+
+def run_code(
+    code: str, work_dir: str, pool: ExecutionPool, timeout: float = EXEC_TIMEOUT, stats: dict | None = None,
+    on_output: Callable[[list[str]], None] | None = None,
+) -> tuple[str, list[str]]:
+    """Run generated code on a pre-warmed worker; returns (output, chart paths).
+
+    `on_output` receives stdout lines as the script prints them. The
+    returned output is the last `exec_pool.DISPLAY_LINES` lines (plus
+    stderr on failure); the full stdout stays in the file at
+    stats["output_path"]. Fills `stats` with returncode, the worker's
+    peak_rss_kb, output_lines and output_path. The script's own spans and
+    FHIR counters are merged into the current trace under a `run_code` span.
+    Raises subprocess.TimeoutExpired when the script runs past `timeout`.
+    """
+    with telemetry.span("run_code") as attrs:
+        result = pool.run(code, work_dir, timeout=timeout, on_output=on_output)
+        attrs.update(returncode=result.returncode, peak_rss_kb=result.peak_rss_kb, output_lines=result.stdout_lines)
+        telemetry.absorb(result.telemetry)
+    if stats is not None:
+        stats.update(
+            returncode=result.returncode, peak_rss_kb=result.peak_rss_kb,
+            output_lines=result.stdout_lines, output_path=result.stdout_path,
+        )
+    output = result.stdout
+    omitted = result.stdout_lines - output.count("\n")
+    if omitted > 0:
+        output = f"[... {omitted:,} earlier lines not shown -- download the full output ...]\n" + output
+    if result.returncode != 0:
+        output += "\n\nSTDERR:\n" + result.stderr
+
+    pngs = sorted(Path(work_dir).glob("*.png"))
+    return output, [str(p) for p in pngs]
+
+
+def data_source(endpoints: dict[str, str], store_path: str | None) -> str:
+    """Opening clause of a workflow prompt naming where the data comes from."""
+    if store_path:
+        return (
+            f"Using the local clinical store at {store_path} "
+            f"(open it with clinical_store.ClinicalStore({store_path!r}); do not call the FHIR endpoint)"
+        )
+    if len(endpoints) > 1:
+        listed = ", ".join(f"{name} at {url}" for name, url in endpoints.items())
+        return (
+            f"Using the FHIR endpoints {listed} "
+            f"(query all of them at once with fhir_federated.FederatedClient({endpoints!r}), "
+            "which can be passed to the fhir_batch helpers in place of a single client)"
+        )
+    return f"Using the FHIR endpoint at {next(iter(endpoints.values()), DEFAULT_FHIR)}"
+
+
+def case_summary_prompt(source: str, patient_query: str) -> str:
+    return (
+        f"{source}, prepare a complete case summary for {patient_query}. "
+        "Query the Patient, Condition, Observation, and MedicationRequest endpoints. "
+        "Flag abnormal lab values with reference_ranges.flag(observations, sex=gender), "
+        "which adds lab, reference, flag (low/normal/high) and concerning columns. "
+        "Write a Python script that does all of this and prints a formatted case summary."
+    )
+
+
+def custom_query_prompt(source: str, question: str) -> str:
+    return (
+        f"{source}, answer this clinical data question:\n\n"
+        f"{question}\n\n"
+        "Write a Python script that queries the relevant FHIR endpoints, "
+        "analyzes the data, creates any relevant visualizations (save as PNG), "
+        "and prints a clear summary."
+    )
+
+
+# ---------------------------------------------------------------------------
+# Background jobs
+# ---------------------------------------------------------------------------
+
+def llm_job_kinds(llm_cache: LLMCache, pool: ExecutionPool, artifacts: ArtifactStore | None = None) -> dict[str, list]:
+    """Job kinds for LLM workflows: "llm" generates then executes, "llm-cached" only executes.
+
+    Params: prompt, llm_url, model, workflow, and optionally snapshot and
+    force. Result: response, code, llm (stream stats), output, output_lines,
+    output_path, charts, exec_time, and reused_at when the run was served
+    from `artifacts`. While the code runs, `job.progress` shows its line
+    count and last lines. Finished runs, timed-out ones included, are moved
+    into `artifacts`; only successful ones with a data snapshot are keyed
+    for reuse.
+    """
+    def generate(job: Job):
+        p = job.params
+        workflow = p.get("workflow", CUSTOM_QUERY)
+        stats, response = {}, ""
+        for piece in stream_llm(p["prompt"], p["llm_url"], p["model"], stats, workflow):
+            response += piece
+            job.progress = response
+        with telemetry.span("extract_code"):
+            code = extract_code(response)
+        if code:
+            key = cache_key(build_system_prompt(workflow), p["prompt"], p["model"], p["llm_url"])
+            llm_cache.put(key, p["model"], response, code)
+        job.result.update(response=response, code=code, llm=stats)
+        if not code:
+            job.error = "LLM did not return executable code"
+
+    def execute(job: Job):
+        p = job.params
+        key = artifact_key(job.result["code"], p["snapshot"]) if artifacts is not None and p.get("snapshot") else None
+        if key and not p.get("force"):
+            # The LLM wrote the same script as an earlier run on the same data.
+            artifact = artifacts.get(key, reuse_max_age(p["snapshot"]))
+            if artifact is not None:
+                telemetry.count("artifacts_reused_total", kind=job.kind)
+                job.result.update(artifact.result, reused_at=artifact.created)
+                return
+
+        job.progress = "Executing analysis code..."
+        recent, printed = deque(maxlen=PROGRESS_LINES), 0
+
+        def show(lines: list[str]):
+            nonlocal printed
+            recent.extend(lines)
+            printed += len(lines)
+            job.progress = f"Executing analysis code... {printed:,} lines of output\n\n" + "\n".join(recent)
+
+        t0 = time.time()
+        stats = {}
+        try:
+            output, charts = run_code(job.result["code"], job.work_dir, pool, stats=stats, on_output=show)
+        except subprocess.TimeoutExpired:
+            job.error = "Code execution timed out"
+            if artifacts is not None:
+                # Keep what it printed before it was stopped, like a failed run.
+                result = dict(
+                    output="\n".join(recent), output_lines=printed,
+                    output_path=os.path.join(job.work_dir, STDOUT_NAME),
+                    charts=[str(p) for p in sorted(Path(job.work_dir).glob("*.png"))], exec_time=time.time() - t0,
+                )
+                job.result.update(artifacts.put(run_key(), job.work_dir, result).result)
+            return
+        result = dict(
+            output=output, output_lines=stats["output_lines"], output_path=stats["output_path"],
+            charts=charts, exec_time=time.time() - t0,
+        )
+        if artifacts is not None:
+            # Failed runs are kept too (their full output matters most), but
+            # under a key of their own so they are never served again.
+            reusable = key and stats["returncode"] == 0
+            result = artifacts.put(key if reusable else run_key(), job.work_dir, result).result
+        job.result.update(result)
+
+    return {"llm": [(GPU, generate), (CPU, execute)], "llm-cached": [(CPU, execute)]}
+
+
+def submit_llm_job(
+    queue: JobQueue, llm_cache: LLMCache, name: str, prompt: str, llm_url: str, model: str,
+    force: bool = False, owner: str | None = None, workflow: str = CUSTOM_QUERY,
+    artifacts: ArtifactStore | None = None, snapshot: dict | None = None,
+) -> str:
+    """Queue an LLM workflow, skipping the GPU stage when the response is cached.
+
+    With `artifacts` and the `snapshot` of the data the prompt names, a
+    cached response whose script already ran on that data is not executed
+    again: the job is recorded as done with the stored output and charts.
+    """
+    params = {"prompt": prompt, "llm_url": llm_url, "model": model, "workflow": workflow, "snapshot": snapshot, "force": force}
+    cached = None if force else llm_cache.get(cache_key(build_system_prompt(workflow), prompt, model, llm_url))
+    if cached:
+        telemetry.count("llm_cache_hits_total", model=model)
+        result = {"response": cached["response"], "code": cached["code"], "cached_at": cached["created"]}
+        if artifacts is not None and snapshot is not None:
+            artifact = artifacts.get(artifact_key(cached["code"], snapshot), reuse_max_age(snapshot))
+            if artifact is not None:
+                telemetry.count("artifacts_reused_total", kind="llm-cached")
+                return queue.record("llm-cached", name, params, owner, result={**result, **artifact.result, "reused_at": artifact.created})
+        return queue.submit("llm-cached", name, params, owner, result=result)
+    return queue.submit("llm", name, params, owner)
+
+
+def measure_key(kind: str, params: dict) -> str:
+    """Artifact key of a measure job: which measures, on which data, as of today."""
+    measure = json.dumps([kind, params.get("condition"), date.today().isoformat()])
+    return artifact_key(measure, data_snapshot(params["endpoints"], params["store_path"]))
+
+
+def submit_measure_job(
+    queue: JobQueue, kind: str, name: str, params: dict, owner: str | None = None,
+    artifacts: ArtifactStore | None = None, force: bool = False,
+) -> str:
+    """Queue a "measure" or "measure-all" job, or serve an identical earlier one from `artifacts`."""
+    if artifacts is not None and not force:
+        snapshot = data_snapshot(params["endpoints"], params["store_path"])
+        artifact = artifacts.get(measure_key(kind, params), reuse_max_age(snapshot))
+        if artifact is not None:
+            telemetry.count("artifacts_reused_total", kind=kind)
+            return queue.record(kind, name, params, owner, result={**artifact.result, "reused_at": artifact.created})
+    return queue.submit(kind, name, params, owner)
+
+
+def measure_job_stages(artifacts: ArtifactStore | None = None) -> list:
+    """The "measure" job kind: evaluate a preset gap measure on the CPU.
+
+    Params: condition, endpoints, store_path. Result: summary, report,
+    chart, gaps_csv, lab, timings, endpoint_stats. The report, chart and
+    CSV are stored in `artifacts` under `measure_key`.
+    """
+    def evaluate(job: Job):
+        p = job.params
+        key = measure_key(job.kind, p)
+        federation = None
+        job.progress = f"Loading cohort, latest labs and active medications from {p['store_path'] or ', '.join(p['endpoints'])}..."
+        try:
+            if p["store_path"]:
+                result = measures.run_measure(p["condition"], store=store_for(p["store_path"]))
+            else:
+                # Every configured endpoint is queried concurrently and the
+                # results merged by patient identifier.
+                federation = FederatedClient(p["endpoints"])
+                result = measures.run_measure(p["condition"], client=federation)
+        finally:
+            if federation is not None:
+                job.result["endpoint_stats"] = federation.stats
+        _store_measure_result(job, result, artifacts, key)
+
+    return [(CPU, evaluate)]
+
+
+def _store_measure_result(job: Job, result: measures.MeasureResult, artifacts: ArtifactStore | None, key: str):
+    job.progress = "Rendering report..."
+    with telemetry.span("measure.chart"):
+        chart = measures.chart(result, os.path.join(job.work_dir, "gap_chart.png"))
+    gaps_csv = os.path.join(job.work_dir, "gap_patients.csv")
+    result.gaps.to_csv(gaps_csv, index=False)
+    stored = dict(
+        summary=result.summary, report=measures.report(result), chart=chart, gaps_csv=gaps_csv,
+        lab=result.preset["lab"], timings=result.timings,
+    )
+    if artifacts is not None:
+        stored = artifacts.put(key, job.work_dir, stored).result
+    job.result.update(stored)
+
+
+def measure_preview_job_stages(artifacts: ArtifactStore | None = None) -> list:
+    """The "measure-preview" job kind: a preset measure on a growing random sample.
+
+    Params: condition, endpoints, store_path. Result: `estimates`, one per
+    batch (sampled, cohort, gaps, with_lab, gap_rate, low, high, elapsed).
+    When every patient is evaluated, the result also has everything a
+    "measure" job has, stored in `artifacts` as that "measure" job's result.
+    A stopped job keeps its estimates and sets `stopped`.
+    """
+    def evaluate(job: Job):
+        p = job.params
+        key = measure_key("measure", p)
+        federation = None
+        job.result["estimates"] = []
+        job.progress = f"Loading the cohort from {p['store_path'] or ', '.join(p['endpoints'])}..."
+        try:
+            if p["store_path"]:
+                estimates = measures.progressive_measure(p["condition"], store=store_for(p["store_path"]))
+            else:
+                federation = FederatedClient(p["endpoints"])
+                estimates = measures.progressive_measure(p["condition"], client=federation)
+            for estimate in estimates:
+                s = estimate.summary
+                job.result["estimates"].append({
+                    "sampled": estimate.sampled, "cohort": estimate.cohort, "gaps": s["gaps"], "with_lab": s["with_lab"],
+                    "gap_rate": s["gap_rate"], "low": estimate.low, "high": estimate.high, "elapsed": estimate.elapsed,
+                })
+                if estimate.exact:
+                    _store_measure_result(job, estimate.result, artifacts, key)
+                    break
+                if job.stop_requested:
+                    job.result["stopped"] = True
+                    break
+                job.progress = f"Sampled {estimate.sampled:,} of {estimate.cohort:,} patients, fetching the next batch..."
+        finally:
+            if federation is not None:
+                job.result["endpoint_stats"] = federation.stats
+
+    return [(CPU, evaluate)]
+
+
+def measure_batch_job_stages(artifacts: ArtifactStore | None = None) -> list:
+    """The "measure-all" job kind: every preset measure from one shared load.
+
+    Params: endpoints, store_path. Result: report, gaps_csv, fetched,
+    timings, endpoint_stats and per-condition `measures` (summary, lab,
+    chart). The report, charts and CSV are stored in `artifacts`.
+    """
+    def evaluate(job: Job):
+        p = job.params
+        key = measure_key(job.kind, p)
+        federation = None
+        job.progress = f"Loading every preset cohort, their labs and active medications from {p['store_path'] or ', '.join(p['endpoints'])}..."
+        try:
+            if p["store_path"]:
+                batch = measures.run_all_measures(store=store_for(p["store_path"]))
+            else:
+                federation = FederatedClient(p["endpoints"])
+                batch = measures.run_all_measures(client=federation)
+        finally:
+            if federation is not None:
+                job.result["endpoint_stats"] = federation.stats
+        job.progress = "Rendering report and charts..."
+        results = {}
+        for i, (condition, result) in enumerate(batch.results.items()):
+            with telemetry.span("measure.chart", condition=condition):
+                chart = measures.chart(result, os.path.join(job.work_dir, f"gap_chart_{i}.png"))
+            results[condition] = {"summary": result.summary, "lab": result.preset["lab"], "chart": chart}
+        gaps = [result.gaps.assign(condition=condition) for condition, result in batch.results.items()]
+        gaps_csv = os.path.join(job.work_dir, "gap_patients.csv")
+        pd.concat(gaps, ignore_index=True).to_csv(gaps_csv, index=False)
+        stored = dict(
+            measures=results, report=measures.batch_report(batch), gaps_csv=gaps_csv,
+            fetched=batch.fetched, timings=batch.timings,
+        )
+        if artifacts is not None:
+            stored = artifacts.put(key, job.work_dir, stored).result
+        job.result.update(stored)
+
+    return [(CPU, evaluate)]
@@ -0,0 +1,315 @@
+"""
+End-to-end workflow benchmark on synthetic cohorts.
+
+Generates a synthetic population per size (cached under
+~/.cache/clinical-intelligence/synthetic/), serves it with the local FHIR
+server, and drives the same workflow stages as the workbench against a stub
+LLM that streams canned analysis scripts:
+
+    query_llm -> extract_code -> run_code        (case summary, cohort query)
+    measures.run_measure                         (preset gap analysis)
+    measures.run_all_measures                    (every preset from one shared load)
+
+Reports p50/p95 latency, peak RSS and FHIR/LLM request counts per stage, and
+the system-prompt size of each LLM workflow, so regressions in the data layer,
+the execution pool, the measure engine or the prompts show up without a GPU
+or a network.
+
+Run: python scripts/benchmark.py [--sizes 1k,10k,100k,1m] [--runs 5] [--json results.json]
+
+The whole population is held in memory by the FHIR server; 100k patients
+needs a few GB of RAM and 1m patients tens of GB.
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+# Measure the uncached pipeline; set CLINICAL_FHIR_CACHE=memory to measure warm runs.
+os.environ.setdefault("CLINICAL_FHIR_CACHE", "off")
+
+import measures  # noqa: E402
+import synthetic  # noqa: E402
+from exec_pool import ExecutionPool  # noqa: E402
+from fhir_client import client_for  # noqa: E402
+from fhir_server import ResourceIndex, serve_in_background  # noqa: E402
+from llm_cache import CACHE_DIR  # noqa: E402
+from workflow import (  # noqa: E402
+    CASE_SUMMARY,
+    CUSTOM_QUERY,
+    case_summary_prompt,
+    custom_query_prompt,
+    data_source,
+    extract_code,
+    prompt_stats,
+    query_llm,
+    run_code,
+)
+
+DATA_DIR = CACHE_DIR / "synthetic"
+MODEL = "benchmark-stub"
+COHORT_QUESTION = "Find diabetic patients with HbA1c above 9% who are not on insulin or a GLP-1 agonist."
+
+# ---------------------------------------------------------------------------
+# Stub LLM
+# ---------------------------------------------------------------------------
+
+CASE_SUMMARY_SCRIPT = '''
+from fhir_client import FHIRClient
+from fhir_batch import effective_date, medication_name, observation_value
+
+client = FHIRClient("{url}")
+patient = next(client.search("Patient", {{"_count": 1}}))
+pid = patient["id"]
+conditions = client.search_all("Condition", {{"patient": pid}})
+observations = client.search_all("Observation", {{"patient": pid, "_sort": "-date"}})
+medications = client.search_all("MedicationRequest", {{"patient": pid}})
+
+name = patient["name"][0]
+print(f"Patient: {{' '.join(name['given'])}} {{name['family']}} ({{patient['gender']}}, born {{patient['birthDate']}})")
+print("Conditions:")
+for c in conditions:
+    print("  -", c["code"]["text"])
+print("Latest observations:")
+for obs in observations[:10]:
+    print("  -", effective_date(obs), obs["code"]["text"], observation_value(obs))
+print("Medications:")
+for m in medications:
+    print("  -", medication_name(m), m["status"])
+print("For research and operational purposes only. Clinical decisions should be made by qualified clinicians.")
+'''
+
+COHORT_SCRIPT = '''
+import pandas as pd
+import matplotlib.pyplot as plt
+from fhir_client import FHIRClient
+from fhir_batch import cohort_patient_ids, latest_values, medication_name, medications_by_patient
+
+client = FHIRClient("{url}")
+ids = cohort_patient_ids(client, "44054006")
+a1c = latest_values(client, ids, "4548-4")
+meds = medications_by_patient(client, ids, status="active")
+
+df = pd.DataFrame({{"patient_id": ids}})
+df["a1c"] = df["patient_id"].map(a1c)
+names = {{pid: " ".join(medication_name(m) for m in ms).lower() for pid, ms in meds.items()}}
+df["treated"] = df["patient_id"].map(names).fillna("").str.contains("insulin|glutide")
+gaps = df[(df["a1c"] > 9) & ~df["treated"]]
+print(f"Diabetic patients: {{len(df)}}, with HbA1c: {{df['a1c'].notna().sum()}}")
+print(f"Gaps: {{len(gaps)}} ({{len(gaps) / max(df['a1c'].notna().sum(), 1):.1%}})")
+df["a1c"].dropna().plot.hist(bins=20)
+plt.savefig("a1c_distribution.png")
+print("For research and operational purposes only. Clinical decisions should be made by qualified clinicians.")
+'''
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Minimal Ollama API that streams a canned script for the prompt's FHIR URL."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, obj: dict):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.count_request()
+        if self.path == "/api/tags":
+            return self._send_json({"models": [{"name": MODEL}]})
+        self.send_error(404)
+
+    def do_POST(self):
+        self.server.count_request()
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        prompt = request["messages"][-1]["content"]
+        url = re.search(r"https?://[\w.:-]+", prompt).group(0)
+        script = CASE_SUMMARY_SCRIPT if "case summary" in prompt else COHORT_SCRIPT
+        text = "```python\n" + script.format(url=url).strip() + "\n```"
+        pieces = [text[i:i + 8] for i in range(0, len(text), 8)]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, piece in enumerate(pieces + [""]):
+            chunk = {"message": {"content": piece}, "done": i == len(pieces)}
+            if chunk["done"]:
+                prompt_chars = sum(len(m["content"]) for m in request["messages"])
+                chunk.update(prompt_eval_count=prompt_chars // 4, eval_count=len(pieces))
+            line = (json.dumps(chunk) + "\n").encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    requests_served = 0
+    _count_lock = threading.Lock()
+
+    def count_request(self):
+        with self._count_lock:
+            self.requests_served += 1
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def peak_rss_kb() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class StageTimer:
+    """Collects latency, peak RSS and request counts per stage."""
+
+    def __init__(self, fhir_server, llm_server):
+        self.servers = {"fhir": fhir_server, "llm": llm_server}
+        self.samples: dict[str, list[dict]] = {}
+
+    def run(self, stage: str, fn, *args, **kwargs):
+        before = {k: s.requests_served for k, s in self.servers.items()}
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        sample = {
+            "seconds": time.perf_counter() - t0,
+            "peak_rss_kb": peak_rss_kb(),
+            **{f"{k}_requests": s.requests_served - before[k] for k, s in self.servers.items()},
+        }
+        self.samples.setdefault(stage, []).append(sample)
+        return result, sample
+
+    def summary(self) -> dict[str, dict]:
+        out = {}
+        for stage, samples in self.samples.items():
+            seconds = [s["seconds"] for s in samples]
+            out[stage] = {
+                "runs": len(samples),
+                "p50_ms": percentile(seconds, 50) * 1000,
+                "p95_ms": percentile(seconds, 95) * 1000,
+                "peak_rss_mb": max(s["peak_rss_kb"] for s in samples) / 1024,
+                "fhir_requests": sum(s["fhir_requests"] for s in samples) / len(samples),
+                "llm_requests": sum(s["llm_requests"] for s in samples) / len(samples),
+            }
+        return out
+
+
+def dataset(n_patients: int, seed: int) -> str:
+    path = DATA_DIR / f"{n_patients}-seed{seed}"
+    if not (path / "Patient.ndjson").exists():
+        print(f"  Generating {n_patients:,} patients in {path} ...")
+        synthetic.write_ndjson(path, n_patients, seed)
+    return str(path)
+
+
+def run_workflow(timer: StageTimer, name: str, workflow: str, prompt: str, llm_url: str, pool: ExecutionPool):
+    response, _ = timer.run(f"{name}: query_llm", query_llm, prompt, llm_url, MODEL, workflow)
+    code, _ = timer.run(f"{name}: extract_code", extract_code, response)
+    if code is None:
+        raise RuntimeError(f"no code in LLM response: {response[:200]}")
+    work_dir = tempfile.mkdtemp(prefix="clinical-bench-")
+    try:
+        stats = {}
+        (output, _), sample = timer.run(f"{name}: run_code", run_code, code, work_dir, pool, stats=stats)
+        # The script runs in a worker process; report its memory, not ours.
+        sample["peak_rss_kb"] = stats["peak_rss_kb"]
+        if stats["returncode"] != 0:
+            raise RuntimeError(f"{name} script failed:\n{output}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark(n_patients: int, runs: int, seed: int, pool: ExecutionPool, llm_server: StubLLMServer) -> dict:
+    print(f"\n{n_patients:,} patients")
+    path = dataset(n_patients, seed)
+    t0 = time.perf_counter()
+    index = ResourceIndex()
+    index.load_dir(path)
+    load_seconds = time.perf_counter() - t0
+    print(f"  Loaded {sum(index.counts().values()):,} resources in {load_seconds:.1f}s")
+
+    server = serve_in_background(index)
+    llm_url = f"http://127.0.0.1:{llm_server.server_address[1]}"
+    source = data_source({"Synthetic": server.base_url}, None)
+    prompts = {
+        "case summary": (CASE_SUMMARY, case_summary_prompt(source, "the first patient")),
+        "cohort query": (CUSTOM_QUERY, custom_query_prompt(source, COHORT_QUESTION)),
+    }
+    try:
+        timer = StageTimer(server, llm_server)
+        for _ in range(runs):
+            for name, (workflow, prompt) in prompts.items():
+                run_workflow(timer, name, workflow, prompt, llm_url, pool)
+            timer.run("measure: run_measure", measures.run_measure, "Diabetes Mellitus Type 2",
+                      client=client_for(server.base_url))
+            timer.run("measures: run_all_measures", measures.run_all_measures, client=client_for(server.base_url))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {"patients": n_patients, "resources": index.counts(), "load_seconds": load_seconds,
+            "stages": timer.summary(), "prompts": {workflow: prompt_stats(workflow) for workflow, _ in prompts.values()}}
+
+
+def print_report(result: dict):
+    print(f"  {'stage':<28} {'p50 ms':>9} {'p95 ms':>9} {'peak RSS MB':>12} {'FHIR req':>9} {'LLM req':>8}")
+    for stage, s in result["stages"].items():
+        print(f"  {stage:<28} {s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['peak_rss_mb']:>12.0f} "
+              f"{s['fhir_requests']:>9.1f} {s['llm_requests']:>8.1f}")
+    for workflow, p in result["prompts"].items():
+        skills = ", ".join(f"{name} ~{tokens:,}" for name, tokens in p["skill_tokens"].items())
+        print(f"  {workflow} system prompt: ~{p['system_tokens']:,} tokens ({skills})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1k", help="comma-separated cohort sizes (default: 1k)")
+    parser.add_argument("--runs", type=int, default=5, help="runs of each workflow per size (default: 5)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    llm_server = StubLLMServer(("127.0.0.1", 0), StubLLMHandler)
+    threading.Thread(target=llm_server.serve_forever, daemon=True).start()
+    pool = ExecutionPool(size=1)
+    results = []
+    try:
+        for size in args.sizes.split(","):
+            result = benchmark(synthetic.parse_size(size), args.runs, args.seed, pool, llm_server)
+            print_report(result)
+            results.append(result)
+    finally:
+        pool.close()
+        llm_server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved {args.json}")
+
+
+if __name__ == "__main__":
+    main()
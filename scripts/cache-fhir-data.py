@@ -2,40 +2,91 @@
 Pre-caches FHIR responses to local JSON files as a fallback
 in case the FHIR test server is slow or unreachable during the demo.
 
-Run: python scripts/cache-fhir-data.py
+Run: python scripts/cache-fhir-data.py [--incremental | --bulk] [--store fallback-data/clinical.db]
 
-Saves to: fallback-data/
+Saves to: fallback-data/ (and, with --store, the local clinical store)
+
+--incremental refreshes an existing cache: it only pulls resources changed
+since the last run (per-type `_lastUpdated` high-water marks kept in
+fallback-data/sync-state.json) and merges updates and deletions in place.
+
+--bulk uses the FHIR Bulk Data $export operation instead of paged searches,
+streaming NDJSON files to fallback-data/bulk/ (for servers that support it).
 """
 
+import argparse
 import json
 import os
 import sys
 
-import requests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import bulk_export  # noqa: E402
+import fhir_sync  # noqa: E402
+from clinical_store import ClinicalStore  # noqa: E402
+from fhir_client import FHIRClient  # noqa: E402
 
 BASE = "https://r4.smarthealthit.org"
 OUT_DIR = os.path.join(os.path.dirname(__file__), "..", "fallback-data")
+STATE_FILE = os.path.join(OUT_DIR, "sync-state.json")
+
+# A snapshot must be current: revalidate every cached response (unchanged
+# ones come back as bodiless 304s).
+client = FHIRClient(BASE, max_age=0)
+store = None
+
 
+def searches(pid):
+    """(path, filename, max_pages) for every cached search."""
+    return [
+        ("/Patient?_count=20", "patients.json", 1),
+        (f"/Condition?patient={pid}&_count=100", "conditions.json", None),
+        (f"/Observation?patient={pid}&_count=100", "observations.json", None),
+        (f"/MedicationRequest?patient={pid}&_count=100", "medications.json", None),
+        (f"/Encounter?patient={pid}&_count=100", "encounters.json", None),
+        # Broader condition searches for cohort analysis
+        ("/Condition?code=44054006&_count=200", "diabetic-patients.json", None),
+        ("/Condition?code=38341003&_count=200", "hypertensive-patients.json", None),
+    ]
 
-def cache(path, filename):
-    url = f"{BASE}{path}"
-    print(f"  Fetching {url} ...")
-    r = requests.get(url, timeout=15)
-    r.raise_for_status()
-    data = r.json()
+
+def save(filename, data):
     filepath = os.path.join(OUT_DIR, filename)
     with open(filepath, "w") as f:
         json.dump(data, f, indent=2)
+    return filepath
+
+
+def cache(path, filename, max_pages=None):
+    print(f"  Fetching {BASE}{path} ...")
+    data = client.bundle(path, max_pages=max_pages)
+    filepath = save(filename, data)
     count = len(data.get("entry", []))
     print(f"    -> {filepath} ({count} entries)")
+    if store is not None:
+        store.ingest_bundle(data)
     return data
 
 
-def main():
+def refresh(path, filename, max_pages, marks):
+    """Pull changes since the type's mark for one cached search and merge them."""
+    since = marks.get(fhir_sync.resource_type(path))
+    changed = fhir_sync.fetch_changes(client, path, since)
+    with open(os.path.join(OUT_DIR, filename)) as f:
+        bundle = json.load(f)
+    bundle, stats = fhir_sync.merge(bundle, changed, base_url=BASE, replace_only=max_pages is not None)
+    save(filename, bundle)
+    if store is not None and changed:
+        store.ingest(changed)
+    print(f"  {filename}: {len(changed)} changed (+{stats['added']} new, {stats['updated']} updated)")
+    return changed
+
+
+def full_refresh():
     os.makedirs(OUT_DIR, exist_ok=True)
     print(f"Caching FHIR data from {BASE}\n")
 
-    patients = cache("/Patient?_count=20", "patients.json")
+    patients = cache(*searches(None)[0])
 
     if not patients.get("entry"):
         print("No patients found.")
@@ -46,23 +97,101 @@ def main():
     display = f"{name.get('given', ['?'])[0]} {name.get('family', '?')}"
     print(f"\nCaching data for: {display} (ID: {pid})\n")
 
-    cache(f"/Condition?patient={pid}&_count=100", "conditions.json")
-    cache(f"/Observation?patient={pid}&_count=100", "observations.json")
-    cache(f"/MedicationRequest?patient={pid}&_count=100", "medications.json")
-    cache(f"/Encounter?patient={pid}&_count=100", "encounters.json")
-
-    # Cache broader condition searches for cohort analysis
-    print("\nCaching cohort data...\n")
-    cache("/Condition?code=44054006&_count=200", "diabetic-patients.json")
-    cache("/Condition?code=38341003&_count=200", "hypertensive-patients.json")
+    # Per-patient and cohort searches are independent, so fetch them
+    # concurrently over the client's pooled connections.
+    bundles = [patients] + client.map(lambda job: cache(*job), searches(pid)[1:])
 
     info = {"patient_id": pid, "patient_name": display, "base_url": BASE}
     with open(os.path.join(OUT_DIR, "demo-info.json"), "w") as f:
         json.dump(info, f, indent=2)
 
+    state = {"base_url": BASE, "marks": {}}
+    for bundle in bundles:
+        fhir_sync.record_marks(state, (e["resource"] for e in bundle.get("entry", []) if "resource" in e))
+    fhir_sync.save_state(STATE_FILE, state)
+
     print(f"\nDone. Fallback data saved to {OUT_DIR}/")
     print(f"Demo patient: {display} (ID: {pid})")
 
 
+def incremental_refresh():
+    state = fhir_sync.load_state(STATE_FILE)
+    info_path = os.path.join(OUT_DIR, "demo-info.json")
+    if not state.get("marks") or state.get("base_url") != BASE or not os.path.exists(info_path):
+        print("No sync state for this server -- running a full refresh.\n")
+        return full_refresh()
+
+    with open(info_path) as f:
+        pid = json.load(f)["patient_id"]
+    marks = state["marks"]
+    print(f"Incremental sync from {BASE}")
+    for rtype, mark in sorted(marks.items()):
+        print(f"  {rtype}: changes since {mark}")
+    print()
+
+    jobs = searches(pid)
+    changed = client.map(lambda job: refresh(*job, marks), jobs)
+
+    # Deletions do not show up in searches; read them from each type's history.
+    types = sorted({fhir_sync.resource_type(path) for path, _, _ in jobs})
+    deleted = set().union(*client.map(lambda t: fhir_sync.fetch_deletions(client, t, marks[t]) if t in marks else set(), types))
+    if deleted:
+        for path, filename, _ in jobs:
+            with open(os.path.join(OUT_DIR, filename)) as f:
+                bundle, stats = fhir_sync.merge(json.load(f), [], deleted)
+            if stats["removed"]:
+                save(filename, bundle)
+                print(f"  {filename}: {stats['removed']} deleted")
+        if store is not None:
+            for ref in deleted:
+                store.delete(*ref.split("/", 1))
+
+    for resources in changed:
+        fhir_sync.record_marks(state, resources)
+    fhir_sync.save_state(STATE_FILE, state)
+    print(f"\nDone. {sum(map(len, changed))} changed, {len(deleted)} deleted.")
+
+
+def bulk_refresh(types):
+    bulk_dir = os.path.join(OUT_DIR, "bulk")
+    print(f"Bulk $export from {BASE} -> {bulk_dir}/\n")
+    paths = bulk_export.export(client, bulk_dir, types=types)
+    for path in paths:
+        print(f"  -> {path} ({path.stat().st_size:,} bytes)")
+        if store is not None:
+            store.ingest_file(path)
+    print(f"\nDone. {len(paths)} NDJSON files saved to {bulk_dir}/")
+
+
+def main():
+    global BASE, OUT_DIR, STATE_FILE, client, store
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--incremental", action="store_true", help="only pull changes since the last run")
+    mode.add_argument("--bulk", action="store_true", help="use the Bulk Data $export operation")
+    parser.add_argument("--types", default="Patient,Condition,Observation,MedicationRequest,Encounter",
+                        help="resource types for --bulk (comma-separated)")
+    parser.add_argument("--store", help="also load everything into this local clinical store (SQLite)")
+    parser.add_argument("--base", default=BASE, help=f"FHIR base URL (default: {BASE})")
+    parser.add_argument("--out", default=OUT_DIR, help="cache directory (default: fallback-data/)")
+    args = parser.parse_args()
+
+    BASE, OUT_DIR = args.base.rstrip("/"), args.out
+    STATE_FILE = os.path.join(OUT_DIR, "sync-state.json")
+    client = FHIRClient(BASE, max_age=0)
+    if args.store:
+        store = ClinicalStore(args.store)
+
+    if args.bulk:
+        bulk_refresh(args.types.split(","))
+    elif args.incremental:
+        incremental_refresh()
+    else:
+        full_refresh()
+
+    if store is not None:
+        print(f"Clinical store {args.store}: {store.counts()}")
+
+
 if __name__ == "__main__":
     main()
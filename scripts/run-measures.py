@@ -0,0 +1,339 @@
+"""
+Headless batch runner for the preset quality measures (nightly reports).
+
+Evaluates the CMS122/CMS165/CMS135 and CKD gap measures over a whole
+population without the workbench:
+
+1. The union of the preset cohorts is selected once, from the clinical store
+   or the FHIR endpoints.
+2. The patients are split into shards of --shard-size and evaluated on a
+   process pool (--workers). Each shard loads only its own patients' labs and
+   medications, with the same batched searches as the workbench.
+3. Every finished shard is checkpointed under OUT/shards/. Re-running the
+   same command after an interruption resumes: finished shards are skipped.
+4. The shards are merged into OUT/measures.<fmt> (one row per patient and
+   measure), OUT/gaps.<fmt>, OUT/report.txt and OUT/summary.json.
+
+Run: python scripts/run-measures.py --out reports/2026-10 [--store fallback-data/clinical.db | --endpoint URL ...]
+         [--conditions "Hypertension,Heart Failure"] [--workers 4] [--shard-size 5000]
+         [--format csv,parquet,json] [--as-of 2026-10-01] [--fresh]
+
+With --question, one free-text query goes through the LLM workflow instead
+(build_system_prompt -> query_llm -> extract_code -> run_code), and its
+output, script and charts are written to OUT.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from multiprocessing import get_all_start_methods, get_context
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import pandas as pd  # noqa: E402
+
+import measures  # noqa: E402
+from clinical_store import store_for  # noqa: E402
+from exec_pool import ExecutionPool  # noqa: E402
+from fhir_federated import FederatedClient  # noqa: E402
+from workflow import (  # noqa: E402
+    DEFAULT_FHIR,
+    custom_query_prompt,
+    data_source,
+    extract_code,
+    query_llm,
+    run_code,
+)
+
+FORMATS = ("csv", "parquet", "json")
+DEFAULT_SHARD_SIZE = 5000
+RUN_FILE = "run.json"
+POPULATION_FILE = "population.pkl"
+
+# ---------------------------------------------------------------------------
+# Data source
+# ---------------------------------------------------------------------------
+
+
+def parse_endpoints(values: list[str] | None) -> dict[str, str]:
+    """{name: url} from `--endpoint URL` or `--endpoint NAME=URL` flags."""
+    endpoints = {}
+    for value in values or [DEFAULT_FHIR]:
+        name, _, url = value.partition("=") if "=" in value.split("://")[0] else ("", "", value)
+        endpoints[name or url] = url.rstrip("/")
+    return endpoints
+
+
+def open_source(source: dict) -> dict:
+    """`store=` or `client=` for the measure engine, opened in this process."""
+    if source["store"]:
+        return {"store": store_for(source["store"])}
+    return {"client": FederatedClient(source["endpoints"])}
+
+
+def load_cohorts(source: dict, presets: dict[str, dict]) -> tuple[dict[str, list[str]], pd.DataFrame]:
+    kwargs = open_source(source)
+    if "store" in kwargs:
+        return measures.cohorts_from_store(kwargs["store"], presets)
+    return measures.cohorts_from_fhir(kwargs["client"], presets)
+
+
+# ---------------------------------------------------------------------------
+# Shards
+# ---------------------------------------------------------------------------
+
+
+def shard_path(shard_dir: Path, index: int, suffix: str) -> Path:
+    return shard_dir / f"{index:05d}{suffix}"
+
+
+def run_shard(index: int, source: dict, conditions: list[str], cohorts: dict[str, list[str]],
+              patients: pd.DataFrame, as_of: str, shard_dir: Path) -> dict:
+    """Evaluate every measure for one shard of patients and checkpoint the rows.
+
+    Runs in a pool process. The rows go to `<index>.pkl` and the shard's
+    counts to `<index>.json`, which is written last and marks it finished.
+    """
+    t0 = time.perf_counter()
+    presets = {c: measures.PRESET_CONDITIONS[c] for c in conditions}
+    ids = patients["patient_id"].tolist()
+    kwargs = open_source(source)
+    if "store" in kwargs:
+        labs, meds = measures.patient_data_from_store(kwargs["store"], presets, ids)
+    else:
+        labs, meds = measures.patient_data_from_fhir(kwargs["client"], presets, ids)
+    frames = measures.evaluate_all(presets, cohorts, patients, labs, meds, date.fromisoformat(as_of))
+    rows = pd.concat([f.assign(condition=c) for c, f in frames.items()], ignore_index=True)
+
+    tmp = shard_path(shard_dir, index, ".pkl.tmp")
+    rows.to_pickle(tmp)
+    os.replace(tmp, shard_path(shard_dir, index, ".pkl"))
+    info = {
+        "shard": index, "patients": len(ids), "rows": len(rows), "labs": sum(map(len, labs.values())),
+        "medications": len(meds), "seconds": time.perf_counter() - t0,
+    }
+    shard_path(shard_dir, index, ".json").write_text(json.dumps(info))
+    return info
+
+
+def plan(out: Path, run: dict, source: dict, presets: dict[str, dict], fresh: bool) -> tuple[dict, pd.DataFrame, dict]:
+    """Start a run in `out`, or resume the one already there.
+
+    Returns (run, patients, cohorts). The population is selected once and
+    saved with the checkpoints, so a resumed run shards the same patients.
+    """
+    shard_dir = out / "shards"
+    run_file = out / RUN_FILE
+    if fresh:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        run_file.unlink(missing_ok=True)
+    if run_file.exists():
+        previous = json.loads(run_file.read_text())
+        explicit = {k: v for k, v in run.items() if v is not None}
+        changed = [k for k, v in explicit.items() if previous.get(k) != v]
+        if changed:
+            sys.exit(f"{out} holds a run with different {', '.join(changed)}; pass --fresh or another --out")
+        cohorts, patients = pd.read_pickle(shard_dir / POPULATION_FILE)
+        print(f"Resuming run started {previous['started']}")
+        return previous, patients, cohorts
+
+    t0 = time.perf_counter()
+    print("Selecting cohorts ...")
+    cohorts, patients = load_cohorts(source, presets)
+    patients = patients.sort_values("patient_id", ignore_index=True)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    pd.to_pickle((cohorts, patients), shard_dir / POPULATION_FILE)
+    run = {
+        **run, "shard_size": run["shard_size"] or DEFAULT_SHARD_SIZE, "as_of": run["as_of"] or date.today().isoformat(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "cohort_seconds": time.perf_counter() - t0,
+    }
+    run_file.write_text(json.dumps(run, indent=2))
+    return run, patients, cohorts
+
+
+def run_measures(args, source: dict):
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    conditions = [c.strip() for c in args.conditions.split(",")] if args.conditions else list(measures.PRESET_CONDITIONS)
+    unknown = [c for c in conditions if c not in measures.PRESET_CONDITIONS]
+    if unknown:
+        sys.exit(f"unknown condition(s): {', '.join(unknown)} (choose from {', '.join(measures.PRESET_CONDITIONS)})")
+    presets = {c: measures.PRESET_CONDITIONS[c] for c in conditions}
+    requested = {"source": source, "conditions": conditions, "shard_size": args.shard_size, "as_of": args.as_of}
+    run, patients, cohorts = plan(out, requested, source, presets, args.fresh)
+
+    shard_dir = out / "shards"
+    n_shards = max(1, -(-len(patients) // run["shard_size"]))
+    done = {i for i in range(n_shards) if shard_path(shard_dir, i, ".json").exists()}
+    todo = [i for i in range(n_shards) if i not in done]
+    print(f"{len(patients):,} patients in {n_shards} shards of {run['shard_size']:,}"
+          + (f" ({len(done)} already finished)" if done else ""))
+
+    member_of: dict[str, list[str]] = {}
+    for condition, ids in cohorts.items():
+        for pid in ids:
+            member_of.setdefault(pid, []).append(condition)
+
+    t0 = time.perf_counter()
+    if todo:
+        method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=get_context(method)) as pool:
+            futures = []
+            for i in todo:
+                shard = patients.iloc[i * run["shard_size"]:(i + 1) * run["shard_size"]]
+                shard_cohorts = {c: [] for c in conditions}
+                for pid in shard["patient_id"]:
+                    for condition in member_of.get(pid, []):
+                        shard_cohorts[condition].append(pid)
+                futures.append(pool.submit(run_shard, i, source, conditions, shard_cohorts, shard, run["as_of"], shard_dir))
+            try:
+                for n, future in enumerate(as_completed(futures), len(done) + 1):
+                    info = future.result()
+                    print(f"  [{n}/{n_shards}] shard {info['shard']}: {info['patients']:,} patients in {info['seconds']:.1f}s")
+            except BaseException:
+                # Keep the shards already checkpointed; the next run resumes from them.
+                for future in futures:
+                    future.cancel()
+                raise
+
+    write_outputs(out, run, conditions, n_shards, args.formats, time.perf_counter() - t0)
+
+
+def write_outputs(out: Path, run: dict, conditions: list[str], n_shards: int, formats: list[str], seconds: float):
+    """Merge the shard checkpoints into the report files."""
+    shard_dir = out / "shards"
+    rows = pd.concat([pd.read_pickle(shard_path(shard_dir, i, ".pkl")) for i in range(n_shards)], ignore_index=True)
+    rows = rows[["condition", *[c for c in rows.columns if c != "condition"]]]
+    shards = [json.loads(shard_path(shard_dir, i, ".json").read_text()) for i in range(n_shards)]
+
+    results = {}
+    for condition in conditions:
+        frame = rows[rows["condition"] == condition].drop(columns="condition")
+        frame = frame.sort_values("patient_id", ignore_index=True)
+        results[condition] = measures.MeasureResult(condition, measures.PRESET_CONDITIONS[condition], frame, measures.summarize(frame))
+    fetched = {
+        "patients": sum(s["patients"] for s in shards),
+        "memberships": len(rows),
+        "labs": sum(s["labs"] for s in shards),
+        "medications": sum(s["medications"] for s in shards),
+    }
+    batch = measures.BatchResult(results, fetched, {"shards": sum(s["seconds"] for s in shards)})
+
+    gaps = rows[rows["gap"]]
+    for fmt in formats:
+        for name, frame in (("measures", rows), ("gaps", gaps)):
+            path = out / f"{name}.{fmt}"
+            if fmt == "csv":
+                frame.to_csv(path, index=False)
+            elif fmt == "parquet":
+                frame.to_parquet(path, index=False)
+            else:
+                frame.to_json(path, orient="records", indent=1)
+    (out / "report.txt").write_text(measures.batch_report(batch))
+    summary = {
+        **run,
+        "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "shards": n_shards,
+        "fetched": fetched,
+        "shard_seconds": batch.timings["shards"],
+        "wall_seconds": seconds,
+        "measures": {
+            condition: {"measure": result.preset["measure"], **result.summary}
+            for condition, result in results.items()
+        },
+    }
+    (out / "summary.json").write_text(json.dumps(summary, indent=2))
+
+    for condition, result in results.items():
+        s = result.summary
+        print(f"  {condition:<26} {s['gaps']:>7,} gaps / {s['with_lab']:>8,} with lab ({s['gap_rate']:.1%}), {s['no_lab']:,} without")
+    print(f"Wrote {', '.join(f'{n}.{f}' for f in formats for n in ('measures', 'gaps'))}, report.txt, summary.json to {out}")
+
+
+# ---------------------------------------------------------------------------
+# LLM workflow
+# ---------------------------------------------------------------------------
+
+
+def run_question(args, source: dict):
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    prompt = custom_query_prompt(data_source(source["endpoints"], source["store"]), args.question)
+    t0 = time.perf_counter()
+    print(f"Generating analysis code with {args.model} ...")
+    response = query_llm(prompt, args.llm_url, args.model)
+    code = extract_code(response)
+    llm_seconds = time.perf_counter() - t0
+    if code is None:
+        (out / "response.md").write_text(response)
+        sys.exit(f"The LLM response had no code block; saved it to {out / 'response.md'}")
+    (out / "analysis.py").write_text(code)
+
+    print("Running it ...")
+    pool = ExecutionPool(size=1)
+    stats = {}
+    try:
+        # The script's output is echoed as it prints, not held until it ends.
+        output, charts = run_code(code, str(out), pool, stats=stats, on_output=lambda lines: print(*lines, sep="\n"))
+    finally:
+        pool.close()
+    shutil.copyfile(stats["output_path"], out / "report.txt")
+    summary = {
+        "question": args.question, "source": source, "model": args.model, "returncode": stats["returncode"],
+        "llm_seconds": llm_seconds, "exec_seconds": time.perf_counter() - t0 - llm_seconds,
+        "charts": [Path(c).name for c in charts],
+    }
+    (out / "summary.json").write_text(json.dumps(summary, indent=2))
+    if stats["returncode"] != 0:
+        print(output.split("\n\nSTDERR:\n", 1)[-1], file=sys.stderr)
+        sys.exit(stats["returncode"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--out", required=True, help="output directory (also holds the checkpoints)")
+    parser.add_argument("--store", help="evaluate against this clinical store instead of FHIR endpoints")
+    parser.add_argument("--endpoint", action="append", help=f"FHIR endpoint URL or NAME=URL, repeatable (default: {DEFAULT_FHIR})")
+    parser.add_argument("--conditions", help="comma-separated preset conditions (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="shard processes (default: CPU count)")
+    parser.add_argument("--shard-size", type=int, help=f"patients per shard (default: {DEFAULT_SHARD_SIZE})")
+    parser.add_argument("--format", default="csv,json", help="comma-separated output formats: csv, parquet, json (default: csv,json)")
+    parser.add_argument("--as-of", help="measurement date, YYYY-MM-DD (default: today)")
+    parser.add_argument("--fresh", action="store_true", help="discard checkpoints of a previous run in --out")
+    parser.add_argument("--question", help="run this free-text query through the LLM workflow instead")
+    parser.add_argument("--llm-url", default="http://localhost:11434")
+    parser.add_argument("--model", default="glm-4.7-flash:bf16")
+    args = parser.parse_args()
+
+    args.formats = [f.strip() for f in args.format.split(",") if f.strip()]
+    bad = [f for f in args.formats if f not in FORMATS]
+    if bad:
+        parser.error(f"unknown format(s): {', '.join(bad)}")
+    if "parquet" in args.formats:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+    if args.as_of:
+        try:
+            date.fromisoformat(args.as_of)
+        except ValueError:
+            parser.error(f"--as-of {args.as_of!r} is not a YYYY-MM-DD date")
+    if args.shard_size is not None and args.shard_size < 1:
+        parser.error("--shard-size must be positive")
+
+    source = {"store": args.store, "endpoints": {} if args.store else parse_endpoints(args.endpoint)}
+    if args.question:
+        run_question(args, source)
+    else:
+        run_measures(args, source)
+
+
+if __name__ == "__main__":
+    main()
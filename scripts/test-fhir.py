@@ -2,23 +2,25 @@
 Quick test script to verify the FHIR test server is reachable
 and has usable patient data for the demo.
 
-Run: python scripts/test-fhir.py
+Run: python scripts/test-fhir.py [base-url]
 """
 
-import json
+import os
 import sys
 
-import requests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
 
-BASE = "https://r4.smarthealthit.org"
+from fhir_client import FHIRClient  # noqa: E402
+
+BASE = sys.argv[1].rstrip("/") if len(sys.argv) > 1 else "https://r4.smarthealthit.org"
+
+# Always reach the server: cached responses are revalidated, not trusted.
+client = FHIRClient(BASE, retries=1, timeout=10, max_age=0)
 
 
 def test_endpoint(path, label):
-    url = f"{BASE}{path}"
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        data = client.get(path)
         count = len(data.get("entry", []))
         print(f"  {label}: {count} results")
         return data
@@ -40,7 +42,7 @@ def main():
     display = f"{name.get('given', ['?'])[0]} {name.get('family', '?')}"
     print(f"\nUsing test patient: {display} (ID: {pid})\n")
 
-    test_endpoint(f"/Condition?patient={pid}&_count=50", "Conditions")
+    conditions = test_endpoint(f"/Condition?patient={pid}&_count=50", "Conditions")
     test_endpoint(f"/Observation?patient={pid}&_count=50", "Observations (labs/vitals)")
     test_endpoint(f"/MedicationRequest?patient={pid}&_count=50", "Medications")
     test_endpoint(f"/Encounter?patient={pid}&_count=50", "Encounters")
@@ -48,8 +50,7 @@ def main():
     print(f"\nGood patient for demo: {display} (ID: {pid})")
     print("Use this patient ID in your demo commands.\n")
 
-    conditions = requests.get(f"{BASE}/Condition?patient={pid}&_count=50").json()
-    if conditions.get("entry"):
+    if conditions and conditions.get("entry"):
         print("Active conditions:")
         for e in conditions["entry"]:
             code = e["resource"]["code"]["coding"][0]
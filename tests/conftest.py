@@ -0,0 +1,36 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "app"))
+
+import fhir_server  # noqa: E402
+import synthetic  # noqa: E402
+from clinical_store import ClinicalStore  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fallback_store(tmp_path_factory):
+    """The cached demo Bundles in fallback-data/, loaded into a fresh store."""
+    store = ClinicalStore(tmp_path_factory.mktemp("store") / "clinical.db")
+    store.ingest_dir(ROOT / "fallback-data")
+    yield store
+    store.close()
+
+
+@pytest.fixture(scope="session")
+def synthetic_index():
+    """A small deterministic synthetic population, indexed for the local FHIR server."""
+    index = fhir_server.ResourceIndex()
+    index.add(synthetic.generate(300, seed=1))
+    return index
+
+
+@pytest.fixture(scope="session")
+def fhir_url(synthetic_index):
+    """Base URL of a local FHIR server over `synthetic_index`."""
+    server = fhir_server.serve_in_background(synthetic_index)
+    yield server.base_url
+    server.shutdown()
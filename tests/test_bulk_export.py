@@ -0,0 +1,35 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import bulk_export
+from fhir_client import FHIRClient
+
+
+def test_export_through_local_server(synthetic_index, fhir_url, tmp_path):
+    client = FHIRClient(fhir_url, cache=False)
+    paths = bulk_export.export(client, tmp_path, types=["Patient", "Condition"], poll_interval=0)
+    assert sorted(p.name for p in paths) == ["Condition.1.ndjson", "Patient.1.ndjson"]
+    for path in paths:
+        resources = [json.loads(line) for line in path.read_text().splitlines()]
+        rtype = path.name.split(".")[0]
+        assert {r["id"] for r in resources} == set(synthetic_index.resources[rtype])
+
+
+def test_export_status_is_gone_after_download(fhir_url, tmp_path):
+    client = FHIRClient(fhir_url, cache=False)
+    status_url = bulk_export.kick_off(client, types=["Patient"])
+    bulk_export.poll(client, status_url, interval=0)
+    client.session.delete(status_url)
+    assert client.session.get(status_url).status_code == 404
+    with pytest.raises(bulk_export.BulkExportError):
+        bulk_export.poll(client, status_url, interval=0)
+
+
+def test_cache_script_rejects_bulk_with_incremental():
+    script = Path(__file__).resolve().parent.parent / "scripts" / "cache-fhir-data.py"
+    run = subprocess.run([sys.executable, script, "--bulk", "--incremental"], capture_output=True, text=True)
+    assert run.returncode == 2 and "not allowed with" in run.stderr
@@ -0,0 +1,18 @@
+from clinical_store import ClinicalStore
+
+
+def observation(version: int, value: float) -> dict:
+    return {
+        "resourceType": "Observation", "id": "a1c", "subject": {"reference": "Patient/p1"},
+        "meta": {"versionId": str(version)}, "effectiveDateTime": f"2025-0{version}-01T00:00:00Z",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "4548-4"}]},
+        "valueQuantity": {"value": value, "unit": "%"},
+    }
+
+
+def test_ingest_keeps_last_version_within_a_batch(tmp_path):
+    store = ClinicalStore(tmp_path / "clinical.db")
+    assert store.ingest([observation(1, 7.0), observation(2, 9.5)]) == 1
+    rows = store.observations("p1")
+    assert rows["value"].tolist() == [9.5]
+    assert store.latest_observations("4548-4")["value"].tolist() == [9.5]
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from exec_pool import ExecutionPool
+
+
+def running(pid: int) -> bool:
+    """Alive and not a zombie (killed processes may wait for a reaper that never comes)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = ExecutionPool(size=1, timeout=30, memory_mb=None)
+    yield pool
+    pool.close()
+
+
+def test_scripts_do_not_share_state(pool, tmp_path):
+    first = "import pandas as pd, json\npd.set_option('display.max_rows', 3)\njson.dumps = None\nimport fhir_client\nfhir_client.LEAKED = 1\n"
+    second = "import pandas as pd, json, fhir_client\nprint(pd.get_option('display.max_rows'), json.dumps is None, hasattr(fhir_client, 'LEAKED'))\n"
+    for i, code in enumerate((first, second)):
+        work_dir = tmp_path / str(i)
+        work_dir.mkdir()
+        result = pool.run(code, str(work_dir))
+        assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ["60", "False", "False"]
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_worker_death_and_timeout_are_reported(pool, tmp_path):
+    result = pool.run("import os\nos._exit(3)\n", str(tmp_path))
+    assert result.returncode == 3
+    marker = tmp_path / "pid"
+    with pytest.raises(subprocess.TimeoutExpired):
+        pool.run(f"import os, time\nopen({str(marker)!r}, 'w').write(str(os.getpid()))\ntime.sleep(60)\n", str(tmp_path), timeout=1)
+    time.sleep(0.2)
+    assert not running(int(marker.read_text()))     # the timed-out script was killed with its worker
+    assert pool.run("print('ok')", str(tmp_path)).stdout == "ok\n"
@@ -0,0 +1,42 @@
+import threading
+
+import fhir_batch
+import fhir_server
+from fhir_client import FHIRClient
+
+DIABETES = "44054006"
+
+
+class LenientHandler(fhir_server.FHIRRequestHandler):
+    """Ignores `_has`, as servers that do not support it may: every Patient comes back."""
+
+    def _search(self, rtype, params, base):
+        params = {k: v for k, v in params.items() if not k.startswith("_has")}
+        return super()._search(rtype, params, base)
+
+
+def diabetics(index) -> list[str]:
+    return sorted({
+        r["subject"]["reference"].split("/")[-1] for r in index.resources["Condition"].values()
+        if any(c["code"] == DIABETES for c in r["code"]["coding"])
+    })
+
+
+def test_cohort_patients_uses_has_when_applied(synthetic_index, fhir_url):
+    client = FHIRClient(fhir_url, cache=False)
+    assert client.supports("Patient", "_has:Condition:patient:code", DIABETES)
+    assert sorted(fhir_batch.cohort_patient_ids(client, DIABETES)) == diabetics(synthetic_index)
+
+
+def test_cohort_patients_falls_back_when_has_is_ignored(synthetic_index):
+    handler = type("Handler", (LenientHandler,), {"index": synthetic_index})
+    server = fhir_server.FHIRServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = FHIRClient(server.base_url, cache=False)
+        assert not client.supports("Patient", "_has:Condition:patient:code", DIABETES)
+        cohort = fhir_batch.cohort_patients(client, DIABETES, elements="id,gender,birthDate")
+        assert sorted(p["id"] for p in cohort) == diabetics(synthetic_index)
+        assert all("birthDate" in p for p in cohort)
+    finally:
+        server.shutdown()
@@ -0,0 +1,18 @@
+import pytest
+
+from fhir_client import FHIRClient
+
+
+@pytest.mark.parametrize("path, key", [
+    ("Observation", "Observation"),
+    ("Observation/obs-1", "Observation"),
+    ("Observation/_history", "_history"),
+    ("Patient/p-1/_history/2", "_history"),
+    ("$export", "$export"),
+    ("Patient/$export", "$export"),
+    ("$export-status/abc", "$export"),
+])
+def test_history_and_export_use_their_own_cache_ttl(path, key):
+    client = FHIRClient("http://fhir.example/r4", cache=False)
+    assert client._resource_type(client.url(path)) == key
+
@@ -0,0 +1,33 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fhir_batch import cohort_patient_ids
+from fhir_federated import FederatedClient
+
+
+class HTMLHandler(BaseHTTPRequestHandler):
+    """A misconfigured endpoint: every request gets a 200 login page."""
+
+    def do_GET(self):
+        body = b"<html><body>Please sign in</body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def test_non_json_endpoint_is_a_per_endpoint_failure(fhir_url):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HTMLHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        fed = FederatedClient({"EHR": fhir_url, "Portal": f"http://127.0.0.1:{server.server_port}/fhir"})
+        ids = cohort_patient_ids(fed, "44054006")
+    finally:
+        server.shutdown()
+    assert ids
+    assert fed.stats["EHR"]["ok"] is True
+    assert fed.stats["Portal"]["ok"] is False
@@ -0,0 +1,55 @@
+import pandas as pd
+
+import fhir_frames
+
+PATIENT = {"reference": "Patient/p1"}
+
+
+def test_missing_concepts_flatten_to_missing_values():
+    bundle = {"resourceType": "Bundle", "entry": [{"resource": r} for r in [
+        {"resourceType": "Encounter", "id": "e1", "subject": PATIENT, "status": "finished"},
+        {"resourceType": "Encounter", "id": "e2", "subject": PATIENT, "type": [], "class": {}},
+        {"resourceType": "Condition", "id": "c1", "subject": PATIENT},
+        {"resourceType": "Observation", "id": "o1", "subject": PATIENT, "valueCodeableConcept": {}},
+        {"resourceType": "MedicationRequest", "id": "m1", "subject": PATIENT},
+    ]]}
+    frames = fhir_frames.frames(bundle)
+    assert set(frames) == {"Encounter", "Condition", "Observation", "MedicationRequest"}
+    for resource_type, frame in frames.items():
+        assert list(frame.columns) == list(fhir_frames.SCHEMAS[resource_type])
+        assert frame["patient_id"].tolist() == ["p1"] * len(frame)
+    encounters = frames["Encounter"]
+    assert encounters[["class", "type_code", "type"]].isna().all().all()
+    assert frames["Condition"]["code"].isna().all()
+    assert frames["Observation"][["code", "value", "value_text"]].isna().all().all()
+    assert frames["MedicationRequest"][["rxnorm", "name"]].isna().all().all()
+
+
+def test_observation_panels_give_component_rows():
+    observation = {
+        "resourceType": "Observation", "id": "bp", "subject": {"reference": "urn:uuid:p1"},
+        "effectiveDateTime": "2025-03-01T10:00:00+00:00",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "55284-4"}]},
+        "component": [
+            {"code": {"coding": [{"code": "8480-6"}]}, "valueQuantity": {"value": 150, "unit": "mm[Hg]"}},
+            {"code": {"coding": [{"code": "8462-4"}]}, "valueQuantity": {"value": 95, "unit": "mm[Hg]"}},
+        ],
+    }
+    frame = fhir_frames.observations([observation])
+    assert frame["code"].tolist() == ["8480-6", "8462-4"]
+    assert frame["panel"].tolist() == ["55284-4", "55284-4"]
+    assert frame["value"].tolist() == [150.0, 95.0]
+    assert frame["patient_id"].tolist() == ["p1", "p1"]
+    assert frame["effective"].iloc[0] == pd.Timestamp("2025-03-01T10:00:00Z")
+
+
+def test_missing_text_fields_are_missing_not_the_string_none():
+    frame = fhir_frames.patients([
+        {"resourceType": "Patient", "id": "p1", "gender": "male"},
+        {"resourceType": "Patient", "id": "p2", "name": [{"family": "Doe"}]},
+    ])
+    assert frame["family"].isna().tolist() == [True, False]
+    assert frame["given"].isna().all()
+    assert "None" not in frame["family"].tolist()
+    assert frame["family"].iloc[1] == "Doe"
+    assert frame["gender"].isna().tolist() == [False, True]
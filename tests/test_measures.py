@@ -0,0 +1,59 @@
+import pytest
+
+import fhir_server
+import measures
+from conftest import ROOT
+from fhir_client import FHIRClient
+
+
+def test_wilson_interval_closes_on_whole_population():
+    assert measures.wilson_interval(3, 10, population=10) == (0.3, 0.3)
+    assert measures.wilson_interval(0, 1, population=1) == (0.0, 0.0)
+    assert measures.wilson_interval(0, 0, population=0) == (0.0, 0.0)
+    low, high = measures.wilson_interval(3, 10, population=20)
+    assert low < 0.3 < high
+
+
+@pytest.mark.parametrize("condition", list(measures.PRESET_CONDITIONS))
+@pytest.mark.parametrize("first", [1, measures.SAMPLE_START])
+def test_progressive_measure_ends_exact(fallback_store, condition, first):
+    estimates = list(measures.progressive_measure(condition, store=fallback_store, first=first, seed=0))
+    last = estimates[-1]
+    assert last.exact and last.sampled == last.cohort
+    assert last.low == last.high == last.gap_rate
+    assert last.summary == measures.run_measure(condition, store=fallback_store).summary
+
+
+def test_progressive_interval_stays_open_without_lab_results(fallback_store):
+    # No diabetic in fallback-data has an HbA1c, so every partial batch has
+    # with_lab == 0; only the final, whole-cohort estimate may close.
+    estimates = list(measures.progressive_measure("Diabetes Mellitus Type 2", store=fallback_store, first=1, seed=0))
+    assert len(estimates) > 1
+    for estimate in estimates[:-1]:
+        assert estimate.summary["with_lab"] == 0
+        assert (estimate.low, estimate.high) == (0.0, 1.0)
+    assert (estimates[-1].low, estimates[-1].high) == (0.0, 0.0)
+
+
+
+@pytest.fixture(scope="module")
+def fallback_client():
+    """A client for a local FHIR server over fallback-data/."""
+    index = fhir_server.ResourceIndex()
+    index.load_dir(ROOT / "fallback-data")
+    server = fhir_server.serve_in_background(index)
+    yield FHIRClient(server.base_url, cache=False)
+    server.shutdown()
+
+
+@pytest.mark.parametrize("condition", list(measures.PRESET_CONDITIONS))
+def test_store_and_fhir_define_the_same_cohort(fallback_store, fallback_client, condition):
+    # fallback-data has Conditions whose Patient resource is missing; both
+    # backends keep those patients and count only active Conditions.
+    from_store = measures.run_measure(condition, store=fallback_store).summary
+    assert measures.run_measure(condition, client=fallback_client).summary == from_store
+
+
+def test_store_cohort_keeps_patients_without_a_patient_record(fallback_store):
+    summary = measures.run_measure("Diabetes Mellitus Type 2", store=fallback_store).summary
+    assert summary["cohort"] == 47
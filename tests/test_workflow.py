@@ -0,0 +1,40 @@
+import functools
+import os
+import time
+from pathlib import Path
+
+import workflow
+from artifact_store import ArtifactStore
+from exec_pool import ExecutionPool
+from jobs import Job, JobQueue
+from llm_cache import LLMCache
+
+
+def test_timed_out_run_keeps_its_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(workflow, "run_code", functools.partial(workflow.run_code, timeout=1))
+    pool = ExecutionPool(size=1, timeout=30, memory_mb=None)
+    artifacts = ArtifactStore(tmp_path / "artifacts")
+    try:
+        [(_, execute)] = workflow.llm_job_kinds(LLMCache(tmp_path / "llm.db"), pool, artifacts)["llm-cached"]
+        job = Job("job1", "llm-cached", "slow", {}, result={"code": "import time\nprint('started', flush=True)\ntime.sleep(60)\n"})
+        job.work_dir = str(tmp_path / "jobs" / job.id)
+        Path(job.work_dir).mkdir(parents=True)
+        execute(job)
+    finally:
+        pool.close()
+    assert job.error == "Code execution timed out"
+    assert not os.path.exists(job.work_dir)
+    assert Path(job.result["output_path"]).read_text() == "started\n"
+    assert job.result["output_path"].startswith(str(artifacts.root))
+
+
+def test_queue_prunes_old_work_dirs(tmp_path):
+    old, recent = tmp_path / "jobs" / "old", tmp_path / "jobs" / "recent"
+    for work_dir in (old, recent):
+        work_dir.mkdir(parents=True)
+        (work_dir / "gap_patients.csv").write_text("patient_id\n")
+    past = time.time() - 3 * 24 * 3600
+    os.utime(old, (past, past))
+    JobQueue(tmp_path / "jobs.db", work_dir_ttl=24 * 3600)
+    assert not old.exists()
+    assert recent.exists()